@@ -0,0 +1,306 @@
+import pandas as pd
+import numpy as np
+from functools import partial
+
+from Analysis.spatial_density import DEFAULT_RADII_KM, monitor_radius_density, tract_radius_density
+from Integration.partitioning import combine, partition, run_partitions
+from Integration.schema import plain
+from Pipeline.instrumentation import instrumented
+
+# Geographic levels the tract-level branch density can be rolled up to
+ROLLUP_LEVELS = ["county", "city", "cbsa"]
+
+# Columns of the case study sheets the branch counts, tract geography and radius features are derived from
+SOD_DENSITY_COLUMNS = ["census_tract", "STCNTYBR", "CNTYNAMB", "CITYBR", "MSABR", "MSANAMB", "SIMS_LATITUDE", "SIMS_LONGITUDE"]
+NCUA_DENSITY_COLUMNS = ["census tract", "PhysicalAddressCountyName", "PhysicalAddressCity"]
+AQ_DENSITY_COLUMNS = ["census_tract", "latitude", "longitude"]
+
+
+def encode(keys):
+    """
+        Encode keys as integer codes into their sorted unique values, with -1 for missing keys.
+        Whole-number float keys (census tracts that went through a merge) are returned as integers.
+    """
+    codes, uniques = pd.factorize(pd.Series(keys), sort=True)
+    uniques = pd.Index(uniques)
+    if pd.api.types.is_float_dtype(uniques) and (uniques % 1 == 0).all():
+        uniques = uniques.astype("int64")
+    return codes, uniques
+
+
+def count_unique(codes, n_keys, ids):
+    """
+        Count the distinct non-missing ids of every key code in a single vectorized pass.
+        Each (key, id) pair is packed into one integer so the distinct pairs can be found with one np.unique.
+    """
+    id_codes, id_uniques = pd.factorize(pd.Series(ids))
+    valid = (codes >= 0) & (id_codes >= 0)
+    pairs = np.unique(codes[valid].astype("int64") * max(len(id_uniques), 1) + id_codes[valid])
+    return np.bincount(pairs // max(len(id_uniques), 1), minlength=n_keys)
+
+
+def count_rows(keys, name, key_name="census_tract"):
+    """
+        Count the rows of every key, e.g. the branches of every census tract when every row is a unique branch.
+        Rows with a missing key are not counted.
+    """
+    codes, uniques = encode(keys)
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    return pd.DataFrame({key_name: uniques, name: counts})
+
+
+def branch_density(frame, bank_column, creditunion_column, key="census_tract"):
+    """
+        Count the unique banks and credit unions, and their total, for every key of a frame with one row per branch pairing.
+
+        Args:
+            frame (DataFrame): The integrated rows, e.g. from Integrated_Filtered_Data.
+            bank_column (str): The column identifying the bank (e.g. "CERT_SOD").
+            creditunion_column (str): The column identifying the credit union site (e.g. "SiteId_NCUA").
+            key (str): The column the branches are counted by.
+
+        Returns:
+            DataFrame: The key and the unique_bank_count, unique_creditunion_count and total_branch_count columns.
+    """
+    codes, uniques = encode(frame[key])
+    banks = count_unique(codes, len(uniques), frame[bank_column])
+    creditunions = count_unique(codes, len(uniques), frame[creditunion_column])
+    return pd.DataFrame({
+        key: uniques,
+        'unique_bank_count': banks,
+        'unique_creditunion_count': creditunions,
+        'total_branch_count': banks + creditunions,
+    })
+
+
+def combine_counts(bank_counts, creditunion_counts, key="census_tract"):
+    """
+        Combine the bank branch counts and credit union branch counts of every key into one table with their total.
+        A key missing from one of the tables has no branches of that kind.
+    """
+    combined = pd.merge(bank_counts, creditunion_counts, on=key, how='outer')
+    count_columns = [column for column in combined.columns if column != key]
+    combined[count_columns] = combined[count_columns].fillna(0).astype("int64")
+    combined['total_branch_count'] = combined[count_columns].sum(axis=1)
+    return combined
+
+
+def sort_desc(counts, column):
+    """
+        Sort counts in descending order, breaking ties by key so that the order is deterministic.
+    """
+    return counts.sort_values(column, ascending=False, kind="stable").reset_index(drop=True)
+
+
+def most_common(keys, values):
+    """
+        Return the most common non-missing value of every key.
+    """
+    pairs = pd.DataFrame({"key": keys, "value": values}).dropna()
+    counts = pairs.groupby(["key", "value"]).size().reset_index(name="n")
+    counts = counts.sort_values(["key", "n"], ascending=[True, False], kind="stable")
+    return counts.drop_duplicates("key").set_index("key")["value"]
+
+
+def tract_geography(sod, ncua):
+    """
+        Map every census tract of the SOD and NCUA data to its county, city and CBSA.
+
+        The county and CBSA are determined by the state and county FIPS code (the first five digits of the tract),
+        using the SOD county names and metropolitan statistical areas; tracts in counties without a bank fall back to the NCUA county.
+        The city is the most common branch city in the tract.
+
+        Args:
+            sod (DataFrame): The SOD_IL_2024 sheet, with at least the SOD_DENSITY_COLUMNS.
+            ncua (DataFrame): The NCUA_IL_Q2_2024 sheet, with at least the NCUA_DENSITY_COLUMNS.
+
+        Returns:
+            DataFrame: The county, city and cbsa of every census tract, indexed by census_tract.
+    """
+    sod = sod.dropna(subset=["census_tract"])
+    ncua = ncua.dropna(subset=["census tract"])
+
+    tracts = pd.Index(np.union1d(sod["census_tract"].astype("int64"), ncua["census tract"].astype("int64")), name="census_tract")
+    county_fips = pd.Series(tracts // 1_000_000, index=tracts)
+
+    sod_counties = sod.drop_duplicates("STCNTYBR").set_index("STCNTYBR")
+    ncua_county_fips = ncua["census tract"].astype("int64") // 1_000_000
+    ncua_counties = most_common(ncua_county_fips, ncua["PhysicalAddressCountyName"])
+    metros = sod_counties[sod_counties["MSABR"] != 0]["MSANAMB"]
+
+    cities = pd.concat([
+        pd.DataFrame({"tract": sod["census_tract"].astype("int64"), "city": sod["CITYBR"]}),
+        pd.DataFrame({"tract": ncua["census tract"].astype("int64"), "city": ncua["PhysicalAddressCity"]}),
+    ])
+
+    geography = pd.DataFrame(index=tracts)
+    geography["county"] = county_fips.map(plain(sod_counties["CNTYNAMB"])).fillna(county_fips.map(ncua_counties))
+    geography["city"] = pd.Series(tracts, index=tracts).map(most_common(cities["tract"], cities["city"].str.title()))
+    geography["cbsa"] = county_fips.map(metros)
+    return geography
+
+
+def rollup_rows(frame, geography, level, bank_column, creditunion_column, key="census_tract"):
+    """
+        Map the integrated rows from their census tract to the area of a coarser geographic level.
+
+        Returns:
+            DataFrame: The area (in the level column) and the institution columns of every row.
+    """
+    if level not in ROLLUP_LEVELS:
+        raise ValueError(f"Unknown rollup level {level}, expected one of {ROLLUP_LEVELS}")
+
+    # Keep the dtype of the areas also when none of the tracts has one, e.g. in a partition of tracts without geography
+    areas = pd.Series(frame[key].to_numpy()).map(geography[level]).astype(geography[level].dtype)
+    return pd.DataFrame({level: areas.array, bank_column: frame[bank_column].array, creditunion_column: frame[creditunion_column].array})
+
+
+def rollup(frame, geography, level, bank_column, creditunion_column, key="census_tract"):
+    """
+        Roll the branch density up from census tracts to a coarser geographic level.
+        Banks and credit unions are counted once per area, even if they have branches in several of its tracts.
+
+        Args:
+            frame (DataFrame): The integrated rows with the census tract and the institution columns.
+            geography (DataFrame): The tract geography (see tract_geography).
+            level (str): One of ROLLUP_LEVELS.
+            bank_column (str): The column identifying the bank.
+            creditunion_column (str): The column identifying the credit union site.
+
+        Returns:
+            DataFrame: The area and its unique_bank_count, unique_creditunion_count and total_branch_count.
+    """
+    rows = rollup_rows(frame, geography, level, bank_column, creditunion_column, key)
+    return branch_density(rows, bank_column, creditunion_column, key=level)
+
+
+def rollup_sheet(level):
+    return level.upper() if level == "cbsa" else level.title()
+
+
+@instrumented()
+def branch_count_sheets(sod, ncua, integrated, bank_column, creditunion_column, aq=None, radii_km=DEFAULT_RADII_KM, workers=0,
+                        integrated_counts=None):
+    """
+        Calculate every branch count table the branch density scripts save, sorted by descending count.
+
+        Args:
+            sod (DataFrame): The SOD_IL_2024 sheet.
+            ncua (DataFrame): The NCUA_IL_Q2_2024 sheet.
+            integrated (DataFrame): The integrated rows with the census_tract and institution columns.
+            bank_column (str): The integrated column identifying the bank.
+            creditunion_column (str): The integrated column identifying the credit union site.
+            aq (DataFrame): The AirQuality_EPA_IL sheet. If given, the bank branches within radii_km of every monitor
+                and tract centroid are added as the Monitor_Radius and Tract_Radius sheets.
+            radii_km (list): The radii in kilometers of the radius features.
+            workers (int): The number of worker processes to partition the work by state over (see branch_count_sheets_by_state).
+                0 calculates the tables in this process.
+            integrated_counts (DataFrame): The tract-level counts of the integrated rows sorted by census tract, e.g. the
+                Tract_Branch_Counts table the integration maintains (see delta_ingestion.refresh_branch_counts).
+                Defaults to counting them from integrated.
+
+        Returns:
+            dict: The count tables keyed by sheet name.
+    """
+    if workers:
+        sheets = branch_count_sheets_by_state(sod, ncua, integrated, bank_column, creditunion_column, aq, radii_km, workers)
+        if integrated_counts is not None:
+            sheets['Integrated'] = sort_desc(integrated_counts, 'total_branch_count')
+        return sheets
+
+    # Since all rows in SOD and NCUA data are unique, we can simply count the number of rows for each census tract
+    sod_branch_count = count_rows(sod['census_tract'], 'bank_branch_count')
+    ncua_branch_count = count_rows(ncua['census tract'], 'credit_union_branch_count')
+
+    # For the integrated data, we need to count the number of unique bank branches and credit union branches for each census tract
+    if integrated_counts is None:
+        integrated_counts = branch_density(integrated, bank_column, creditunion_column)
+
+    geography = tract_geography(sod, ncua)
+    sheets = {
+        'SOD': sort_desc(sod_branch_count, 'bank_branch_count'),
+        'NCUA': sort_desc(ncua_branch_count, 'credit_union_branch_count'),
+        'Integrated': sort_desc(integrated_counts, 'total_branch_count'),
+        'SOD_NCUA_Combined': sort_desc(combine_counts(sod_branch_count, ncua_branch_count), 'total_branch_count'),
+    }
+    for level in ROLLUP_LEVELS:
+        sheets[rollup_sheet(level)] = sort_desc(
+            rollup(integrated, geography, level, bank_column, creditunion_column), 'total_branch_count')
+
+    # Branch coordinates are only available for banks (SOD), so the radius features count bank branches
+    if aq is not None:
+        sheets['Monitor_Radius'] = monitor_radius_density(aq, sod, radii_km)
+        sheets['Tract_Radius'] = tract_radius_density(aq, sod, radii_km)
+    return sheets
+
+
+def partition_counts(sod, ncua, integrated, geography, aq=None, branches=None, bank_column=None, creditunion_column=None, radii_km=DEFAULT_RADII_KM):
+    """
+        Calculate the partial branch counts of one state partition (see branch_count_sheets_by_state).
+        The rollups are returned as the distinct rows of every area, since an area like a CBSA or a city name can span states.
+        The monitors are indexed by the position of their first row in the AirQuality data.
+    """
+    partials = {
+        'SOD': count_rows(sod['census_tract'], 'bank_branch_count'),
+        'NCUA': count_rows(ncua['census tract'], 'credit_union_branch_count'),
+        'Integrated': branch_density(integrated, bank_column, creditunion_column),
+    }
+    geography = geography.set_index("census_tract")
+    for level in ROLLUP_LEVELS:
+        partials[level] = rollup_rows(integrated, geography, level, bank_column, creditunion_column).drop_duplicates()
+
+    if aq is not None:
+        monitors = monitor_radius_density(aq, branches, radii_km)
+        monitors.index = aq[["census_tract", "latitude", "longitude"]].drop_duplicates().index
+        partials['Monitor_Radius'] = monitors
+        partials['Tract_Radius'] = tract_radius_density(aq, sod, radii_km, branches=branches)
+    return partials
+
+
+@instrumented()
+def branch_count_sheets_by_state(sod, ncua, integrated, bank_column, creditunion_column, aq=None, radii_km=DEFAULT_RADII_KM, workers=1):
+    """
+        Calculate the tables of branch_count_sheets with the rows partitioned by the state of their census tract,
+        in a process pool, and combine the partitions into the same tables as a single-process run.
+
+        The tract geography is calculated once over all rows and split with them. Every partition counts the branches of
+        its own tracts and the radius features of its own monitors and tracts, against the coordinates of all branches so
+        that branches across a state line are counted. The tract-level tables are concatenated in state order, which keeps
+        them sorted by tract, and the rollups are counted from the distinct rows of every partition.
+
+        Args:
+            sod (DataFrame): The SOD sheet.
+            ncua (DataFrame): The NCUA sheet.
+            integrated (DataFrame): The integrated rows with the census_tract and institution columns.
+            bank_column (str): The integrated column identifying the bank.
+            creditunion_column (str): The integrated column identifying the credit union site.
+            aq (DataFrame): The AirQuality sheet, to add the Monitor_Radius and Tract_Radius sheets.
+            radii_km (list): The radii in kilometers of the radius features.
+            workers (int): The number of worker processes.
+
+        Returns:
+            dict: The count tables keyed by sheet name.
+    """
+    geography = tract_geography(sod, ncua).rename_axis("census_tract").reset_index()
+    frames = [sod, ncua, integrated, geography] + ([aq.reset_index(drop=True)] if aq is not None else [])
+    tract_columns = ["census_tract", "census tract", "census_tract", "census_tract", "census_tract"][:len(frames)]
+    count = partial(partition_counts, branches=sod[["SIMS_LATITUDE", "SIMS_LONGITUDE"]], bank_column=bank_column,
+                    creditunion_column=creditunion_column, radii_km=radii_km)
+    partials = list(run_partitions(count, partition(frames, tract_columns), workers).values())
+
+    sod_branch_count = combine([counts['SOD'] for counts in partials])
+    ncua_branch_count = combine([counts['NCUA'] for counts in partials])
+    sheets = {
+        'SOD': sort_desc(sod_branch_count, 'bank_branch_count'),
+        'NCUA': sort_desc(ncua_branch_count, 'credit_union_branch_count'),
+        'Integrated': sort_desc(combine([counts['Integrated'] for counts in partials]), 'total_branch_count'),
+        'SOD_NCUA_Combined': sort_desc(combine_counts(sod_branch_count, ncua_branch_count), 'total_branch_count'),
+    }
+    for level in ROLLUP_LEVELS:
+        rows = combine([counts[level] for counts in partials])
+        sheets[rollup_sheet(level)] = sort_desc(branch_density(rows, bank_column, creditunion_column, key=level), 'total_branch_count')
+
+    if aq is not None:
+        sheets['Monitor_Radius'] = combine([counts['Monitor_Radius'] for counts in partials], ordered=True).reset_index(drop=True)
+        sheets['Tract_Radius'] = combine([counts['Tract_Radius'] for counts in partials])
+    return sheets
@@ -1,12 +1,32 @@
-import pandas as pd
+import argparse
 import os
 import sys
 
-def main():
+# Add the repository root to the path so that the shared modules can be imported when run as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Integration.workbook_cache import read_sheet
+from Integration.partitioning import partition_workers
+from Integration.sinks import ARTIFACT_FORMATS, write_output
+from Integration.schema import compact, report_footprint
+from Integration.delta_ingestion import TRACT_BRANCH_COUNTS_TABLE
+from Integration.sqlite_store import has_table, read_table
+from Analysis.branch_density import AQ_DENSITY_COLUMNS, SOD_DENSITY_COLUMNS, NCUA_DENSITY_COLUMNS, branch_count_sheets
+from Pipeline.instrumentation import stage, step
+
+@stage("branch_density_original")
+def main(workers=None, format=None):
     """
         This function reads the case study data and the integrated data, and calculates the branch density for each dataset.
-        The branch density is calculated as the number of branches per census tract.
-        The function then saves the branch density data to an Excel file.
+        The branch density is calculated as the number of branches per census tract, and rolled up to county, city and CBSA.
+        The number of bank branches within several radii of every air-quality monitor and tract centroid is added as well.
+        The function then saves the branch density data to the branch_counts output (e.g. branch_counts.arrow).
+
+        Args:
+            workers (int): The number of worker processes to partition the counts by state over, so every state is counted
+                in parallel. 0 counts in this process. Defaults to the PIPELINE_PARTITION_WORKERS variable.
+            format (str): The format of the output file (see sinks.output_format). Defaults to the PIPELINE_OUTPUT_FORMAT variable,
+                or else the columnar Arrow format.
     """
     
     # Add the data directory to the path so that we can import the data files directly
@@ -15,43 +35,40 @@ def main():
     data_dir = os.path.join(parent_dir, "data/")
     sys.path.append(data_dir)
     
-    case_study_file = "20241125 Case Study for Position SE_Data (1).xlsx"
-    integrated_filtered_data_file = "integrated_filtered_data.xlsx"
+    integrated_filtered_data_db = "integrated_filtered_data.db"
+    integrated_table = "Integrated_Filtered_Data"
+
+    # The rollups count the unique institutions of every area, which the one row per tract of the aggregate mode does not hold
+    if not has_table(integrated_filtered_data_db, integrated_table):
+        raise ValueError(f"{integrated_filtered_data_db} has no {integrated_table} table; run data_integrate_filtered.py "
+                         "in the merged or normalized mode first")
+
+    sod_data = read_sheet("SOD_IL_2024", columns=SOD_DENSITY_COLUMNS)
+    ncua_data = read_sheet("NCUA_IL_Q2_2024", columns=NCUA_DENSITY_COLUMNS)
+    aq_data = read_sheet("AirQuality_EPA_IL", columns=AQ_DENSITY_COLUMNS)
+    integrated_data = compact(read_table(integrated_filtered_data_db, integrated_table, columns=["census_tract", "CERT_SOD", "SiteId_NCUA"]), name=integrated_table)
+
+    # The integration keeps the tract-level counts of the integrated rows up to date in SQL, even when it only refreshes
+    # the changed tracts, so they are read instead of counted; databases without the table are counted as before
+    integrated_counts = None
+    if has_table(integrated_filtered_data_db, TRACT_BRANCH_COUNTS_TABLE):
+        integrated_counts = read_table(integrated_filtered_data_db, TRACT_BRANCH_COUNTS_TABLE, order_by="census_tract")
+        integrated_counts = integrated_counts.astype({"census_tract": "Int64"})
+
+    # Tract-level counts for each dataset, the integrated counts rolled up to county, city and CBSA,
+    # and the bank branches within several radii of every monitor and tract centroid
+    sheets = branch_count_sheets(sod_data, ncua_data, integrated_data, bank_column='CERT_SOD', creditunion_column='SiteId_NCUA', aq=aq_data,
+                                 workers=partition_workers(workers), integrated_counts=integrated_counts)
+
+    with step("write_output", rows_in=sum(len(counts) for counts in sheets.values())):
+        output_file = write_output(sheets, 'branch_counts', format)
 
-    sod_data = pd.read_excel(case_study_file, sheet_name="SOD_IL_2024")
-    ncua_data = pd.read_excel(case_study_file, sheet_name="NCUA_IL_Q2_2024")
-    integrated_data = pd.read_excel(integrated_filtered_data_file)
-    
-    # Since all rows in SOD data are unique, we can simply count the number of rows for each census tract
-    sod_branch_count = sod_data.groupby('census_tract').size().reset_index(name='bank_branch_count')
-    sod_branch_count_desc = sod_branch_count.sort_values('bank_branch_count', ascending=False)
-    
-    # Since all rows in NCUA data are unique, we can simply count the number of rows for each census tract
-    ncua_branch_count = ncua_data.groupby('census tract').size().reset_index(name='credit_union_branch_count')
-    ncua_branch_count.rename(columns={'census tract': 'census_tract'}, inplace=True)
-    ncua_branch_count_desc = ncua_branch_count.sort_values('credit_union_branch_count', ascending=False)
-    
-    # For the integrated data, we need to count the number of unique bank branches and credit union branches for each census tract
-    integrated_sod_counts = integrated_data.groupby('census_tract')['CERT_SOD'].nunique().reset_index(name='unique_bank_count')
-    integrated_ncua_counts = integrated_data.groupby('census_tract')['SiteId_NCUA'].nunique().reset_index(name='unique_creditunion_count')
-    integrated_branch_count = pd.merge(integrated_sod_counts, integrated_ncua_counts, on='census_tract', how='outer')
-    integrated_branch_count['total_branch_count'] = integrated_branch_count['unique_bank_count'] + integrated_branch_count['unique_creditunion_count']
-    integrated_branch_count_desc = integrated_branch_count.sort_values('total_branch_count', ascending=False)
-    
-    # Combine the SOD and NCUA branch counts
-    sod_ncua_combined = pd.merge(sod_branch_count, ncua_branch_count, on='census_tract', how='outer')
-    sod_ncua_combined.fillna(0, inplace=True)
-    sod_ncua_combined['total_branch_count'] = sod_ncua_combined['bank_branch_count'] + sod_ncua_combined['credit_union_branch_count']
-    sod_ncua_combined_desc = sod_ncua_combined.sort_values('total_branch_count', ascending=False)
-    
-    output_file = 'branch_counts.xlsx'
-    with pd.ExcelWriter(output_file) as writer:
-        sod_branch_count_desc.to_excel(writer, sheet_name='SOD', index=False)
-        ncua_branch_count_desc.to_excel(writer, sheet_name='NCUA', index=False)
-        integrated_branch_count_desc.to_excel(writer, sheet_name='Integrated', index=False)
-        sod_ncua_combined_desc.to_excel(writer, sheet_name='SOD_NCUA_Combined', index=False)
-    
     print("Branch density data saved to", output_file)
+    report_footprint()
     
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Calculate the branch density of the case study data and the filtered integrated data.")
+    parser.add_argument("--partition-workers", type=int, help="Count every state in parallel over this many worker processes (0 for a single process)")
+    parser.add_argument("--output-format", choices=ARTIFACT_FORMATS, help="Format of the output files (defaults to the PIPELINE_OUTPUT_FORMAT variable or arrow)")
+    args = parser.parse_args()
+    main(args.partition_workers, args.output_format)
\ No newline at end of file
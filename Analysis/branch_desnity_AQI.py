@@ -1,13 +1,37 @@
 import pandas as pd
+import argparse
 import os 
 import sys
 
-def main():
+# Add the repository root to the path so that the shared modules can be imported when run as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Integration.workbook_cache import read_sheet
+from Integration.partitioning import partition_workers
+from Integration.pm25_aggregates import PM25_YEAR, tract_means
+from Integration.sinks import ARTIFACT_FORMATS, write_output
+from Integration.schema import compact, report_footprint
+from Integration.sqlite_store import connect, bulk_load, read_table
+from Analysis.branch_density import AQ_DENSITY_COLUMNS, SOD_DENSITY_COLUMNS, NCUA_DENSITY_COLUMNS, branch_count_sheets, sort_desc, tract_geography
+from Analysis.density_cube import density_cubes, refresh_cubes
+from Pipeline.instrumentation import stage, step
+
+@stage("branch_density_aqi")
+def main(workers=None, format=None, year=PM25_YEAR):
     """
         This function reads the case study data and the integrated data, and calculates the branch density for each dataset.
-        The branch density is calculated as the number of branches per census tract.
-        The function then saves the branch density data to an Excel file.
-        This function also merges the branch density data with the AQI means data and saves the merged data to an Excel file.
+        The branch density is calculated as the number of branches per census tract, and rolled up to county, city and CBSA.
+        The number of bank branches within several radii of every air-quality monitor and tract centroid is added as well.
+        The function then saves the branch density data to the branch_counts_aqi output (e.g. branch_counts_aqi.arrow).
+        This function also merges the branch density data with the AQI means data and saves the merged data to the branch_counts_with_pm25 output.
+        The branch density cube, the counts by tract, county and CBSA and PM2.5 bucket, is refreshed in branch_density.db for the query layers.
+
+        Args:
+            workers (int): The number of worker processes to partition the counts by state over, so every state is counted
+                in parallel. 0 counts in this process. Defaults to the PIPELINE_PARTITION_WORKERS variable.
+            format (str): The format of the output files (see sinks.output_format). Defaults to the PIPELINE_OUTPUT_FORMAT variable,
+                or else the columnar Arrow format.
+            year (int): The year of the PM2.5 tract means.
     """
     
     
@@ -17,56 +41,61 @@ def main():
     data_dir = os.path.join(parent_dir, "data/")
     sys.path.append(data_dir)
     
-    case_study_file = "20241125 Case Study for Position SE_Data (1).xlsx"
-    integrated_aqi_data_file = "Integrated_with_PM25.xlsx"
-    
-    sod_data = pd.read_excel(case_study_file, sheet_name="SOD_IL_2024")
-    ncua_data = pd.read_excel(case_study_file, sheet_name="NCUA_IL_Q2_2024")
-    integrated_data = pd.read_excel(integrated_aqi_data_file)
-    
-    # Since all rows in SOD data are unique, we can simply count the number of rows for each census tract
-    sod_branch_count = sod_data.groupby('census_tract').size().reset_index(name='bank_branch_count')
-    sod_branch_count_desc = sod_branch_count.sort_values('bank_branch_count', ascending=False)
-    
-    # Since all rows in NCUA data are unique, we can simply count the number of rows for each census tract
-    ncua_branch_count = ncua_data.groupby('census tract').size().reset_index(name='credit_union_branch_count')
-    ncua_branch_count.rename(columns={'census tract': 'census_tract'}, inplace=True)
-    ncua_branch_count_desc = ncua_branch_count.sort_values('credit_union_branch_count', ascending=False)
-    
-    # For the integrated data, we need to count the number of unique bank branches and credit union branches for each census tract
-    integrated_sod_counts = integrated_data.groupby('census_tract')['CERT'].nunique().reset_index(name='unique_bank_count')
-    integrated_ncua_counts = integrated_data.groupby('census_tract')['SiteId'].nunique().reset_index(name='unique_creditunion_count')
-    integrated_branch_count = pd.merge(integrated_sod_counts, integrated_ncua_counts, on='census_tract', how='outer')
-    integrated_branch_count['total_branch_count'] = integrated_branch_count['unique_bank_count'] + integrated_branch_count['unique_creditunion_count']
-    integrated_branch_count_desc = integrated_branch_count.sort_values('total_branch_count', ascending=False)
-    
-    # Combine the SOD and NCUA branch counts
-    sod_ncua_combined = pd.merge(sod_branch_count, ncua_branch_count, on='census_tract', how='outer')
-    sod_ncua_combined.fillna(0, inplace=True)
-    sod_ncua_combined['total_branch_count'] = sod_ncua_combined['bank_branch_count'] + sod_ncua_combined['credit_union_branch_count']
-    sod_ncua_combined_desc = sod_ncua_combined.sort_values('total_branch_count', ascending=False)
+    integrated_aqi_data_db = "integrated_with_pm25.db"
     
-    output_file = 'branch_counts.xlsx'
-    with pd.ExcelWriter(output_file) as writer:
-        sod_branch_count_desc.to_excel(writer, sheet_name='SOD', index=False)
-        ncua_branch_count_desc.to_excel(writer, sheet_name='NCUA', index=False)
-        integrated_branch_count_desc.to_excel(writer, sheet_name='Integrated', index=False)
-        sod_ncua_combined_desc.to_excel(writer, sheet_name='SOD_NCUA_Combined', index=False)
-        
+    sod_data = read_sheet("SOD_IL_2024", columns=SOD_DENSITY_COLUMNS)
+    ncua_data = read_sheet("NCUA_IL_Q2_2024", columns=NCUA_DENSITY_COLUMNS)
+    aq_data = read_sheet("AirQuality_EPA_IL", columns=AQ_DENSITY_COLUMNS)
+    integrated_data = compact(read_table(integrated_aqi_data_db, "Integrated_With_PM25", columns=["census_tract", "CERT", "SiteId"]), name="Integrated_With_PM25")
+
+    # Tract-level counts for each dataset, the integrated counts rolled up to county, city and CBSA,
+    # and the bank branches within several radii of every monitor and tract centroid
+    sheets = branch_count_sheets(sod_data, ncua_data, integrated_data, bank_column='CERT', creditunion_column='SiteId', aq=aq_data,
+                                 workers=partition_workers(workers))
+    integrated_branch_count = sheets['Integrated']
+
+    with step("write_output", rows_in=sum(len(counts) for counts in sheets.values())):
+        output_file = write_output(sheets, 'branch_counts_aqi', format)
+
     print("Branch density new data saved to", output_file)
     
-    # Merge the integrated branch count data with the AQI means data
-    aqi_means_file = "AQI_2020_means.xlsx"
-    aqi_means = pd.read_excel(aqi_means_file)
-    
-    integrated_branch_count_with_pm25 = pd.merge(integrated_branch_count, aqi_means, on='census_tract', how='left')
-    integrated_branch_count_with_pm25_desc = integrated_branch_count_with_pm25.sort_values('total_branch_count', ascending=False)
+    # Merge the integrated branch count data with the AQI means of the year from the PM2.5 aggregate store
+    aqi_means = tract_means(year)
     
-    # Save the integrated branch count data with AQI means to an Excel file
-    output_file = 'branch_counts_with_pm25.xlsx'
-    integrated_branch_count_with_pm25_desc.to_excel(output_file, index=False)
+    with step("merge_pm25", rows_in=len(integrated_branch_count)) as record:
+        integrated_branch_count_with_pm25 = pd.merge(integrated_branch_count, aqi_means, on='census_tract', how='left')
+
+        # Add the radius-based density of every tract as extra features
+        radius_features = sheets['Tract_Radius'].drop(columns=['latitude', 'longitude'])
+        integrated_branch_count_with_pm25 = pd.merge(integrated_branch_count_with_pm25, radius_features, on='census_tract', how='left')
+        integrated_branch_count_with_pm25_desc = sort_desc(integrated_branch_count_with_pm25, 'total_branch_count')
+        record.rows_out = len(integrated_branch_count_with_pm25_desc)
+
+    # Summarize the counts by tract, county and CBSA and PM2.5 bucket, for the group-by and threshold queries
+    with step("build_cube", rows_in=len(integrated_data)) as record:
+        cubes = density_cubes(integrated_branch_count_with_pm25_desc, integrated_data, tract_geography(sod_data, ncua_data),
+                              bank_column='CERT', creditunion_column='SiteId')
+        record.rows_out = sum(len(cube) for cube in cubes.values())
     
+    # Save the integrated branch count data with AQI means to an output file, which the model selection reads
+    with step("write_output", rows_in=len(integrated_branch_count_with_pm25_desc)):
+        output_file = write_output({"Branch_Counts_With_PM25": integrated_branch_count_with_pm25_desc}, 'branch_counts_with_pm25', format)
+
+    # Also store it in SQLite so the analysis and NLP layers can query it without reloading the output file
+    db_name = "branch_density.db"
+    conn = connect(db_name)
+    bulk_load(conn, "Branch_Counts_With_PM25", integrated_branch_count_with_pm25_desc)
+    refresh_cubes(conn, cubes)
+    conn.close()
+
     print("Branch density data with PM2.5 saved to", output_file)
+    print("Branch density data with PM2.5 saved to", db_name)
+    report_footprint()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Calculate the branch density of the case study data and the PM2.5 integrated data.")
+    parser.add_argument("--partition-workers", type=int, help="Count every state in parallel over this many worker processes (0 for a single process)")
+    parser.add_argument("--output-format", choices=ARTIFACT_FORMATS, help="Format of the output files (defaults to the PIPELINE_OUTPUT_FORMAT variable or arrow)")
+    parser.add_argument("--year", type=int, default=PM25_YEAR, help=f"Year of the PM2.5 tract means (default: {PM25_YEAR})")
+    args = parser.parse_args()
+    main(args.partition_workers, args.output_format, args.year)
\ No newline at end of file
@@ -1,14 +1,29 @@
-import pandas as pd
 import os
 import sys
-import seaborn as sns
-import matplotlib.pyplot as plt
+import argparse
 
-def main():
+# Add the repository root to the path so that the shared modules can be imported when run as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Integration.sqlite_store import DEFAULT_BATCH_SIZE
+from Analysis.streaming_correlation import (DEFAULT_REPLICATES, SQLiteSource, bootstrap_intervals, correlations,
+                                            correlation_summary, save_heatmap)
+from Pipeline.instrumentation import stage, step
+
+CORRELATION_COLUMNS = ['unique_bank_count', 'unique_creditunion_count', 'total_branch_count', 'mean_pm25_concentration']
+
+@stage("correlation")
+def main(replicates=DEFAULT_REPLICATES, workers=None, chunksize=DEFAULT_BATCH_SIZE):
     """
         Main function for correlation analysis.
-        This function loads the branch density and PM2.5 data, calculates the correlation matrix,
-        and visualizes the correlation matrix using a heatmap
+        This function streams the branch density and PM2.5 data from the SQLite store, calculates the Pearson and
+        Spearman correlation matrices with their bootstrap confidence intervals, and visualizes the Pearson
+        correlation matrix using a heatmap
+
+        Args:
+            replicates (int): The number of bootstrap replicates; 0 skips the confidence intervals.
+            workers (int): The number of worker processes for the bootstrap. Defaults to the number of CPUs.
+            chunksize (int): The number of rows read at a time.
     """
       
     # Add the data directory to the path so that we can import the data files directly
@@ -17,22 +32,29 @@ def main():
     data_dir = os.path.join(parent_dir, "data/")
     sys.path.append(data_dir)
     
-    # Load the branch density and PM2.5 data
-    branch_density_pm_file = "branch_counts_with_pm25.xlsx"
-    df = pd.read_excel(branch_density_pm_file)
-    
-    correlation = df[['unique_bank_count', 'unique_creditunion_count', 'total_branch_count', 'mean_pm25_concentration']].corr()
+    # Stream the branch density and PM2.5 data from the SQLite store written by the branch density script
+    source = SQLiteSource("branch_density.db", "Branch_Counts_With_PM25", CORRELATION_COLUMNS, chunksize)
     
-    # Plot the correlation matrix
-    plt.figure(figsize=(10, 8))
-    sns.heatmap(correlation, annot=True, cmap='coolwarm', fmt=".2f")
-    plt.title("Correlation Matrix")
-    plt.show()
+    correlation, spearman, rank_maps = correlations(source)
+    intervals = bootstrap_intervals(source, rank_maps, replicates, workers=workers) if replicates else None
 
-    # Save the correlation heatmap image
+    # Save every correlation with its confidence interval
+    summary = correlation_summary(correlation, spearman, intervals)
+    correlation_summary_file = "correlation_summary.csv"
+    summary.to_csv(correlation_summary_file, index=False)
+    print(summary.to_string(index=False))
+    print(f"Correlation summary saved to {correlation_summary_file}")
+    
+    # Plot the correlation matrix and save the correlation heatmap image, without opening a window
     correlation_heatmap_file = "correlation_heatmap.png"
-    plt.savefig(correlation_heatmap_file)
+    with step("save_heatmap"):
+        save_heatmap(correlation, correlation_heatmap_file)
     print(f"Correlation heatmap saved to {correlation_heatmap_file}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Correlate the branch density with the PM2.5 concentration.")
+    parser.add_argument("--replicates", type=int, default=DEFAULT_REPLICATES, help="Bootstrap replicates (0 to skip)")
+    parser.add_argument("--workers", type=int, help="Number of worker processes for the bootstrap")
+    parser.add_argument("--chunksize", type=int, default=DEFAULT_BATCH_SIZE, help="Rows read at a time")
+    args = parser.parse_args()
+    main(args.replicates, args.workers, args.chunksize)
@@ -0,0 +1,181 @@
+import numpy as np
+import pandas as pd
+
+from Integration.delta_ingestion import refresh_table
+from Integration.sqlite_store import read_table
+from Pipeline.instrumentation import instrumented
+
+# The upper breakpoints (µg/m³, inclusive) of the EPA AQI categories for PM2.5, as revised in 2024.
+# The bucket of a concentration is the position of its category, so buckets compare like air-quality levels.
+PM25_BUCKETS = [
+    (9.0, "Good"),
+    (35.4, "Moderate"),
+    (55.4, "Unhealthy for Sensitive Groups"),
+    (125.4, "Unhealthy"),
+    (225.4, "Very Unhealthy"),
+    (np.inf, "Hazardous"),
+]
+PM25_CATEGORIES = [category for _, category in PM25_BUCKETS]
+
+# The levels of the cube, the table of every level and the columns identifying its rows.
+# Tracts have one row each; counties and CBSAs have one row per PM2.5 bucket of their tracts.
+CUBE_LEVELS = ["tract", "county", "cbsa"]
+CUBE_TABLES = {"tract": "Tract_Density_Cube", "county": "County_Density_Cube", "cbsa": "CBSA_Density_Cube"}
+CUBE_KEYS = {"tract": ["census_tract"], "county": ["county", "pm25_bucket"], "cbsa": ["cbsa", "pm25_bucket"]}
+
+# The columns the group-by and threshold queries filter on
+CUBE_INDEXES = {
+    "tract": ["census_tract", "pm25_bucket", "mean_pm25_concentration", "total_branch_count"],
+    "county": ["county", "pm25_bucket"],
+    "cbsa": ["cbsa", "pm25_bucket"],
+}
+
+COUNT_COLUMNS = ["unique_bank_count", "unique_creditunion_count", "total_branch_count"]
+
+
+def pm25_bucket(concentrations):
+    """
+        The PM2.5 bucket of every concentration (see PM25_BUCKETS), missing for a missing concentration.
+    """
+    values = np.asarray(concentrations, dtype="float64")
+    buckets = pd.array(np.searchsorted([upper for upper, _ in PM25_BUCKETS], values, side="left"), dtype="Int8")
+    buckets[np.isnan(values)] = pd.NA
+    return buckets
+
+
+def pm25_category(buckets):
+    """
+        The name of the AQI category of every PM2.5 bucket.
+    """
+    codes = pd.array(buckets, dtype="Int8").fillna(-1).to_numpy(dtype="int8")
+    return pd.Categorical.from_codes(codes, categories=PM25_CATEGORIES, ordered=True)
+
+
+def tract_cube(counts, geography):
+    """
+        The tract level of the cube: the PM2.5 concentration, bucket and branch counts of every tract, with its county and CBSA.
+
+        Args:
+            counts (DataFrame): The branch counts of every tract with its mean_pm25_concentration, e.g. Branch_Counts_With_PM25.
+            geography (DataFrame): The tract geography (see branch_density.tract_geography).
+
+        Returns:
+            DataFrame: One row per tract, sorted by census tract.
+    """
+    counts = counts.sort_values("census_tract", kind="stable")
+    tracts = counts["census_tract"].to_numpy(dtype="int64")
+    areas = geography.reindex(tracts)
+    concentrations = counts["mean_pm25_concentration"].to_numpy(dtype="float64", na_value=np.nan)
+    buckets = pm25_bucket(concentrations)
+
+    cube = pd.DataFrame({
+        "census_tract": tracts,
+        "county": areas["county"].array,
+        "cbsa": areas["cbsa"].array,
+        "mean_pm25_concentration": concentrations,
+        "pm25_bucket": buckets,
+        "pm25_category": pm25_category(buckets),
+    })
+    for column in COUNT_COLUMNS:
+        cube[column] = counts[column].to_numpy(dtype="int64")
+    return cube
+
+
+def area_cube(integrated, tracts, level, bank_column, creditunion_column):
+    """
+        The county or CBSA level of the cube: the tracts, mean PM2.5 concentration and unique banks and credit unions
+        of every area and PM2.5 bucket. An institution is counted once per area and bucket, even with branches in several
+        of its tracts, so the counts are taken from the integrated rows rather than summed from the tract level.
+
+        Args:
+            integrated (DataFrame): The integrated rows with the census_tract and institution columns.
+            tracts (DataFrame): The tract level of the cube (see tract_cube).
+            level (str): "county" or "cbsa".
+            bank_column (str): The integrated column identifying the bank.
+            creditunion_column (str): The integrated column identifying the credit union site.
+
+        Returns:
+            DataFrame: One row per area and bucket, sorted by area and bucket. Tracts without an area or a concentration
+                are kept under a missing area or bucket.
+    """
+    keys = [level, "pm25_bucket"]
+    rows = integrated[["census_tract", bank_column, creditunion_column]].merge(tracts[["census_tract"] + keys], on="census_tract")
+
+    areas = tracts.groupby(keys, dropna=False).agg(
+        tract_count=("census_tract", "size"),
+        mean_pm25_concentration=("mean_pm25_concentration", "mean"),
+    )
+    institutions = rows.groupby(keys, dropna=False).agg(
+        unique_bank_count=(bank_column, "nunique"),
+        unique_creditunion_count=(creditunion_column, "nunique"),
+    )
+
+    cube = areas.join(institutions).reset_index()
+    cube[COUNT_COLUMNS[:2]] = cube[COUNT_COLUMNS[:2]].fillna(0).astype("int64")
+    cube["total_branch_count"] = cube["unique_bank_count"] + cube["unique_creditunion_count"]
+    cube["pm25_bucket"] = cube["pm25_bucket"].astype("Int8")
+    cube.insert(2, "pm25_category", pm25_category(cube["pm25_bucket"]))
+    return cube.sort_values(keys, kind="stable").reset_index(drop=True)
+
+
+@instrumented()
+def density_cubes(counts, integrated, geography, bank_column, creditunion_column):
+    """
+        Calculate every level of the branch density cube.
+
+        Args:
+            counts (DataFrame): The branch counts of every tract with its mean_pm25_concentration (see tract_cube).
+            integrated (DataFrame): The integrated rows the counts were calculated from (see area_cube).
+            geography (DataFrame): The tract geography (see branch_density.tract_geography).
+            bank_column (str): The integrated column identifying the bank.
+            creditunion_column (str): The integrated column identifying the credit union site.
+
+        Returns:
+            dict: The rows of every level, keyed by level (see CUBE_LEVELS).
+    """
+    tracts = tract_cube(counts, geography)
+    cubes = {"tract": tracts}
+    for level in CUBE_LEVELS[1:]:
+        cubes[level] = area_cube(integrated, tracts, level, bank_column, creditunion_column)
+    return cubes
+
+
+@instrumented()
+def refresh_cubes(conn, cubes):
+    """
+        Store the levels of the cube in their indexed tables, only rewriting the rows that changed since the last build
+        (see delta_ingestion.refresh_table).
+    """
+    for level, cube in cubes.items():
+        inserted, updated, deleted = refresh_table(conn, CUBE_TABLES[level], cube, CUBE_KEYS[level], CUBE_INDEXES[level])
+        print(f"{CUBE_TABLES[level]}: {inserted} rows inserted, {updated} updated, {deleted} deleted")
+
+
+def read_cube(db_name, level="tract", conditions=None, order_by=None, limit=None):
+    """
+        Read a level of the cube, filtered in SQL on its indexed columns (see sqlite_store.read_table),
+        e.g. read_cube(db, "tract", [("mean_pm25_concentration", ">", 15), ("total_branch_count", ">", 5)]).
+    """
+    if level not in CUBE_TABLES:
+        raise ValueError(f"Unknown cube level {level}, expected one of {CUBE_LEVELS}")
+    return read_table(db_name, CUBE_TABLES[level], conditions=conditions, order_by=order_by, limit=limit)
+
+
+def group_density(tracts, by):
+    """
+        Summarize rows of the tract level of the cube per group, e.g. per PM2.5 bucket: the number of tracts,
+        their mean PM2.5 concentration and their mean bank, credit union and total branch counts, i.e. the branch density per tract.
+
+        Args:
+            tracts (DataFrame): Rows of the tract level of the cube, e.g. the tracts matching a query.
+            by (list): The columns to group by, e.g. ["pm25_bucket", "pm25_category"], ["county"] or ["cbsa"].
+
+        Returns:
+            DataFrame: One row per group, sorted by the group columns.
+    """
+    summary = tracts.groupby(by, dropna=False, observed=True).agg(
+        tract_count=("census_tract", "size"),
+        mean_pm25_concentration=("mean_pm25_concentration", "mean"),
+        **{"mean_" + column: (column, "mean") for column in COUNT_COLUMNS},
+    )
+    return summary.reset_index()
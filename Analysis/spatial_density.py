@@ -0,0 +1,123 @@
+import pandas as pd
+import numpy as np
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Radii of the density features that are added to the branch density output
+DEFAULT_RADII_KM = [1, 2, 5, 10]
+
+
+def to_unit_vectors(latitude, longitude):
+    """
+        Project latitudes and longitudes (in degrees) onto the unit sphere as 3-D Cartesian coordinates.
+        The straight-line (chord) distance between two projected points increases monotonically with their great-circle distance,
+        so a Euclidean KD-tree over these points answers great-circle radius queries exactly.
+    """
+    latitude = np.radians(np.asarray(latitude, dtype="float64"))
+    longitude = np.radians(np.asarray(longitude, dtype="float64"))
+    return np.column_stack([
+        np.cos(latitude) * np.cos(longitude),
+        np.cos(latitude) * np.sin(longitude),
+        np.sin(latitude),
+    ])
+
+
+def chord_length(radius_km):
+    """
+        Convert a great-circle distance in kilometers to the chord length between the projected points on the unit sphere.
+    """
+    return 2 * np.sin(np.minimum(np.asarray(radius_km, dtype="float64") / (2 * EARTH_RADIUS_KM), np.pi / 2))
+
+
+class BranchIndex:
+    """
+        Spatial index over branch coordinates that counts the branches within given radii of many points at once.
+        Building the index is O(n log n) and each query visits only the branches near the point, so the cost does not grow
+        with the product of the number of points and branches like a pairwise distance computation does.
+    """
+
+    def __init__(self, latitude, longitude):
+        latitude = np.asarray(latitude, dtype="float64")
+        longitude = np.asarray(longitude, dtype="float64")
+        valid = ~(np.isnan(latitude) | np.isnan(longitude))
+        self.size = int(valid.sum())
+        self.tree = cKDTree(to_unit_vectors(latitude[valid], longitude[valid]))
+
+    def count_within(self, latitude, longitude, radii_km=DEFAULT_RADII_KM):
+        """
+            Count the branches within each radius of every point, answering all points and radii in one batched query.
+
+            Args:
+                latitude (array): The latitudes of the points.
+                longitude (array): The longitudes of the points.
+                radii_km (list): The radii in kilometers.
+
+            Returns:
+                DataFrame: One branches_within_<radius>km column per radius and one row per point.
+                Points without coordinates get missing counts.
+        """
+        latitude = np.asarray(latitude, dtype="float64")
+        longitude = np.asarray(longitude, dtype="float64")
+        valid = ~(np.isnan(latitude) | np.isnan(longitude))
+        points = to_unit_vectors(latitude[valid], longitude[valid])
+
+        # Repeat the points once per radius so that a single query_ball_point call answers every radius
+        radii = chord_length(radii_km)
+        queries = np.tile(points, (len(radii), 1))
+        lengths = self.tree.query_ball_point(queries, np.repeat(radii, len(points)), return_length=True)
+        lengths = lengths.reshape(len(radii), len(points))
+
+        counts = pd.DataFrame(index=range(len(latitude)))
+        for radius, radius_counts in zip(radii_km, lengths):
+            column = pd.Series(pd.NA, index=counts.index, dtype="Int64")
+            column[valid] = radius_counts
+            counts[f"branches_within_{radius:g}km"] = column
+        return counts
+
+
+def monitor_radius_density(df_aq, df_sod, radii_km=DEFAULT_RADII_KM):
+    """
+        Count the bank branches within each radius of every air-quality monitor.
+
+        Args:
+            df_aq (DataFrame): The AirQuality_EPA_IL sheet, with census_tract, latitude and longitude.
+            df_sod (DataFrame): The SOD_IL_2024 sheet, with SIMS_LATITUDE and SIMS_LONGITUDE.
+            radii_km (list): The radii in kilometers.
+
+        Returns:
+            DataFrame: One row per monitor location with its census_tract, latitude, longitude and branch counts.
+    """
+    monitors = df_aq[["census_tract", "latitude", "longitude"]].drop_duplicates().reset_index(drop=True)
+    index = BranchIndex(df_sod["SIMS_LATITUDE"], df_sod["SIMS_LONGITUDE"])
+    return pd.concat([monitors, index.count_within(monitors["latitude"], monitors["longitude"], radii_km)], axis=1)
+
+
+def tract_centroids(df_aq, df_sod):
+    """
+        Approximate the centroid of every census tract as the mean location of the monitors and bank branches in it.
+        The case study data has no tract boundaries, so this is the best available stand-in for the tract centroid.
+    """
+    points = pd.concat([
+        df_aq[["census_tract", "latitude", "longitude"]].drop_duplicates(),
+        df_sod[["census_tract", "SIMS_LATITUDE", "SIMS_LONGITUDE"]].rename(columns={"SIMS_LATITUDE": "latitude", "SIMS_LONGITUDE": "longitude"}),
+    ]).dropna()
+    points["census_tract"] = points["census_tract"].astype("int64")
+    return points.groupby("census_tract")[["latitude", "longitude"]].mean().reset_index()
+
+
+def tract_radius_density(df_aq, df_sod, radii_km=DEFAULT_RADII_KM, branches=None):
+    """
+        Count the bank branches within each radius of every census tract centroid (see tract_centroids).
+
+        Args:
+            branches (DataFrame): The branches to count, with SIMS_LATITUDE and SIMS_LONGITUDE, e.g. those of every state
+                when df_aq and df_sod only hold the tracts of one state. Defaults to df_sod.
+
+        Returns:
+            DataFrame: One row per census tract with its centroid and branch counts.
+    """
+    centroids = tract_centroids(df_aq, df_sod)
+    branches = df_sod if branches is None else branches
+    index = BranchIndex(branches["SIMS_LATITUDE"], branches["SIMS_LONGITUDE"])
+    return pd.concat([centroids, index.count_within(centroids["latitude"], centroids["longitude"], radii_km)], axis=1)
@@ -0,0 +1,278 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from Integration.sqlite_store import DEFAULT_BATCH_SIZE, iter_table
+from Pipeline.instrumentation import instrumented
+
+DEFAULT_REPLICATES = 200
+DEFAULT_CONFIDENCE = 0.95
+DEFAULT_SEED = 42
+
+
+class SQLiteSource:
+    """
+        Chunks of a table in the SQLite store. Sources can be iterated more than once and sent to worker processes,
+        which read the chunks themselves instead of receiving the data.
+    """
+
+    def __init__(self, db_name, table, columns, chunksize=DEFAULT_BATCH_SIZE):
+        self.db_name = db_name
+        self.table = table
+        self.columns = list(columns)
+        self.chunksize = chunksize
+
+    def __call__(self):
+        return iter_table(self.db_name, self.table, self.columns, self.chunksize)
+
+
+class CSVSource:
+    """
+        Chunks of the columns of a CSV file (see SQLiteSource).
+    """
+
+    def __init__(self, path, columns, chunksize=DEFAULT_BATCH_SIZE):
+        self.path = path
+        self.columns = list(columns)
+        self.chunksize = chunksize
+
+    def __call__(self):
+        return pd.read_csv(self.path, usecols=self.columns, chunksize=self.chunksize)
+
+
+class FrameSource:
+    """
+        Chunks of the columns of a DataFrame that is already in memory (see SQLiteSource).
+    """
+
+    def __init__(self, df, columns, chunksize=DEFAULT_BATCH_SIZE):
+        self.df = df[list(columns)]
+        self.columns = list(columns)
+        self.chunksize = chunksize
+
+    def __call__(self):
+        return (self.df.iloc[start:start + self.chunksize] for start in range(0, len(self.df), self.chunksize))
+
+
+def chunk_matrices(source):
+    """
+        Yield the chunks of a source as float matrices in the source's column order, with NaN for missing values.
+    """
+    for chunk in source():
+        yield chunk[source.columns].apply(pd.to_numeric, errors="coerce").to_numpy(dtype="float64")
+
+
+class PairwiseMoments:
+    """
+        One-pass accumulator of the pairwise-complete moments of several columns.
+
+        For every pair of columns, the sums are taken over the rows where both values are present, like pandas'
+        DataFrame.corr(). The values are shifted by the first chunk's means to avoid cancellation in the sums, and the
+        sums of chunks simply add up, so chunks can be accumulated in any order and in any number of processes.
+        Rows can be weighted, e.g. by bootstrap resampling counts.
+    """
+
+    def __init__(self, n_columns):
+        self.shift = None
+        self.n = np.zeros((n_columns, n_columns))
+        self.sum = np.zeros((n_columns, n_columns))
+        self.sum_squares = np.zeros((n_columns, n_columns))
+        self.sum_products = np.zeros((n_columns, n_columns))
+
+    def update(self, X, weights=None):
+        """
+            Add a chunk of rows (a float matrix with NaN for missing values) to the sums.
+        """
+        if self.shift is None:
+            self.shift = np.nan_to_num(np.nanmean(X, axis=0)) if len(X) else np.zeros(X.shape[1])
+        present = ~np.isnan(X)
+        centered = np.where(present, X - self.shift, 0.0)
+        mask = present.astype("float64")
+        weighted_mask = mask if weights is None else mask * weights[:, None]
+        weighted = centered if weights is None else centered * weights[:, None]
+
+        # Entry [i, j] of every sum is taken over the rows where both column i and column j are present
+        self.n += weighted_mask.T @ mask
+        self.sum += weighted.T @ mask
+        self.sum_squares += (weighted * centered).T @ mask
+        self.sum_products += weighted.T @ centered
+
+    def correlation(self):
+        """
+            Return the Pearson correlation matrix; NaN where a pair has fewer than two rows or a constant column.
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            covariance = self.sum_products - self.sum * self.sum.T / self.n
+            variance = self.sum_squares - self.sum ** 2 / self.n
+            correlation = covariance / np.sqrt(variance * variance.T)
+        correlation[self.n < 2] = np.nan
+        return np.clip(correlation, -1, 1)
+
+
+class RankMap:
+    """
+        The average ranks of the distinct values of a column, counted in one pass over the chunks.
+        Memory grows with the number of distinct values, not the number of rows; branch counts have few distinct values.
+    """
+
+    def __init__(self):
+        self.values = np.empty(0)
+        self.counts = np.empty(0)
+
+    def add(self, values):
+        chunk_values, chunk_counts = np.unique(values, return_counts=True)
+        merged, inverse = np.unique(np.concatenate([self.values, chunk_values]), return_inverse=True)
+        self.counts = np.bincount(inverse.reshape(-1), weights=np.concatenate([self.counts, chunk_counts]), minlength=len(merged))
+        self.values = merged
+
+    def ranks(self, values):
+        """
+            Return the average rank (1-based, ties sharing the mean of their ranks) of every value.
+        """
+        average_ranks = np.cumsum(self.counts) - (self.counts - 1) / 2
+        return average_ranks[np.searchsorted(self.values, values)]
+
+
+def count_ranks(source, n_columns):
+    """
+        First pass of the Spearman correlation: count the distinct values of every column over the rows where its
+        pair column is present, so that every pair is ranked on its pairwise-complete rows like DataFrame.corr() does.
+    """
+    rank_maps = {(i, j): RankMap() for i in range(n_columns) for j in range(n_columns) if i != j}
+    for X in chunk_matrices(source):
+        present = ~np.isnan(X)
+        for (i, j), rank_map in rank_maps.items():
+            rank_map.add(X[present[:, i] & present[:, j], i])
+    return rank_maps
+
+
+def update_rank_moments(rank_moments, rank_maps, X, weights=None):
+    """
+        Second pass of the Spearman correlation: accumulate the Pearson moments of the ranks of every pair.
+    """
+    present = ~np.isnan(X)
+    for (i, j), moments in rank_moments.items():
+        both = present[:, i] & present[:, j]
+        ranks = np.column_stack([rank_maps[i, j].ranks(X[both, i]), rank_maps[j, i].ranks(X[both, j])])
+        moments.update(ranks, None if weights is None else weights[both])
+
+
+def spearman_matrix(rank_moments, n_columns):
+    correlation = np.eye(n_columns)
+    for (i, j), moments in rank_moments.items():
+        correlation[i, j] = correlation[j, i] = moments.correlation()[0, 1]
+    return correlation
+
+
+@instrumented()
+def correlations(source):
+    """
+        Calculate the Pearson and Spearman correlation matrices of the columns of a chunked source.
+        Pearson takes one pass over the chunks and Spearman one more; only the running sums and the distinct values
+        of every column are kept in memory.
+
+        Returns:
+            tuple: The Pearson and Spearman correlation matrices as DataFrames, and the rank maps of the columns.
+    """
+    n_columns = len(source.columns)
+    rank_maps = count_ranks(source, n_columns)
+
+    pearson = PairwiseMoments(n_columns)
+    rank_moments = {(i, j): PairwiseMoments(2) for i in range(n_columns) for j in range(i + 1, n_columns)}
+    for X in chunk_matrices(source):
+        pearson.update(X)
+        update_rank_moments(rank_moments, rank_maps, X)
+
+    return (pd.DataFrame(pearson.correlation(), index=source.columns, columns=source.columns),
+            pd.DataFrame(spearman_matrix(rank_moments, n_columns), index=source.columns, columns=source.columns),
+            rank_maps)
+
+
+def bootstrap_replicates(source, rank_maps, replicates, seed=DEFAULT_SEED):
+    """
+        Calculate the correlation matrices of bootstrap replicates in one pass over the chunks.
+
+        Uses the Poisson bootstrap: every row appears in every replicate a Poisson(1) number of times, which can be
+        drawn chunk by chunk without knowing the number of rows. The counts are seeded by replicate and chunk, so the
+        replicates are the same however they are split over processes. The Spearman replicates reuse the ranks of the
+        full data instead of re-ranking every resample.
+
+        Returns:
+            tuple: Arrays of shape (replicates, columns, columns) with the Pearson and Spearman correlations.
+    """
+    n_columns = len(source.columns)
+    pearson = {replicate: PairwiseMoments(n_columns) for replicate in replicates}
+    rank_moments = {replicate: {(i, j): PairwiseMoments(2) for i in range(n_columns) for j in range(i + 1, n_columns)}
+                    for replicate in replicates}
+
+    for chunk_number, X in enumerate(chunk_matrices(source)):
+        for replicate in replicates:
+            weights = np.random.default_rng([seed, replicate, chunk_number]).poisson(1.0, len(X)).astype("float64")
+            pearson[replicate].update(X, weights)
+            update_rank_moments(rank_moments[replicate], rank_maps, X, weights)
+
+    return (np.array([pearson[replicate].correlation() for replicate in replicates]),
+            np.array([spearman_matrix(rank_moments[replicate], n_columns) for replicate in replicates]))
+
+
+@instrumented()
+def bootstrap_intervals(source, rank_maps, replicates=DEFAULT_REPLICATES, confidence=DEFAULT_CONFIDENCE,
+                        workers=None, seed=DEFAULT_SEED):
+    """
+        Calculate percentile bootstrap confidence intervals of the correlations, splitting the replicates over
+        worker processes that each stream the source.
+
+        Returns:
+            dict: The (lower, upper) bound matrices of the "pearson" and "spearman" correlations.
+    """
+    workers = workers or os.cpu_count() or 1
+    blocks = [list(block) for block in np.array_split(np.arange(replicates), min(workers, replicates)) if len(block)]
+    with ProcessPoolExecutor(max_workers=len(blocks)) as executor:
+        results = list(executor.map(bootstrap_replicates, [source] * len(blocks), [rank_maps] * len(blocks), blocks, [seed] * len(blocks)))
+
+    alpha = (1 - confidence) / 2
+    intervals = {}
+    for method, samples in zip(("pearson", "spearman"), (np.concatenate(result) for result in zip(*results))):
+        lower, upper = np.nanquantile(samples, [alpha, 1 - alpha], axis=0)
+        intervals[method] = (pd.DataFrame(lower, index=source.columns, columns=source.columns),
+                             pd.DataFrame(upper, index=source.columns, columns=source.columns))
+    return intervals
+
+
+def correlation_summary(pearson, spearman, intervals):
+    """
+        Flatten the correlation matrices and their confidence intervals to one row per method and pair of columns.
+    """
+    rows = []
+    columns = list(pearson.columns)
+    for method, matrix in (("pearson", pearson), ("spearman", spearman)):
+        lower, upper = intervals[method] if intervals else (None, None)
+        for i, x in enumerate(columns):
+            for y in columns[i + 1:]:
+                rows.append({
+                    "method": method,
+                    "x": x,
+                    "y": y,
+                    "correlation": matrix.loc[x, y],
+                    "ci_lower": lower.loc[x, y] if lower is not None else np.nan,
+                    "ci_upper": upper.loc[x, y] if upper is not None else np.nan,
+                })
+    return pd.DataFrame(rows)
+
+
+def save_heatmap(correlation, output_file, title="Correlation Matrix"):
+    """
+        Render a correlation heatmap straight to a file with the non-interactive Agg backend, so it works headless.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import seaborn as sns
+
+    figure = Figure(figsize=(10, 8))
+    FigureCanvasAgg(figure)
+    axes = figure.subplots()
+    sns.heatmap(correlation, annot=True, cmap='coolwarm', fmt=".2f", ax=axes)
+    axes.set_title(title)
+    figure.savefig(output_file)
@@ -1,34 +1,207 @@
 import pandas as pd
 import os
 import sys
+import io
+import argparse
+import glob
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 
-def main():
+# Add the repository root to the path so that the shared modules can be imported when run as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Integration.pm25_aggregates import (
+    AGGREGATES_DIR, AGGREGATE_KEYS, MEANS_STEM, available_years, combine_aggregates, create_store, empty_aggregates,
+    fold_aggregates, is_ingested, tract_means
+)
+from Integration.pm25_daily_store import DAILY_DIR, begin_staging, commit_staging, stage_rows
+from Integration.pm25_daily_store import create_store as create_daily_store, is_ingested as is_stored
+from Integration.schema import DAILY_PM25_DTYPES
+from Integration.sinks import FORMATS, write_output
+from Pipeline.instrumentation import instrumented, stage, step
+
+# Only these columns of the daily PM2.5 file are needed to compute the tract means
+AQI_COLUMNS = ["year", "ctfips", "DS_PM_pred"]
+
+# The daily store (see pm25_daily_store) keeps the date of every row as well
+DAILY_COLUMNS = AQI_COLUMNS + ["date"]
+
+# New daily PM2.5 drops follow the naming of the original 2016-2020 file
+DAILY_FILES_PATTERN = "Daily_Census_Tract-Level_PM2.5_Concentrations__*.csv"
+
+# Size of the byte block handed to each worker, roughly 1-2 million rows of the daily file
+DEFAULT_BLOCK_SIZE = 64 * 1024 * 1024
+
+
+def read_header(csv_file):
+    """
+        Read the header line of a CSV file and return the column names and the offset of the first data row.
+    """
+    with open(csv_file, "rb") as file:
+        header = file.readline()
+        return header.decode("utf-8").strip().split(","), file.tell()
+
+
+def byte_ranges(csv_file, block_size=DEFAULT_BLOCK_SIZE):
+    """
+        Split a CSV file into (start, end) byte ranges of roughly block_size bytes.
+        Every range starts at the beginning of a line and ends right after a newline (or at the end of the file),
+        so each range can be parsed on its own without splitting a row.
+    """
+    _, offset = read_header(csv_file)
+    file_size = os.path.getsize(csv_file)
+
+    with open(csv_file, "rb") as file:
+        while offset < file_size:
+            file.seek(min(offset + block_size, file_size))
+            file.readline()
+            end = min(file.tell(), file_size)
+            yield offset, end
+            offset = end
+
+
+def read_block(csv_file, start, end, columns, usecols=AQI_COLUMNS):
+    """
+        Parse the rows between two byte offsets of the daily PM2.5 file, keeping only the AQI_COLUMNS (or the given columns).
+        A date column is parsed to datetime64.
+    """
+    with open(csv_file, "rb") as file:
+        file.seek(start)
+        block = file.read(end - start)
+
+    rows = pd.read_csv(io.BytesIO(block), header=None, names=columns, usecols=usecols, dtype=DAILY_PM25_DTYPES)
+    if "date" in rows.columns:
+        rows["date"] = pd.to_datetime(rows["date"], format="%Y-%m-%d")
+    return rows
+
+
+def aggregate_block(csv_file, start, end, columns, years=None, staging_dir=None):
+    """
+        Compute the per-tract, per-year sum, count, minimum and maximum of the PM2.5 concentration for one byte range of the daily file.
+        Rows outside the requested years are dropped before grouping so that the partial result stays small.
+        With a staging directory, all rows of the range are also staged for the daily store (see pm25_daily_store.stage_rows).
+    """
+    block = read_block(csv_file, start, end, columns, DAILY_COLUMNS if staging_dir else AQI_COLUMNS)
+    if staging_dir:
+        stage_rows(block, staging_dir, f"{start:016d}")
+    if years is not None:
+        block = block[block["year"].isin(years)]
+    return block.groupby(AGGREGATE_KEYS)["DS_PM_pred"].agg(["sum", "count", "min", "max"])
+
+
+@instrumented()
+def stream_tract_aggregates(csv_file, years=None, block_size=DEFAULT_BLOCK_SIZE, workers=None, staging_dir=None):
+    """
+        Calculate the per-tract, per-year PM2.5 aggregates of a daily file without loading the whole file.
+
+        The file is split into byte ranges that are parsed and aggregated in parallel worker processes.
+        Only a bounded number of ranges is in flight at any time, and the running aggregates are the
+        only state kept in the parent, so peak memory does not grow with the size of the file.
+
+        Args:
+            csv_file (str): The daily census tract-level PM2.5 CSV file.
+            years (list): The years to aggregate. Defaults to every year in the file.
+            block_size (int): The approximate number of bytes parsed by a worker at once.
+            workers (int): The number of worker processes. Defaults to the number of CPUs.
+            staging_dir (str): The staging directory of the daily store the workers also write the parsed rows to
+                (see pm25_daily_store.begin_staging), so the file is only parsed once. Defaults to not staging them.
+
+        Returns:
+            DataFrame: The sum, count, min and max columns indexed by (ctfips, year).
+    """
+    columns, _ = read_header(csv_file)
+    workers = workers or os.cpu_count() or 1
+    totals = empty_aggregates()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for start, end in byte_ranges(csv_file, block_size):
+            # Keep at most two blocks per worker in flight to bound memory
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                totals = combine_aggregates(totals, *[future.result() for future in done])
+            pending.add(executor.submit(aggregate_block, csv_file, start, end, columns, years, staging_dir))
+
+        totals = combine_aggregates(totals, *[future.result() for future in pending])
+
+    return totals.sort_index()
+
+
+def stream_tract_means(csv_file, year=2020, block_size=DEFAULT_BLOCK_SIZE, workers=None):
+    """
+        Calculate the mean PM2.5 concentration for each census tract in the given year directly from a daily file.
+
+        Returns:
+            DataFrame: The census_tract and mean_pm25_concentration columns, sorted by census tract.
+    """
+    totals = stream_tract_aggregates(csv_file, [year], block_size, workers).groupby(level="ctfips").sum()
+    means = (totals["sum"] / totals["count"]).reset_index(name='mean_pm25_concentration')
+    means.columns = ['census_tract', 'mean_pm25_concentration']
+    return means
+
+
+@stage("aqi_clean")
+def main(daily_files=None, export_years=None, format=None, daily_store=True):
     """
         There was an issue with provided case study dataset
         (There were mulitple missing values in the 'census_tract' column in the AirQuality sheet that were present in the SOD & NCUA sheet).
-        Therefore, we decided to calculate the mean PM2.5 concentration for each census tract in 2020 using the AQI data.
-        This function reads the AQI data and calculates the mean PM2.5 concentration for each census tract in 2020.
-        The function then saves the results to an Excel file.
+        Therefore, we decided to calculate the mean PM2.5 concentration for each census tract using the AQI data.
+        This function streams each new daily AQI file and folds its per-tract, per-year aggregates into the PM2.5 aggregate store,
+        from which the means for any range of years are calculated without rereading the daily files.
+        The daily rows are merged into the daily PM2.5 store in the same pass, for the date range, rolling window and
+        exceedance queries of pm25_daily_store.
+        Optionally, the means for a range of years are also exported to an output file.
+
+        Args:
+            daily_files (list): The daily PM2.5 files to fold into the store. Defaults to every file matching DAILY_FILES_PATTERN.
+                Files whose content was already folded are skipped; a changed file of a folded name replaces its aggregates.
+            export_years (tuple): The (first, last) years of the means to export.
+            format (str): The format of the exported means (see sinks.output_format), e.g. "excel" for a workbook.
+            daily_store (bool): Whether to merge the daily rows into the daily PM2.5 store as well.
     """
-    
+
     # Add the data directory to the path so that we can import the data files directly
     current_dir = os.path.dirname(os.path.abspath(__file__))
     parent_dir = os.path.dirname(current_dir)
     data_dir = os.path.join(parent_dir, "data/")
     sys.path.append(data_dir)
-    
-    AQI_df = pd.read_csv("Daily_Census_Tract-Level_PM2.5_Concentrations__2016_-_2020.csv") 
-    
-    # Filter the data for 2020 and calculate the mean PM2.5 concentration for each census tract
-    AQI_2020 = AQI_df[AQI_df['year'] == 2020]
-    AQI_2020_means = AQI_2020.groupby('ctfips')['DS_PM_pred'].mean().reset_index(name='mean_pm25_concentration')
-    
-    AQI_2020_means.rename(columns={'ctfips': 'census_tract'}, inplace=True)
-    
-    output_file = 'AQI_2020_means.xlsx'
-    AQI_2020_means.to_excel(output_file, index=False)  
-    
-    print("Mean PM2.5 concentration data for 2020 saved to", output_file)
+
+    daily_files = daily_files or sorted(glob.glob(DAILY_FILES_PATTERN))
+
+    # The daily files are several GB, so they are aggregated chunk by chunk and only once
+    for daily_file in daily_files:
+        fold = not is_ingested(daily_file, AGGREGATES_DIR)
+        store = daily_store and not is_stored(daily_file, DAILY_DIR)
+        if not fold and not store:
+            print(daily_file, "was already folded into", AGGREGATES_DIR)
+            continue
+
+        staging_dir = begin_staging(DAILY_DIR) if store else None
+        aggregates = stream_tract_aggregates(daily_file, staging_dir=staging_dir)
+        if fold:
+            fold_aggregates(aggregates, daily_file, AGGREGATES_DIR)
+            print(daily_file, "folded into", AGGREGATES_DIR)
+        if store:
+            commit_staging(staging_dir, daily_file, DAILY_DIR)
+            print(daily_file, "merged into", DAILY_DIR)
+
+    create_store(AGGREGATES_DIR)
+    if daily_store:
+        create_daily_store(DAILY_DIR)
+    print("PM2.5 aggregates available for", available_years(AGGREGATES_DIR))
+
+    if export_years:
+        first_year, last_year = export_years
+        means = tract_means(first_year, last_year, store_dir=AGGREGATES_DIR)
+        suffix = str(first_year) if first_year == last_year else f"{first_year}_{last_year}"
+        with step("write_output", rows_in=len(means)):
+            output_file = write_output({"AQI_means": means}, MEANS_STEM.format(suffix), format)
+        print(f"Mean PM2.5 concentration data for {suffix} saved to", output_file)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Fold daily PM2.5 files into the per-tract, per-year aggregate store.")
+    parser.add_argument("daily_files", nargs="*", help="Daily census tract-level PM2.5 CSV files")
+    parser.add_argument("--export", nargs=2, type=int, metavar=("FIRST_YEAR", "LAST_YEAR"), help="Export the tract means for a range of years")
+    parser.add_argument("--output-format", choices=list(FORMATS), help="Format of the exported means (defaults to the PIPELINE_OUTPUT_FORMAT variable or arrow)")
+    parser.add_argument("--no-daily-store", action="store_true", help="Only fold the files into the aggregate store, not into the daily PM2.5 store")
+    args = parser.parse_args()
+    main(args.daily_files, args.export, args.output_format, not args.no_daily_store)
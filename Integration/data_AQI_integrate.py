@@ -1,14 +1,85 @@
 import pandas as pd
 import os
 import sys
+import argparse
 
-def main():
+# Add the repository root to the path so that the shared modules can be imported when run as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Integration.workbook_cache import read_sheet
+from Integration.partitioning import combine, partition, partition_workers, run_partitions
+from Integration.pm25_aggregates import PM25_YEAR, tract_means
+from Integration.schema import report_footprint
+from Integration.sinks import ARTIFACT_FORMATS, write_output
+from Integration.sqlite_store import connect, bulk_load
+from Pipeline.instrumentation import stage, step
+
+# The SOD and NCUA columns of the integrated data
+COLUMNS_SOD = [
+    "CERT", "NAMEFULL", "ADDRESBR", "BRNUM", "ASSET", "DEPDOM",
+    "DEPSUM", "STNAME", "CITYBR", "CNTYNAMB", "DEPSUMBR",
+    "SIMS_LATITUDE", "SIMS_LONGITUDE", "geometry", "census_tract", "mean_pm25_concentration"
+]
+
+COLUMNS_NCUA = [
+    "JOIN_NUMBER", "SiteId", "CU_NAME", "PhysicalAddressCity",
+    "PhysicalAddressStateCode", "ATM", "DriveThru", "census tract", "mean_pm25_concentration"
+]
+
+
+def merge_pm25(sod_data, ncua_data, aqi_means):
+    """
+        Add the mean PM2.5 concentration of their census tract to the SOD and NCUA rows, keeping the rows with a census tract.
+
+        Returns:
+            tuple: The SOD and NCUA rows, indexed like the input rows.
+    """
+    # Merge SOD with PM2.5 data
+    with step("merge_sod", rows_in=len(sod_data)) as record:
+        sod_df = pd.merge(sod_data, aqi_means, on="census_tract", how="left", validate="many_to_one").set_axis(sod_data.index)[COLUMNS_SOD]
+
+        sod_df = sod_df.dropna(subset=["census_tract"])
+        record.rows_out = len(sod_df)
+
+    # Merge NCUA with PM2.5 data
+    with step("merge_ncua", rows_in=len(ncua_data)) as record:
+        ncua_df = pd.merge(ncua_data.rename(columns={"census tract": "census_tract"}), aqi_means, on="census_tract", how="left", validate="many_to_one")
+        ncua_df = ncua_df.set_axis(ncua_data.index).rename(columns={"census_tract": "census tract"})[COLUMNS_NCUA]
+
+        ncua_df = ncua_df.dropna(subset=["census tract"])
+        ncua_df.rename(columns={"census tract": "census_tract"}, inplace=True)
+        record.rows_out = len(ncua_df)
+
+    return sod_df, ncua_df
+
+
+def merge_pm25_by_state(sod_data, ncua_data, aqi_means, workers):
+    """
+        Run merge_pm25 separately for the census tracts of every state in a process pool, with the tract means sharded
+        like the rows, and combine the partitions into the rows of a single-process run in the same order.
+    """
+    partials = run_partitions(merge_pm25, partition([sod_data, ncua_data, aqi_means], ["census_tract", "census tract", "census_tract"]), workers)
+    sod_df = combine([sod_df for sod_df, _ in partials.values()], ordered=True)
+    ncua_df = combine([ncua_df for _, ncua_df in partials.values()], ordered=True)
+    return sod_df, ncua_df
+
+
+@stage("aqi_integrate")
+def main(workers=None, format=None, year=PM25_YEAR):
     """
         This function integrates the data from the case study with the PM2.5 data.
         The data from the case study is in the file "20241125 Case Study for Position SE_Data (1).xlsx".
-        The PM2.5 data is in the file "AQI_2020_means.xlsx".
-        The integrated data is saved in the file "Integrated_with_PM25.xlsx".
+        The PM2.5 data are the tract means of a year calculated from the PM2.5 aggregate store (see pm25_aggregates.tract_means).
+        The integrated data is saved in the output "Integrated_with_PM25" (e.g. "Integrated_with_PM25.arrow") and the Integrated_With_PM25 table of "integrated_with_pm25.db".
+
+        Args:
+            workers (int): The number of worker processes to partition the integration by state over, so every state is
+                integrated in parallel. 0 integrates in this process. Defaults to the PIPELINE_PARTITION_WORKERS variable.
+            format (str): The format of the output file (see sinks.output_format). Defaults to the PIPELINE_OUTPUT_FORMAT variable,
+                or else the columnar Arrow format.
+            year (int): The year of the PM2.5 tract means.
     """
+    workers = partition_workers(workers)
     
     # Add the data directory to the path so that we can import the data files directly
     current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -16,38 +87,14 @@ def main():
     data_dir = os.path.join(parent_dir, "data/")
     sys.path.append(data_dir)
     
-    case_study_file = "20241125 Case Study for Position SE_Data (1).xlsx"
-    aqi_means_file = "AQI_2020_means.xlsx"
-    output_file = "Integrated_with_PM25.xlsx"
-    
-    sod_data = pd.read_excel(case_study_file, sheet_name="SOD_IL_2024")
-    ncua_data = pd.read_excel(case_study_file, sheet_name="NCUA_IL_Q2_2024")
-    aqi_means = pd.read_excel(aqi_means_file)
-    
-    # Define SOD columns
-    columns_sod = [
-        "CERT", "NAMEFULL", "ADDRESBR", "BRNUM", "ASSET", "DEPDOM",
-        "DEPSUM", "STNAME", "CITYBR", "CNTYNAMB", "DEPSUMBR",
-        "SIMS_LATITUDE", "SIMS_LONGITUDE", "geometry", "census_tract", "mean_pm25_concentration"
-    ]
-
-    # Merge SOD with PM2.5 data
-    sod_data = pd.merge(sod_data, aqi_means, on="census_tract", how="left")
-    sod_df = sod_data[columns_sod]
-    
-    sod_df = sod_df.dropna(subset=["census_tract"])
-    
-    columns_ncua = [
-        "JOIN_NUMBER", "SiteId", "CU_NAME", "PhysicalAddressCity",
-        "PhysicalAddressStateCode", "ATM", "DriveThru", "census tract", "mean_pm25_concentration"
-    ]
+    sod_data = read_sheet("SOD_IL_2024")
+    ncua_data = read_sheet("NCUA_IL_Q2_2024")
+    aqi_means = tract_means(year)
 
-    # Merge NCUA with PM2.5 data
-    ncua_data = pd.merge(ncua_data.rename(columns={"census tract": "census_tract"}), aqi_means, on="census_tract", how="left")
-    ncua_df = ncua_data.rename(columns={"census_tract": "census tract"})[columns_ncua]
-    
-    ncua_df = ncua_df.dropna(subset=["census tract"])
-    ncua_df.rename(columns={"census tract": "census_tract"}, inplace=True)
+    if workers:
+        sod_df, ncua_df = merge_pm25_by_state(sod_data, ncua_data, aqi_means, workers)
+    else:
+        sod_df, ncua_df = merge_pm25(sod_data, ncua_data, aqi_means)
     
     integrated_data = pd.concat([sod_df, ncua_df], ignore_index=True)
     
@@ -55,9 +102,22 @@ def main():
     columns_order = ['census_tract'] + [col for col in integrated_data.columns if col not in ['census_tract', 'mean_pm25_concentration']] + ['mean_pm25_concentration']
     integrated_data = integrated_data[columns_order]
     
-    integrated_data.to_excel(output_file, index=False)
-    
+    with step("write_output", rows_in=len(integrated_data)):
+        output_file = write_output({"Integrated_With_PM25": integrated_data}, "Integrated_with_PM25", format)
+
+    db_name = "integrated_with_pm25.db"
+    conn = connect(db_name)
+    bulk_load(conn, "Integrated_With_PM25", integrated_data)
+    conn.close()
+
     print("AQI Integrated data saved to", output_file)
+    print("AQI Integrated data saved to", db_name)
+    report_footprint()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Integrate the SOD and NCUA sheets with the PM2.5 tract means of a year.")
+    parser.add_argument("--partition-workers", type=int, help="Integrate every state in parallel over this many worker processes (0 for a single process)")
+    parser.add_argument("--output-format", choices=ARTIFACT_FORMATS, help="Format of the output files (defaults to the PIPELINE_OUTPUT_FORMAT variable or arrow)")
+    parser.add_argument("--year", type=int, default=PM25_YEAR, help=f"Year of the PM2.5 tract means (default: {PM25_YEAR})")
+    args = parser.parse_args()
+    main(args.partition_workers, args.output_format, args.year)
\ No newline at end of file
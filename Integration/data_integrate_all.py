@@ -1,57 +1,80 @@
-import pandas as pd
-import sqlite3
 import os
 import sys
+import argparse
 
-def main():
+# Add the repository root to the path so that the shared modules can be imported when run as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Integration.workbook_cache import read_sheet
+from Integration.delta_ingestion import incremental_ingestion
+from Integration.partitioning import partition_workers
+from Integration.schema import report_footprint
+from Integration.sinks import ARTIFACT_FORMATS
+from Integration.tract_integration import INTEGRATION_MODES, integrate_sources
+from Pipeline.instrumentation import instrumented, stage
+
+INTEGRATED_TABLE = "Integrated_Data"
+
+
+@instrumented()
+def integrate_merged(df_aq, df_sod, df_ncua):
+    """
+        Left-merge every AirQuality row with every SOD row and every NCUA row of the same census tract.
+        The sources are expected to carry the source suffixes (see suffix_sources).
+    """
+    return df_aq.merge(df_sod, left_on='census_tract_AQ', right_on='census_tract_SOD', how='left')\
+                .merge(df_ncua, left_on='census_tract_AQ', right_on='census_tract_NCUA', how='left')
+
+
+@stage("integrate_all")
+def main(mode="merged", compare=False, workers=None, format=None, incremental=None):
     """
-        This function reads the different sheets from the Case Study for Position SE_Data (1).xlsx file and 
+        This function reads the different sheets from the Case Study for Position SE_Data (1).xlsx file and
         creates a new database with the Integrated_Data table.
-        The function also saves the integrated data to an Excel file for backup purposes.    
+        The function also saves the integrated data to the integrated_all_data output (e.g. integrated_all_data.arrow) for backup purposes.
+
+        Args:
+            mode (str): "merged" stores the merged rows of the three sources, "normalized" stores each source once
+                with a tract key table and exposes Integrated_Data as a view, and "aggregate" stores one row per tract.
+            compare (bool): Whether to report the row count and peak memory of every mode.
+            workers (int): The number of worker processes to partition the integration by state over, so every state is
+                integrated in parallel. 0 integrates in this process. Defaults to the PIPELINE_PARTITION_WORKERS variable.
+            format (str): The format of the output file (see sinks.output_format). Defaults to the PIPELINE_OUTPUT_FORMAT variable,
+                or else the columnar Arrow format.
+            incremental (bool): Whether to ingest the SOD and NCUA sheets incrementally: only the census tracts whose
+                rows changed since the previous incremental run are integrated again and replaced in the database
+                (see delta_ingestion.plan_ingestion). Defaults to the PIPELINE_INCREMENTAL variable.
     """
-    
+    workers = partition_workers(workers)
+    incremental = incremental_ingestion(incremental)
+
     # Add the data directory to the path so that we can import the data files directly
     current_dir = os.path.dirname(os.path.abspath(__file__))
     parent_dir = os.path.dirname(current_dir)
     data_dir = os.path.join(parent_dir, "data/")
     sys.path.append(data_dir)
-    
-    file_path = "20241125 Case Study for Position SE_Data (1).xlsx"
-    xls = pd.ExcelFile(file_path)
-
-    sheet_names = xls.sheet_names
 
     db_name = 'integrated_all_data.db'
-    conn = sqlite3.connect(db_name)
-
-    # Read the different sheets from the Excel file
-    df_aq = pd.read_excel(xls, sheet_name="AirQuality_EPA_IL")
-    df_sod = pd.read_excel(xls, sheet_name="SOD_IL_2024")
-    df_ncua = pd.read_excel(xls, sheet_name="NCUA_IL_Q2_2024")
-
-    # Rename columns to match the database schema and avoid SQL syntax errors
-    df_ncua.rename(columns={"census tract": "census_tract"}, inplace=True)
-
-
-    # Add suffixes to the columns to avoid column name conflicts
-    df_aq = df_aq.add_suffix('_AQ')
-    df_sod = df_sod.add_suffix('_SOD')
-    df_ncua = df_ncua.add_suffix('_NCUA')
 
-    # Merge the dataframes
-    integrated_data = df_aq.merge(df_sod, left_on='census_tract_AQ', right_on='census_tract_SOD', how='left')\
-                        .merge(df_ncua, left_on='census_tract_AQ', right_on='census_tract_NCUA', how='left')
-                            
-    integrated_data.to_sql("Integrated_Data", conn, if_exists="replace", index=False)
-    print(integrated_data.head())
+    # Read the different sheets from the cached Excel file
+    df_aq = read_sheet("AirQuality_EPA_IL")
+    df_sod = read_sheet("SOD_IL_2024")
+    df_ncua = read_sheet("NCUA_IL_Q2_2024")
 
-    integrated_data.to_excel("integrated_all_data.xlsx", index=False)
+    output_file = integrate_sources(db_name, INTEGRATED_TABLE, integrate_merged, "integrated_all_data", __file__, df_aq, df_sod, df_ncua,
+                                    mode, compare, workers, format, incremental)
 
-    conn.close()    
-    
     print("All Integrated data saved to", db_name)
-    print("All Integrated data saved to integrated_all_data.xlsx")
+    print("All Integrated data saved to", output_file)
+    report_footprint()
 
 
 if __name__ == "__main__":
-    main()                   
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Integrate the AirQuality, SOD and NCUA sheets.")
+    parser.add_argument("--mode", choices=INTEGRATION_MODES, default="merged", help="How the sources are integrated")
+    parser.add_argument("--compare", action="store_true", help="Report the row count and peak memory of every mode")
+    parser.add_argument("--partition-workers", type=int, help="Integrate every state in parallel over this many worker processes (0 for a single process)")
+    parser.add_argument("--output-format", choices=ARTIFACT_FORMATS, help="Format of the output files (defaults to the PIPELINE_OUTPUT_FORMAT variable or arrow)")
+    parser.add_argument("--incremental", action="store_true", default=None, help="Only integrate the census tracts whose SOD or NCUA rows changed since the previous incremental run")
+    args = parser.parse_args()
+    main(args.mode, args.compare, args.partition_workers, args.output_format, args.incremental)
@@ -1,12 +1,65 @@
-import pandas as pd
-import sqlite3
 import os
 import sys
+import argparse
 
-def main():
+# Add the repository root to the path so that the shared modules can be imported when run as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Integration.workbook_cache import read_sheet
+from Integration.delta_ingestion import incremental_ingestion
+from Integration.partitioning import partition_workers
+from Integration.schema import report_footprint
+from Integration.sinks import ARTIFACT_FORMATS
+from Integration.tract_integration import INTEGRATION_MODES, integrate_sources
+from Pipeline.instrumentation import instrumented, stage
+
+INTEGRATED_TABLE = "Integrated_Filtered_Data"
+
+
+@instrumented()
+def integrate_merged(df_aq, df_sod, df_ncua):
+    """
+        Merge the AirQuality, SOD and NCUA rows of the same census tract, drop the duplicate rows
+        and keep only the rows with a bank or credit union branch.
+        The sources are expected to carry the source suffixes (see suffix_sources).
+    """
+    integrated_filtered_data = df_aq.merge(df_sod, left_on='census_tract_AQ', right_on='census_tract_SOD', how='left')\
+                        .merge(df_ncua, left_on='census_tract_AQ', right_on='census_tract_NCUA', how='left')
+
+    # Rename the columns to remove the suffixes for census_tract and reordering the columns
+    integrated_filtered_data.rename(columns={"census_tract_AQ": "census_tract"}, inplace=True)
+    columns_order = ['census_tract'] + [col for col in integrated_filtered_data.columns if col != 'census_tract']
+    integrated_filtered_data = integrated_filtered_data[columns_order]
+
+    integrated_filtered_data.drop(columns=['census_tract_SOD', 'census_tract_NCUA'], inplace=True)
+    integrated_filtered_data.drop_duplicates(inplace=True)
+
+    # Drop rows with missing values in the SOD and NCUA columns
+    sod_columns = [col for col in integrated_filtered_data.columns if '_SOD' in col]
+    ncua_columns = [col for col in integrated_filtered_data.columns if '_NCUA' in col]
+
+    return integrated_filtered_data[integrated_filtered_data[sod_columns + ncua_columns].notna().any(axis=1)]
+
+
+@stage("integrate_filtered")
+def main(mode="merged", compare=False, workers=None, format=None, incremental=None):
     """
-    This function reads the integrated_data.xlsx file and creates a new database with the integrated_filtered_data table.
+    This function reads the case study sheets and creates a new database with the integrated_filtered_data table.
+
+    Args:
+        mode (str): "merged" stores the merged rows of the three sources, "normalized" stores each source once
+            with a tract key table and exposes Integrated_Filtered_Data as a view, and "aggregate" stores one row per tract.
+        compare (bool): Whether to report the row count and peak memory of every mode.
+        workers (int): The number of worker processes to partition the integration by state over, so every state is
+            integrated in parallel. 0 integrates in this process. Defaults to the PIPELINE_PARTITION_WORKERS variable.
+        format (str): The format of the integrated_filtered_data output (see sinks.output_format). Defaults to the
+            PIPELINE_OUTPUT_FORMAT variable, or else the columnar Arrow format.
+        incremental (bool): Whether to ingest the SOD and NCUA sheets incrementally: only the census tracts whose rows
+            changed since the previous incremental run are integrated again and replaced in the database
+            (see delta_ingestion.plan_ingestion). Defaults to the PIPELINE_INCREMENTAL variable.
     """
+    workers = partition_workers(workers)
+    incremental = incremental_ingestion(incremental)
     
     # Add the data directory to the path so that we can import the data files directly
     current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -14,12 +67,7 @@ def main():
     data_dir = os.path.join(parent_dir, "data/")
     sys.path.append(data_dir)
     
-    file_path = "integrated_data.xlsx"
-    xls = pd.ExcelFile(file_path)
-
-    # Create a new database 
     db_name = 'integrated_filtered_data.db'
-    conn = sqlite3.connect(db_name)
 
     # Columns under consideration for the ML model and NLP Interface
     columns_aq = [
@@ -39,45 +87,24 @@ def main():
         "PhysicalAddressStateCode", "ATM", "DriveThru", "census tract"
     ]
 
-    df_aq = pd.read_excel(xls, sheet_name="AirQuality_EPA_IL", usecols=columns_aq)
-    df_sod = pd.read_excel(xls, sheet_name="SOD_IL_2024", usecols=columns_sod)
-    df_ncua = pd.read_excel(xls, sheet_name="NCUA_IL_Q2_2024", usecols=columns_ncua)
-    
-    # rename columns to prevent SQL syntax errors
-    df_ncua.rename(columns={"census tract": "census_tract"}, inplace=True)
-
-    # Merge the dataframes on the census_tract column and create a new table 
-    df_aq = df_aq.add_suffix('_AQ')
-    df_sod = df_sod.add_suffix('_SOD')
-    df_ncua = df_ncua.add_suffix('_NCUA')
+    df_aq = read_sheet("AirQuality_EPA_IL", columns=columns_aq)
+    df_sod = read_sheet("SOD_IL_2024", columns=columns_sod)
+    df_ncua = read_sheet("NCUA_IL_Q2_2024", columns=columns_ncua)
 
-    integrated_filtered_data = df_aq.merge(df_sod, left_on='census_tract_AQ', right_on='census_tract_SOD', how='left')\
-                        .merge(df_ncua, left_on='census_tract_AQ', right_on='census_tract_NCUA', how='left')
-    
-    # Rename the columns to remove the suffixes for census_tract and reordering the columns                    
-    integrated_filtered_data.rename(columns={"census_tract_AQ": "census_tract"}, inplace=True)
-    columns_order = ['census_tract'] + [col for col in integrated_filtered_data.columns if col != 'census_tract']
-    integrated_filtered_data = integrated_filtered_data[columns_order]
+    output_file = integrate_sources(db_name, INTEGRATED_TABLE, integrate_merged, "integrated_filtered_data", __file__, df_aq, df_sod, df_ncua,
+                                    mode, compare, workers, format, incremental, filtered=True)
 
-    integrated_filtered_data.drop(columns=['census_tract_SOD', 'census_tract_NCUA'], inplace=True)
-    integrated_filtered_data.drop_duplicates(inplace=True)
-
-    # Drop rows with missing values in the SOD and NCUA columns
-    sod_columns = [col for col in integrated_filtered_data.columns if '_SOD' in col]
-    ncua_columns = [col for col in integrated_filtered_data.columns if '_NCUA' in col]
-
-    integrated_filtered_data = integrated_filtered_data[integrated_filtered_data[sod_columns + ncua_columns].notna().any(axis=1)]
-
-    # Save the integrated_filtered_data table to the database and an excel file                        
-    integrated_filtered_data.to_sql("Integrated_Filtered_Data", conn, if_exists="replace", index=False)
-    integrated_filtered_data.to_excel("integrated_filtered_data.xlsx", index=False)
-    print(integrated_filtered_data.head())
-
-    conn.close()              
-    
     print("Integrated filtered data saved to", db_name)
-    print("Integrated filtered data saved to integrated_filtered_data.xlsx")         
+    print("Integrated filtered data saved to", output_file)
+    report_footprint()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Integrate the columns of the AirQuality, SOD and NCUA sheets used by the ML model and NLP interface.")
+    parser.add_argument("--mode", choices=INTEGRATION_MODES, default="merged", help="How the sources are integrated")
+    parser.add_argument("--compare", action="store_true", help="Report the row count and peak memory of every mode")
+    parser.add_argument("--partition-workers", type=int, help="Integrate every state in parallel over this many worker processes (0 for a single process)")
+    parser.add_argument("--output-format", choices=ARTIFACT_FORMATS, help="Format of the output files (defaults to the PIPELINE_OUTPUT_FORMAT variable or arrow)")
+    parser.add_argument("--incremental", action="store_true", default=None, help="Only integrate the census tracts whose SOD or NCUA rows changed since the previous incremental run")
+    args = parser.parse_args()
+    main(args.mode, args.compare, args.partition_workers, args.output_format, args.incremental)
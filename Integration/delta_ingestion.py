@@ -0,0 +1,345 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass
+
+from Integration.schema import plain
+from Integration.sqlite_store import KEY_COLUMNS, bulk_load, create_indexes, delete_rows, drop_relation, insert_rows
+from Integration.workbook_cache import file_hash
+from Pipeline.instrumentation import instrumented
+
+# Whether the integration stages ingest the SOD and NCUA snapshots incrementally; unset or 0 rebuilds every table.
+# The pipeline runner passes it to its stages through the environment (see run_pipeline --incremental).
+INCREMENTAL_ENV = "PIPELINE_INCREMENTAL"
+
+# The natural key of every source snapshot and its census tract column.
+# Neither key is unique in the case study data: SOD lists some branches both with and without their census tract,
+# and NCUA site ids are only unique per credit union. A key therefore stands for the group of rows with that key.
+SOURCES = {
+    "SOD": (["CERT", "BRNUM"], "census_tract"),
+    "NCUA": (["SiteId"], "census tract"),
+}
+
+# The tables the ingestion keeps next to the integrated tables
+SNAPSHOT_SUFFIX = "_Snapshot"
+STATE_TABLE = "Ingestion_State"
+DIRTY_TRACTS_TABLE = "Dirty_Tracts"
+TRACT_BRANCH_COUNTS_TABLE = "Tract_Branch_Counts"
+
+ROW_HASH_COLUMN = "_row_hash"
+
+# The code the integrated rows depend on besides the stage script; a change to it rebuilds the tables
+INTEGRATION_CODE = ["tract_integration.py", "schema.py", "delta_ingestion.py"]
+
+# The number of census tracts per refresh statement, well below SQLite's limit of bound parameters
+TRACT_BATCH_SIZE = 500
+
+
+def incremental_ingestion(incremental=None):
+    """
+        Whether the integration stages ingest incrementally: the given flag, or else whether INCREMENTAL_ENV is set to other than 0.
+    """
+    if incremental is None:
+        incremental = os.environ.get(INCREMENTAL_ENV, "0") not in ("", "0")
+    return incremental
+
+
+def canonical(values):
+    """
+        The values of a column in a representation that does not depend on their dtype, so a value hashes the same
+        whether it was read from the workbook, compacted (see schema.compact) or read back from SQLite.
+    """
+    values = plain(values)
+    if pd.api.types.is_bool_dtype(values) or pd.api.types.is_numeric_dtype(values):
+        return values.astype("float64")
+    if pd.api.types.is_datetime64_any_dtype(values):
+        values = values.astype(str)
+    values = values.astype(object)
+    return values.where(values.notna(), None)
+
+
+def row_hashes(df):
+    """
+        A 64-bit hash of the values of every row of a frame.
+    """
+    values = pd.DataFrame({column: canonical(df[column]) for column in df.columns}, index=df.index)
+    return pd.util.hash_pandas_object(values, index=False).to_numpy().view("int64")
+
+
+def frame_digest(df):
+    """
+        The content hash of a whole frame, its column names included.
+    """
+    digest = hashlib.sha256(",".join(map(str, df.columns)).encode())
+    digest.update(row_hashes(df).tobytes())
+    return digest.hexdigest()
+
+
+def snapshot(df, source):
+    """
+        The identity of every row of a source snapshot: its natural key, census tract and row hash.
+    """
+    keys, tract_column = SOURCES[source]
+    rows = pd.DataFrame({column: df[column].array for column in keys})
+    rows["census_tract"] = df[tract_column].array
+    rows = rows.astype("Int64")
+    rows[ROW_HASH_COLUMN] = row_hashes(df)
+    return rows
+
+
+def tract_list(tracts):
+    """
+        Census tracts as a sorted list of integers, with None for a missing tract last.
+    """
+    return sorted({None if pd.isna(tract) else int(tract) for tract in tracts}, key=lambda tract: (tract is None, tract or 0))
+
+
+@dataclass
+class SnapshotDiff:
+    """
+        The changes of a source between the stored and the current snapshot.
+
+        changed_keys holds the keys whose group of rows differs, i.e. keys that were inserted, updated or deleted;
+        rows holds the current rows of those keys, which replace their stored rows; dirty_tracts holds the census tracts
+        of the stored and the current rows of those keys, with None for the rows without a census tract.
+    """
+    source: str
+    changed_keys: pd.DataFrame
+    rows: pd.DataFrame
+    inserted: int
+    updated: int
+    deleted: int
+    dirty_tracts: list
+
+
+def diff_snapshot(source, stored, current):
+    """
+        Diff the current snapshot of a source against the stored one by natural key (see snapshot).
+        A key changed when the rows with that key differ as a multiset, so duplicate keys are compared as a whole.
+    """
+    keys, _ = SOURCES[source]
+    identity = keys + [ROW_HASH_COLUMN]
+
+    def numbered(rows):
+        # Number the identical rows of a key, so a row that is duplicated once more is a change too
+        return rows[identity].assign(_occurrence=rows.groupby(identity, dropna=False).cumcount())
+
+    rows = numbered(stored).merge(numbered(current), how="outer", indicator=True)
+    changed_keys = rows.loc[rows["_merge"] != "both", keys].drop_duplicates().reset_index(drop=True)
+
+    stored_rows = stored.merge(changed_keys, on=keys)
+    current_rows = current.merge(changed_keys, on=keys)
+    updated = len(stored_rows[keys].drop_duplicates().merge(current_rows[keys].drop_duplicates(), on=keys))
+    return SnapshotDiff(
+        source=source,
+        changed_keys=changed_keys,
+        rows=current_rows[stored.columns],
+        inserted=len(current_rows[keys].drop_duplicates()) - updated,
+        updated=updated,
+        deleted=len(stored_rows[keys].drop_duplicates()) - updated,
+        dirty_tracts=tract_list(pd.concat([stored_rows["census_tract"], current_rows["census_tract"]])),
+    )
+
+
+@dataclass
+class Ingestion:
+    """
+        The plan of an incremental ingestion: the state the stored tables describe once it is applied, the current
+        snapshot of every source and, unless the tables are rebuilt, the diff of every source against its stored snapshot.
+    """
+    state: dict
+    snapshots: dict
+    diffs: dict = None
+
+    @property
+    def rebuild(self):
+        return self.diffs is None
+
+    @property
+    def dirty_tracts(self):
+        return tract_list(tract for diff in self.diffs.values() for tract in diff.dirty_tracts)
+
+
+def read_state(conn):
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (STATE_TABLE,)).fetchone():
+        return {}
+    return dict(conn.execute(f'SELECT name, value FROM "{STATE_TABLE}"').fetchall())
+
+
+def read_snapshot(conn, source):
+    keys, _ = SOURCES[source]
+    stored = pd.read_sql_query(f'SELECT * FROM "{source}{SNAPSHOT_SUFFIX}"', conn)
+    return stored.astype({column: "Int64" for column in keys + ["census_tract"]})
+
+
+@instrumented()
+def plan_ingestion(conn, mode, df_aq, sources, script):
+    """
+        Decide how the integrated tables of a database are brought up to date with the current sheets.
+
+        The tables are only updated in place when they were built by an incremental ingestion from the same AirQuality
+        rows, source columns, integration mode and integration code; otherwise they are rebuilt.
+
+        Args:
+            conn (Connection): The SQLite connection of the integrated database.
+            mode (str): The integration mode of the stage.
+            df_aq (DataFrame): The AirQuality sheet, which is not diffed, so any change to it rebuilds the tables.
+            sources (dict): The current SOD and NCUA sheets, keyed by source name (see SOURCES).
+            script (str): The stage script, whose code is part of the state.
+
+        Returns:
+            Ingestion: The plan, with the diff of every source unless the tables are rebuilt.
+    """
+    code = hashlib.sha256()
+    for path in [script] + [os.path.join(os.path.dirname(os.path.abspath(__file__)), name) for name in INTEGRATION_CODE]:
+        code.update(file_hash(path).encode())
+
+    state = {"mode": mode, "airquality": frame_digest(df_aq), "code": code.hexdigest()}
+    state.update({f"{source}_columns": ",".join(map(str, df.columns)) for source, df in sources.items()})
+    snapshots = {source: snapshot(df, source) for source, df in sources.items()}
+
+    if read_state(conn) != state:
+        return Ingestion(state, snapshots)
+    diffs = {source: diff_snapshot(source, read_snapshot(conn, source), snapshots[source]) for source in sources}
+    return Ingestion(state, snapshots, diffs)
+
+
+def reset_ingestion(conn):
+    """
+        Drop the snapshots and state of the incremental ingestion, so the next incremental ingestion rebuilds the tables.
+        This is done before the tables are rebuilt, so an interrupted rebuild is never mistaken for a consistent state.
+    """
+    for table in [STATE_TABLE, DIRTY_TRACTS_TABLE] + [source + SNAPSHOT_SUFFIX for source in SOURCES]:
+        drop_relation(conn, table)
+
+
+@instrumented()
+def finish_ingestion(conn, ingestion):
+    """
+        Store the current snapshots, the dirty census tracts and the state once the integrated tables are up to date.
+        The changed keys of every snapshot are replaced by their current rows; a rebuild stores the whole snapshots.
+        Until then the stored snapshots describe the previous sheets, so an interrupted ingestion is simply repeated.
+    """
+    for source, rows in ingestion.snapshots.items():
+        table = source + SNAPSHOT_SUFFIX
+        if ingestion.rebuild:
+            bulk_load(conn, table, rows, indexes=SOURCES[source][0])
+        else:
+            diff = ingestion.diffs[source]
+            delete_rows(conn, table, diff.changed_keys)
+            insert_rows(conn, table, diff.rows)
+            print(f"{source}: {diff.inserted} keys inserted, {diff.updated} updated, {diff.deleted} deleted")
+
+    dirty_tracts = [] if ingestion.rebuild else ingestion.dirty_tracts
+    bulk_load(conn, DIRTY_TRACTS_TABLE, pd.DataFrame({"census_tract": pd.array(dirty_tracts, dtype="Int64")}))
+    bulk_load(conn, STATE_TABLE, pd.DataFrame({"name": list(ingestion.state), "value": list(ingestion.state.values())}), indexes=[])
+    if not ingestion.rebuild:
+        print(f"{len(dirty_tracts)} census tracts refreshed")
+
+
+def in_tracts(df, tract_column, tracts):
+    """
+        The rows of a frame in the given census tracts; None selects the rows without a census tract.
+    """
+    values = df[tract_column]
+    selected = values.isin([tract for tract in tracts if tract is not None])
+    if None in tracts:
+        selected |= values.isna()
+    return df[selected]
+
+
+@instrumented()
+def refresh_tracts(conn, tables, tract_columns, tracts):
+    """
+        Replace the rows of the given census tracts in the integrated tables with their recalculated rows.
+
+        Args:
+            conn (Connection): The SQLite connection of the integrated database.
+            tables (dict): The recalculated rows of the tracts, keyed by table name.
+            tract_columns (dict): The census tract column of every table.
+            tracts (list): The census tracts to replace, with None for the rows without a census tract.
+    """
+    for table, df in tables.items():
+        delete_rows(conn, table, pd.DataFrame({tract_columns[table]: pd.Series(tracts, dtype=object)}))
+        insert_rows(conn, table, df)
+
+
+@instrumented()
+def refresh_branch_counts(conn, relation, tract_column, bank_column, creditunion_column, tracts=None):
+    """
+        Count the unique banks and credit unions of every census tract of an integrated table or view in SQL, into the
+        Tract_Branch_Counts table, which holds the same counts as the Integrated sheet of the branch density scripts.
+
+        Args:
+            conn (Connection): The SQLite connection of the integrated database.
+            relation (str): The integrated table or view.
+            tract_column (str): Its census tract column.
+            bank_column (str): Its column identifying the bank.
+            creditunion_column (str): Its column identifying the credit union site.
+            tracts (list): The census tracts whose counts are recalculated. Defaults to recalculating every tract.
+    """
+    banks, creditunions = f'COUNT(DISTINCT "{bank_column}")', f'COUNT(DISTINCT "{creditunion_column}")'
+    select = (f'SELECT "{tract_column}", {banks}, {creditunions}, {banks} + {creditunions} '
+              f'FROM "{relation}" WHERE "{tract_column}" IS NOT NULL')
+
+    if tracts is None:
+        drop_relation(conn, TRACT_BRANCH_COUNTS_TABLE)
+        conn.execute(f'CREATE TABLE "{TRACT_BRANCH_COUNTS_TABLE}" (census_tract INTEGER, unique_bank_count INTEGER, '
+                     'unique_creditunion_count INTEGER, total_branch_count INTEGER)')
+        with conn:
+            conn.execute(f'INSERT INTO "{TRACT_BRANCH_COUNTS_TABLE}" {select} GROUP BY "{tract_column}"')
+    else:
+        tracts = [tract for tract in tracts if tract is not None]
+        delete_rows(conn, TRACT_BRANCH_COUNTS_TABLE, pd.DataFrame({"census_tract": pd.Series(tracts, dtype=object)}))
+        with conn:
+            for start in range(0, len(tracts), TRACT_BATCH_SIZE):
+                batch = tracts[start:start + TRACT_BATCH_SIZE]
+                placeholders = ", ".join("?" for _ in batch)
+                conn.execute(f'INSERT INTO "{TRACT_BRANCH_COUNTS_TABLE}" {select} AND "{tract_column}" IN ({placeholders}) '
+                             f'GROUP BY "{tract_column}"', batch)
+    create_indexes(conn, TRACT_BRANCH_COUNTS_TABLE, ["census_tract"])
+
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+
+
+@instrumented()
+def refresh_table(conn, table, df, keys, indexes=None):
+    """
+        Bring a materialized table up to date with its recalculated rows by only deleting and inserting the rows that
+        changed, compared by key and row hash, so the unchanged rows and the indexes stay in place.
+        A table that does not exist yet or has other columns is loaded from scratch.
+
+        Args:
+            conn (Connection): The SQLite connection.
+            table (str): The table, with one row per key.
+            df (DataFrame): The recalculated rows.
+            keys (list): The key columns.
+            indexes (list): The columns to index (see sqlite_store.bulk_load).
+
+        Returns:
+            tuple: The number of inserted, updated and deleted keys.
+    """
+    if table_columns(conn, table) != list(map(str, df.columns)):
+        bulk_load(conn, table, df, indexes)
+        return len(df), 0, 0
+
+    stored = pd.read_sql_query(f'SELECT * FROM "{table}"', conn)
+
+    def identities(rows):
+        # The keys in the representation of canonical, so keys read back from SQLite match the recalculated ones
+        return pd.DataFrame({column: canonical(rows[column]).array for column in keys}).assign(
+            **{ROW_HASH_COLUMN: row_hashes(rows), "_row": np.arange(len(rows))})
+
+    rows = identities(stored).merge(identities(df), on=keys, how="outer", suffixes=("_stored", ""), indicator=True)
+    changed = rows[(rows["_merge"] != "both") | (rows[ROW_HASH_COLUMN + "_stored"] != rows[ROW_HASH_COLUMN])]
+
+    replaced = changed["_row_stored"].dropna().astype("int64")
+    delete_rows(conn, table, stored.iloc[replaced.to_numpy()][keys])
+    insert_rows(conn, table, df.iloc[changed["_row"].dropna().astype("int64").to_numpy()])
+    create_indexes(conn, table, [column for column in KEY_COLUMNS if column in df.columns] if indexes is None else indexes)
+
+    updated = int((changed["_merge"] == "both").sum())
+    return int((changed["_merge"] == "right_only").sum()), updated, int((changed["_merge"] == "left_only").sum())
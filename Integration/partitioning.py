@@ -0,0 +1,102 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from Pipeline.instrumentation import instrumented
+
+# A census tract FIPS code is the 2-digit state code followed by the 3-digit county and 6-digit tract codes
+TRACT_STATE_DIVISOR = 10 ** 9
+
+# The partition of the rows without a census tract. Missing tracts are matched with each other by a merge, so these rows stay together.
+MISSING_STATE = -1
+
+# The number of worker processes of the state-partitioned execution; unset or 0 runs the scripts in a single process.
+# The pipeline runner passes it to its stages through the environment (see run_pipeline --partition-workers).
+PARTITION_WORKERS_ENV = "PIPELINE_PARTITION_WORKERS"
+
+
+def partition_workers(workers=None):
+    """
+        The number of worker processes of the state-partitioned execution: the given number, or else the value of
+        PARTITION_WORKERS_ENV. 0 means the work runs in a single process.
+    """
+    if workers is None:
+        workers = int(os.environ.get(PARTITION_WORKERS_ENV) or 0)
+    return workers
+
+
+def tract_states(tracts):
+    """
+        The state FIPS code of every census tract, i.e. its leading digits, with MISSING_STATE for missing tracts.
+    """
+    states = pd.to_numeric(pd.Series(tracts).reset_index(drop=True)) // TRACT_STATE_DIVISOR
+    return states.fillna(MISSING_STATE).to_numpy(dtype="int64")
+
+
+def shard(df, tract_column):
+    """
+        Split a frame into the rows of every state, keyed by the state FIPS code of the census tract in tract_column.
+        Each shard keeps the index and the order of its rows in the frame.
+    """
+    positions = pd.Series(np.arange(len(df))).groupby(tract_states(df[tract_column])).indices
+    return {int(state): df.iloc[rows] for state, rows in positions.items()}
+
+
+def partition(frames, tract_columns):
+    """
+        Shard several frames by the state of their census tracts.
+
+        Rows are assigned by the state of the tract they are joined on rather than by the address state of the branch
+        (STNAME, PhysicalAddressStateCode), which can differ from the tract's state, so every join and every per-tract count
+        stays within one partition.
+
+        Args:
+            frames (list): The frames to shard.
+            tract_columns (list): The census tract column of every frame.
+
+        Returns:
+            dict: For every state with rows in any of the frames, the tuple of the frames' rows in that state
+                (empty frames for the frames without rows in it).
+    """
+    shards = [shard(df, column) for df, column in zip(frames, tract_columns)]
+    states = sorted(set().union(*shards))
+    return {state: tuple(parts.get(state, df.iloc[:0]) for parts, df in zip(shards, frames)) for state in states}
+
+
+@instrumented()
+def run_partitions(function, partitions, workers):
+    """
+        Call a function with the frames of every partition in a process pool.
+        The largest partitions are submitted first, so a large state does not start last and hold up the result.
+
+        Args:
+            function (callable): A picklable function taking the frames of a partition as its positional arguments.
+            partitions (dict): The frames of every partition (see partition).
+            workers (int): The number of worker processes.
+
+        Returns:
+            dict: The result of every partition, in ascending state order.
+    """
+    largest_first = sorted(partitions, key=lambda state: -sum(len(df) for df in partitions[state]))
+    with ProcessPoolExecutor(max_workers=min(workers, len(partitions)) or 1) as executor:
+        futures = {state: executor.submit(function, *partitions[state]) for state in largest_first}
+        return {state: futures[state].result() for state in sorted(futures)}
+
+
+def combine(frames, ordered=False):
+    """
+        Concatenate the partial results of the partitions deterministically.
+
+        Args:
+            frames (list): The partial results in ascending state order (see run_partitions).
+            ordered (bool): Whether the rows are indexed by their position in the unpartitioned input. They are then sorted
+                by it, which restores the row order of a single-process run, and the index is kept. Otherwise the
+                results are concatenated in state order, which keeps tables sorted by census tract sorted, with a new index.
+
+        Returns:
+            DataFrame: The combined result.
+    """
+    if ordered:
+        return pd.concat(frames).sort_index(kind="stable")
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,227 @@
+import pandas as pd
+import os
+import json
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from Integration.sinks import FORMATS, output_path, read_output
+from Integration.workbook_cache import file_hash
+from Pipeline.instrumentation import instrumented
+
+# The store lives next to the working directory the pipeline scripts are run from.
+# It holds the aggregates of every folded file separately, with the stamps of the files in the metadata of the same
+# Arrow file, so the aggregates and the record of what was folded into them are always replaced together.
+AGGREGATES_DIR = "pm25_aggregates"
+AGGREGATES_FILE = "tract_source_aggregates.arrow"
+SOURCES_KEY = b"sources"
+
+AGGREGATE_KEYS = ["ctfips", "year"]
+AGGREGATE_FUNCTIONS = {"sum": "sum", "count": "sum", "min": "min", "max": "max"}
+
+# The year of the PM2.5 tract means the integration and branch density stages use by default
+PM25_YEAR = 2020
+
+# The tract means of a year exported by data_AQI_clean --export, e.g. the shipped AQI_2020_means.xlsx.
+# They stand in for the years the store holds no daily data of.
+MEANS_STEM = "AQI_{}_means"
+
+# The aggregates are small (one row per tract, year and file), so the last loaded version is kept in memory
+_loaded = {}
+
+
+def empty_aggregates():
+    """
+        Return an empty aggregate table with the (ctfips, year) index and the sum, count, min and max columns.
+    """
+    index = pd.MultiIndex.from_arrays([pd.Series(dtype="int64"), pd.Series(dtype="int16")], names=AGGREGATE_KEYS)
+    return pd.DataFrame({column: pd.Series(dtype="int64" if column == "count" else "float64") for column in AGGREGATE_FUNCTIONS}, index=index)
+
+
+def combine_aggregates(*partials):
+    """
+        Merge partial per-tract, per-year aggregates into one table.
+        Sums and counts are added and the minimum and maximum are kept, so partials computed over
+        disjoint sets of daily rows combine to exactly what one pass over all the rows would give.
+    """
+    partials = [partial for partial in partials if partial is not None and not partial.empty]
+    if not partials:
+        return empty_aggregates()
+    if len(partials) == 1:
+        return partials[0]
+    return pd.concat(partials).groupby(level=AGGREGATE_KEYS).agg(AGGREGATE_FUNCTIONS)
+
+
+def source_stamp(path, known=()):
+    """
+        Identify a daily PM2.5 file by its name and content hash.
+        The hash of a known stamp with the same name, size and modification time is reused, so an unchanged file is not re-read;
+        a touched or copied file is hashed again and still recognized by its content.
+    """
+    stat = os.stat(path)
+    stamp = {"file": os.path.basename(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    for saved in known:
+        if "sha256" in saved and {k: saved.get(k) for k in stamp} == stamp:
+            return saved
+    return dict(stamp, sha256=file_hash(path))
+
+
+def find_source(stamp, sources):
+    """
+        Return the stamp among sources with the content of the given stamp, or None.
+    """
+    return next((saved for saved in sources if saved.get("sha256") == stamp["sha256"]), None)
+
+
+def load_store(store_dir=AGGREGATES_DIR):
+    """
+        Load the aggregates of every folded file (the ctfips, year and source columns and the sum, count, min and max of DS_PM_pred)
+        and the stamps of the files.
+    """
+    aggregates_file = os.path.join(store_dir, AGGREGATES_FILE)
+    if not os.path.exists(aggregates_file):
+        rows = empty_aggregates().reset_index()
+        rows.insert(2, "source", pd.Series(dtype="str"))
+        return rows, []
+
+    key = (os.path.abspath(aggregates_file), os.stat(aggregates_file).st_mtime_ns)
+    if key not in _loaded:
+        table = feather.read_table(aggregates_file, memory_map=True)
+        sources = json.loads((table.schema.metadata or {}).get(SOURCES_KEY, b"[]"))
+        _loaded.clear()
+        _loaded[key] = (table.to_pandas(), sources)
+    return _loaded[key]
+
+
+def write_store(rows, sources, store_dir=AGGREGATES_DIR):
+    """
+        Replace the store with the given aggregates and source stamps in one step.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    aggregates_file = os.path.join(store_dir, AGGREGATES_FILE)
+    rows = rows.sort_values(["source"] + AGGREGATE_KEYS, kind="stable")
+    table = pa.Table.from_pandas(rows, preserve_index=False)
+    table = table.replace_schema_metadata({SOURCES_KEY: json.dumps(sources).encode()})
+
+    # Write to a temporary file first so an interrupted run never leaves a half-written store
+    feather.write_feather(table, aggregates_file + ".tmp", compression="uncompressed")
+    os.replace(aggregates_file + ".tmp", aggregates_file)
+
+
+def create_store(store_dir=AGGREGATES_DIR):
+    """
+        Create an empty store if there is none yet, so the store exists before any daily file was folded into it.
+    """
+    if not os.path.exists(os.path.join(store_dir, AGGREGATES_FILE)):
+        write_store(*load_store(store_dir), store_dir)
+
+
+def ingested_sources(store_dir=AGGREGATES_DIR):
+    """
+        Return the stamps of the daily files that have already been folded into the store.
+    """
+    return load_store(store_dir)[1]
+
+
+def is_ingested(path, store_dir=AGGREGATES_DIR):
+    """
+        Check whether a daily file with the same content has already been folded into the store.
+    """
+    sources = ingested_sources(store_dir)
+    return find_source(source_stamp(path, sources), sources) is not None
+
+
+def load_aggregates(store_dir=AGGREGATES_DIR):
+    """
+        Load the per-tract, per-year aggregates (sum, count, min and max of DS_PM_pred) of all folded files from the store.
+    """
+    rows, _ = load_store(store_dir)
+    return combine_aggregates(rows.drop(columns="source").set_index(AGGREGATE_KEYS))
+
+
+@instrumented()
+def fold_aggregates(partial, source, store_dir=AGGREGATES_DIR):
+    """
+        Fold the aggregates of a new daily file into the store without touching the history it already holds.
+        A file with the name of a folded file replaces its aggregates, e.g. a corrected download, rather than adding to them.
+
+        Args:
+            partial (DataFrame): The per-tract, per-year aggregates of the new file.
+            source (str): The daily file the aggregates were computed from.
+            store_dir (str): The directory holding the aggregate store.
+    """
+    rows, sources = load_store(store_dir)
+    stamp = source_stamp(source, sources)
+    if find_source(stamp, sources) is not None:
+        raise ValueError(f"{source} has already been folded into {store_dir}")
+
+    partial = partial.reset_index()
+    partial.insert(2, "source", stamp["file"])
+    rows = pd.concat([rows[rows["source"] != stamp["file"]], partial], ignore_index=True)
+    sources = [saved for saved in sources if saved["file"] != stamp["file"]] + [stamp]
+    write_store(rows, sources, store_dir)
+
+
+def available_years(store_dir=AGGREGATES_DIR):
+    """
+        Return the years present in the store.
+    """
+    return sorted(load_aggregates(store_dir).index.get_level_values("year").unique().tolist())
+
+
+def exported_means(year):
+    """
+        Read the tract means of a year exported by data_AQI_clean --export (see MEANS_STEM) in any output format, or None if there are none.
+    """
+    for format in FORMATS:
+        path = output_path(MEANS_STEM.format(year), format)
+        if os.path.exists(path):
+            means = read_output(path)
+            means = pd.DataFrame({
+                'census_tract': means['census_tract'].to_numpy(dtype="int64"),
+                'mean_pm25_concentration': means['mean_pm25_concentration'].to_numpy(dtype="float64"),
+            })
+            return means.sort_values('census_tract', kind="stable").reset_index(drop=True)
+    return None
+
+
+@instrumented()
+def tract_means(first_year, last_year=None, with_extremes=False, store_dir=AGGREGATES_DIR):
+    """
+        Calculate the mean PM2.5 concentration for each census tract over a range of years from the stored aggregates.
+        The means of a single year the store holds no daily data of are read from its exported means (see exported_means) instead.
+
+        Args:
+            first_year (int): The first year of the range.
+            last_year (int): The last year of the range (inclusive). Defaults to first_year.
+            with_extremes (bool): Whether to add the minimum and maximum daily concentration over the range.
+            store_dir (str): The directory holding the aggregate store.
+
+        Returns:
+            DataFrame: The census_tract and mean_pm25_concentration columns, sorted by census tract.
+
+        Raises:
+            ValueError: If the store holds no daily data of a year of the range, and no exported means of it stand in for them.
+    """
+    last_year = first_year if last_year is None else last_year
+    aggregates = load_aggregates(store_dir)
+
+    years = aggregates.index.get_level_values("year")
+    missing = sorted(set(range(first_year, last_year + 1)) - set(years.unique().tolist()))
+    if missing:
+        exported = exported_means(first_year) if first_year == last_year and not with_extremes else None
+        if exported is not None:
+            return exported
+        raise ValueError(f"{store_dir} holds no PM2.5 aggregates for {missing}; fold the daily files of these years "
+                         f"with data_AQI_clean.py or provide the {MEANS_STEM.format(first_year)} tract means")
+
+    in_range = aggregates[(years >= first_year) & (years <= last_year)]
+    tracts = in_range.groupby(level="ctfips").agg(AGGREGATE_FUNCTIONS)
+
+    means = pd.DataFrame({
+        'census_tract': tracts.index.to_numpy(dtype="int64"),
+        'mean_pm25_concentration': (tracts["sum"] / tracts["count"]).to_numpy(),
+    })
+    if with_extremes:
+        means['min_pm25_concentration'] = tracts["min"].to_numpy()
+        means['max_pm25_concentration'] = tracts["max"].to_numpy()
+    return means
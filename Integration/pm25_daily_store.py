@@ -0,0 +1,332 @@
+import os
+import glob
+import json
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from Integration.pm25_aggregates import SOURCES_KEY, find_source, source_stamp
+from Pipeline.instrumentation import instrumented
+
+# The store lives next to the working directory the pipeline scripts are run from, like the aggregate store
+DAILY_DIR = "pm25_daily"
+INDEX_FILE = "partitions.arrow"
+STAGING_DIR = "staging"
+
+# Every partition holds one month of daily rows, sorted by tract and date, in 16 bytes per row
+DAILY_SCHEMA = pa.schema([("ctfips", pa.int64()), ("date", pa.date32()), ("DS_PM_pred", pa.float32())])
+
+# The partition index: the row count and the range of every column of every partition, to skip partitions without opening them
+INDEX_SCHEMA = pa.schema([
+    ("year", pa.int16()), ("month", pa.int8()), ("rows", pa.int64()),
+    ("min_ctfips", pa.int64()), ("max_ctfips", pa.int64()),
+    ("min_date", pa.date32()), ("max_date", pa.date32()),
+    ("min_pm25", pa.float32()), ("max_pm25", pa.float32()),
+])
+
+# The 24-hour PM2.5 standard in µg/m³, the default threshold of the exceedance counts
+DAILY_STANDARD = 35.0
+
+# The partition index is small, so the last loaded version is kept in memory
+_loaded = {}
+
+
+def partition_path(year, month, store_dir=DAILY_DIR):
+    return os.path.join(store_dir, f"year={year}", f"month={month:02d}.arrow")
+
+
+def ingested_sources(store_dir=DAILY_DIR):
+    """
+        Return the stamps of the daily files that have already been merged into the store, kept in the metadata of the partition index.
+    """
+    index_file = os.path.join(store_dir, INDEX_FILE)
+    if not os.path.exists(index_file):
+        return []
+    with pa.memory_map(index_file) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+    return json.loads(metadata.get(SOURCES_KEY, b"[]"))
+
+
+def is_ingested(path, store_dir=DAILY_DIR):
+    """
+        Check whether a daily file with the same content has already been merged into the store.
+    """
+    sources = ingested_sources(store_dir)
+    return find_source(source_stamp(path, sources), sources) is not None
+
+
+def write_index(rows, sources, store_dir=DAILY_DIR):
+    """
+        Replace the partition index and the stamps of the merged files in one step.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    table = pa.Table.from_pylist(rows, schema=INDEX_SCHEMA)
+    write_atomic(table.replace_schema_metadata({SOURCES_KEY: json.dumps(sources).encode()}), os.path.join(store_dir, INDEX_FILE))
+
+
+def create_store(store_dir=DAILY_DIR):
+    """
+        Create an empty store if there is none yet, so the partition index exists before any daily file was merged into it.
+    """
+    if not os.path.exists(os.path.join(store_dir, INDEX_FILE)):
+        write_index([], [], store_dir)
+
+
+def begin_staging(store_dir=DAILY_DIR):
+    """
+        Create an empty staging directory for the runs of a daily file (see stage_rows), discarding those of an interrupted ingestion.
+    """
+    staging_dir = os.path.join(store_dir, STAGING_DIR)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    return staging_dir
+
+
+def daily_table(ctfips, dates, values):
+    """
+        Build a table in the DAILY_SCHEMA from the tract, date and concentration arrays.
+    """
+    return pa.table({
+        "ctfips": pa.array(np.asarray(ctfips, dtype="int64")),
+        "date": pa.array(np.asarray(dates, dtype="datetime64[D]")),
+        "DS_PM_pred": pa.array(np.asarray(values, dtype="float32")),
+    }, schema=DAILY_SCHEMA)
+
+
+def stage_rows(rows, staging_dir, name):
+    """
+        Split parsed rows of a daily file by month and write every part as a run of its partition, to be merged into
+        the store by commit_staging. The workers that parse the daily file call this, so the rows never travel back to the parent.
+
+        Args:
+            rows (DataFrame): The ctfips, date (as datetime64) and DS_PM_pred columns of the rows.
+            staging_dir (str): The staging directory (see begin_staging).
+            name (str): A name that is unique among the runs of the file and sorts in file order, e.g. the byte offset of the rows.
+    """
+    dates = rows["date"]
+    months = (dates.dt.year * 100 + dates.dt.month).to_numpy()
+    for month_key in np.unique(months):
+        year, month = divmod(int(month_key), 100)
+        part = rows[months == month_key]
+        run_dir = os.path.join(staging_dir, f"year={year}", f"month={month:02d}")
+        os.makedirs(run_dir, exist_ok=True)
+        table = daily_table(part["ctfips"], part["date"].to_numpy(), part["DS_PM_pred"])
+        feather.write_feather(table, os.path.join(run_dir, f"{name}.arrow"), compression="uncompressed")
+
+
+def sorted_rows(table):
+    """
+        Sort daily rows by tract and date, keeping the last of the rows with the same tract and date,
+        so a later daily file replaces the values of an earlier one.
+    """
+    ctfips = table.column("ctfips").to_numpy()
+    dates = table.column("date").to_numpy()
+    order = np.lexsort((dates, ctfips))
+    ctfips, dates = ctfips[order], dates[order]
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = (ctfips[1:] != ctfips[:-1]) | (dates[1:] != dates[:-1])
+    return table.take(order[last])
+
+
+def partition_stats(year, month, table):
+    """
+        The index row of a partition (see INDEX_SCHEMA).
+    """
+    values = table.column("DS_PM_pred").to_numpy()
+    dates = table.column("date").to_numpy()
+    ctfips = table.column("ctfips").to_numpy()
+    return {
+        "year": year, "month": month, "rows": len(table),
+        "min_ctfips": ctfips[0].item(), "max_ctfips": ctfips[-1].item(),
+        "min_date": dates.min().item(), "max_date": dates.max().item(),
+        "min_pm25": np.nanmin(values).item(), "max_pm25": np.nanmax(values).item(),
+    }
+
+
+def write_atomic(table, path, **kwargs):
+    # Write to a temporary file first so an interrupted run never leaves a half-written file
+    feather.write_feather(table, path + ".tmp", compression="uncompressed", **kwargs)
+    os.replace(path + ".tmp", path)
+
+
+@instrumented()
+def commit_staging(staging_dir, source, store_dir=DAILY_DIR):
+    """
+        Merge the staged runs of a daily file into the store. Every partition the file touches is rewritten once, sorted by
+        tract and date as a single record batch, with the rows of the file replacing stored rows of the same tract and date.
+        The partition index and the stamps of the merged files are replaced together last; an interrupted merge is simply repeated.
+
+        Args:
+            staging_dir (str): The staging directory holding the runs of the file (see stage_rows).
+            source (str): The daily file the runs were parsed from.
+            store_dir (str): The directory holding the daily store.
+    """
+    sources = ingested_sources(store_dir)
+    stamp = source_stamp(source, sources)
+    if find_source(stamp, sources) is not None:
+        raise ValueError(f"{source} has already been merged into {store_dir}")
+
+    index_file = os.path.join(store_dir, INDEX_FILE)
+    stored = feather.read_table(index_file).to_pylist() if os.path.exists(index_file) else []
+    index = {(row["year"], row["month"]): row for row in stored}
+    for run_dir in sorted(glob.glob(os.path.join(staging_dir, "year=*", "month=*"))):
+        year = int(os.path.basename(os.path.dirname(run_dir))[len("year="):])
+        month = int(os.path.basename(run_dir)[len("month="):])
+        path = partition_path(year, month, store_dir)
+
+        tables = [feather.read_table(path)] if os.path.exists(path) else []
+        tables += [feather.read_table(run) for run in sorted(glob.glob(os.path.join(run_dir, "*.arrow")))]
+        table = sorted_rows(pa.concat_tables(tables).combine_chunks())
+
+        # One record batch per partition, so the sorted ctfips column can be binary searched in the memory-mapped file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(table, path, chunksize=max(len(table), 1))
+        index[(year, month)] = partition_stats(year, month, table)
+
+    sources = [saved for saved in sources if saved["file"] != stamp["file"]] + [stamp]
+    write_index([index[key] for key in sorted(index)], sources, store_dir)
+    shutil.rmtree(staging_dir)
+
+
+def partition_index(store_dir=DAILY_DIR):
+    """
+        Load the partition index of the store (see INDEX_SCHEMA), with the dates as datetime64 columns.
+    """
+    index_file = os.path.join(store_dir, INDEX_FILE)
+    if not os.path.exists(index_file):
+        return INDEX_SCHEMA.empty_table().to_pandas()
+
+    key = (os.path.abspath(index_file), os.stat(index_file).st_mtime_ns)
+    if key not in _loaded:
+        _loaded.clear()
+        _loaded[key] = feather.read_table(index_file).to_pandas(date_as_object=False)
+    return _loaded[key]
+
+
+def as_date(value):
+    return None if value is None else np.datetime64(pd.Timestamp(value).date(), "D")
+
+
+def select_partitions(start=None, end=None, tracts=None, above=None, store_dir=DAILY_DIR):
+    """
+        The index rows of the partitions that can hold rows in the date range, of the tracts and above a concentration,
+        judged from the index alone.
+    """
+    index = partition_index(store_dir)
+    keep = np.ones(len(index), dtype=bool)
+    if start is not None:
+        keep &= index["max_date"].to_numpy(dtype="datetime64[D]") >= start
+    if end is not None:
+        keep &= index["min_date"].to_numpy(dtype="datetime64[D]") <= end
+    if tracts is not None:
+        keep &= (index["min_ctfips"].to_numpy() <= tracts.max()) & (index["max_ctfips"].to_numpy() >= tracts.min()) \
+            if len(tracts) else False
+    if above is not None:
+        keep &= index["max_pm25"].to_numpy() > above
+    return index[keep]
+
+
+def tract_rows(ctfips, tracts):
+    """
+        The positions of the rows of the given sorted tracts in a column sorted by tract, found by binary search.
+    """
+    starts = np.searchsorted(ctfips, tracts, side="left")
+    ends = np.searchsorted(ctfips, tracts, side="right")
+    return np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] or [np.empty(0, dtype="int64")])
+
+
+def scan(start=None, end=None, tracts=None, above=None, store_dir=DAILY_DIR):
+    """
+        Yield the rows of every partition that can match, restricted to the tracts, the date range and the values above
+        a concentration. The partitions are memory-mapped and the rows of the tracts are located by binary search on the
+        sorted ctfips column, so only the pages holding those rows are read.
+    """
+    start, end = as_date(start), as_date(end)
+    tracts = None if tracts is None else np.unique(np.asarray(tracts, dtype="int64"))
+    for partition in select_partitions(start, end, tracts, above, store_dir).itertuples():
+        table = feather.read_table(partition_path(partition.year, partition.month, store_dir), memory_map=True)
+        if tracts is not None:
+            table = table.take(tract_rows(table.column("ctfips").chunk(0).to_numpy(), tracts))
+
+        keep = np.ones(len(table), dtype=bool)
+        # Only the partitions on the edges of the range need their dates checked
+        if start is not None and partition.min_date < start:
+            keep &= table.column("date").to_numpy() >= start
+        if end is not None and partition.max_date > end:
+            keep &= table.column("date").to_numpy() <= end
+        if above is not None:
+            keep &= table.column("DS_PM_pred").to_numpy() > above
+        yield table if keep.all() else table.filter(pa.array(keep))
+
+
+@instrumented()
+def daily_pm25(tracts=None, start=None, end=None, store_dir=DAILY_DIR):
+    """
+        Read the daily PM2.5 series of census tracts over a date range from the store.
+
+        Args:
+            tracts (list): The census tracts (ctfips). Defaults to every tract.
+            start (str): The first date of the range, e.g. "2019-01-01". Defaults to the first stored date.
+            end (str): The last date of the range (inclusive). Defaults to the last stored date.
+            store_dir (str): The directory holding the daily store.
+
+        Returns:
+            DataFrame: The ctfips, date and DS_PM_pred columns, sorted by tract and date.
+    """
+    tables = list(scan(start, end, tracts, store_dir=store_dir))
+    if not tables:
+        return DAILY_SCHEMA.empty_table().to_pandas(date_as_object=False)
+    return sorted_rows(pa.concat_tables(tables)).to_pandas(date_as_object=False)
+
+
+@instrumented()
+def rolling_pm25(tracts, days, start=None, end=None, store_dir=DAILY_DIR):
+    """
+        Calculate the rolling mean PM2.5 concentration of census tracts over the given number of calendar days up to every date
+        of a range, e.g. the 30-day rolling mean. The days before the range are read as well, so the first dates have full windows;
+        days missing from a series are left out of their windows.
+
+        Args:
+            tracts (list): The census tracts (ctfips).
+            days (int): The length of the window in days.
+            start (str): The first date of the range. Defaults to the first stored date.
+            end (str): The last date of the range (inclusive). Defaults to the last stored date.
+            store_dir (str): The directory holding the daily store.
+
+        Returns:
+            DataFrame: The ctfips, date and rolling_mean_pm25 columns, sorted by tract and date.
+    """
+    first = None if start is None else as_date(start) - np.timedelta64(days - 1, "D")
+    series = daily_pm25(tracts, first, end, store_dir)
+
+    windows = series.set_index("date").groupby("ctfips")["DS_PM_pred"].rolling(f"{days}D", min_periods=1)
+    rolling = windows.mean().reset_index(name="rolling_mean_pm25")
+    if start is not None:
+        rolling = rolling[rolling["date"] >= pd.Timestamp(start)]
+    return rolling.reset_index(drop=True)
+
+
+@instrumented()
+def exceedance_days(threshold=DAILY_STANDARD, start=None, end=None, tracts=None, store_dir=DAILY_DIR):
+    """
+        Count the days every census tract exceeded a PM2.5 concentration in a date range, e.g. the days above 35 µg/m³ in 2019.
+        Partitions whose maximum does not exceed the threshold are skipped without being opened.
+
+        Args:
+            threshold (float): The concentration in µg/m³ that a day has to exceed. Defaults to the 24-hour standard.
+            start (str): The first date of the range. Defaults to the first stored date.
+            end (str): The last date of the range (inclusive). Defaults to the last stored date.
+            tracts (list): The census tracts (ctfips). Defaults to every tract.
+            store_dir (str): The directory holding the daily store.
+
+        Returns:
+            DataFrame: The ctfips, exceedance_days and max_pm25 columns of the tracts with at least one exceedance, sorted by tract.
+    """
+    tables = list(scan(start, end, tracts, above=threshold, store_dir=store_dir))
+    if not tables:
+        return pd.DataFrame({"ctfips": pd.Series(dtype="int64"), "exceedance_days": pd.Series(dtype="int64"),
+                             "max_pm25": pd.Series(dtype="float32")})
+    days = pa.concat_tables(tables).to_pandas()
+    return days.groupby("ctfips").agg(exceedance_days=("date", "size"), max_pm25=("DS_PM_pred", "max")).reset_index()
@@ -0,0 +1,157 @@
+import pandas as pd
+
+from Pipeline.instrumentation import emit
+
+# Identifiers are nullable integers, so they stay integers when a merge leaves them missing
+ID_COLUMNS = {
+    "census_tract", "census tract", "ctfips",
+    "CERT", "UNINUMBR", "RSSDID", "RSSDHCR",
+    "CU_NUMBER", "JOIN_NUMBER", "SiteId",
+}
+
+# Yes/no columns, stored as 0/1 or as "Yes"/"No" in the source sheets
+FLAG_COLUMNS = {
+    "ATM", "DriveThru", "MemberServices", "Shrd_Serv_Cntr_Net", "MainOffice",
+    "UNIT", "BKMO", "METROBR", "MICROBR",
+}
+FLAG_VALUES = {0: False, 1: True, "No": False, "Yes": True, "N": False, "Y": True}
+
+# Amounts that are summed across branches keep 64 bits so the totals cannot overflow
+WIDE_COLUMNS = {"ASSET", "DEPDOM", "DEPSUM", "DEPSUMBR", "total_deposits"}
+
+# Text columns with at most this share of distinct values are stored as categoricals
+CATEGORY_MAX_RATIO = 0.5
+
+# Suffixes the integration adds to the columns of every source (see tract_integration)
+SOURCE_SUFFIXES = ("_AQ", "_SOD", "_NCUA")
+
+# The columns of the daily census tract-level PM2.5 file that are read, with their dtypes
+DAILY_PM25_DTYPES = {"year": "int16", "ctfips": "int64", "DS_PM_pred": "float64"}
+
+# The frames compacted since the last report, as (name, bytes before, bytes after)
+_footprints = []
+
+
+def base_name(column):
+    """
+        The name of a column without the source suffix added by the integration.
+    """
+    for suffix in SOURCE_SUFFIXES:
+        if isinstance(column, str) and column.endswith(suffix):
+            return column[:-len(suffix)]
+    return column
+
+
+def footprint(df):
+    """
+        The memory used by a frame in bytes, including the contents of its strings.
+    """
+    return int(df.memory_usage(deep=True).sum())
+
+
+def is_text(values):
+    return pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values)
+
+
+def as_flag(values):
+    """
+        Convert a yes/no column to a nullable boolean, or return None when it holds other values.
+    """
+    present = values.dropna()
+    if not present.isin(list(FLAG_VALUES)).all():
+        return None
+    return values.map(FLAG_VALUES, na_action="ignore").astype("boolean")
+
+
+def plain(values):
+    """
+        The values of a categorical column in the dtype of its categories, e.g. to combine it with another column.
+        Other columns are returned unchanged.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.astype(values.dtype.categories.dtype)
+    return values
+
+
+def downcast_integers(values):
+    """
+        Store whole numbers in the smallest integer dtype that holds them, nullable when values are missing.
+        Columns with fractions are returned unchanged, so no value changes.
+    """
+    present = values.dropna()
+    if pd.api.types.is_float_dtype(values) and not (present % 1 == 0).all():
+        return values
+    if present.empty:
+        return values
+    smallest = pd.to_numeric(present.astype("int64"), downcast="integer").dtype
+    if values.isna().any() or pd.api.types.is_extension_array_dtype(values):
+        return values.astype(str(smallest).capitalize())
+    return values.astype(smallest)
+
+
+def compact_column(column, values):
+    """
+        Return a column in its compact dtype (see compact).
+    """
+    name = base_name(column)
+    if name in ID_COLUMNS:
+        if pd.api.types.is_numeric_dtype(values):
+            present = values.dropna()
+            if (present % 1 == 0).all():
+                return values.astype("Int64")
+        return values
+    if name in FLAG_COLUMNS:
+        flags = as_flag(values)
+        if flags is not None:
+            return flags
+    if isinstance(values.dtype, pd.CategoricalDtype) or pd.api.types.is_bool_dtype(values):
+        return values
+    if is_text(values):
+        if len(values) and values.nunique() <= CATEGORY_MAX_RATIO * len(values):
+            return values.astype("category")
+        return values
+    if name in WIDE_COLUMNS:
+        return values
+    if pd.api.types.is_integer_dtype(values) or pd.api.types.is_float_dtype(values):
+        return downcast_integers(values)
+    return values
+
+
+def compact(df, name=None):
+    """
+        Convert a frame to compact dtypes: nullable Int64 identifiers (census tracts, certificate numbers and site ids),
+        nullable booleans for yes/no flags, categoricals for repeated text (names, cities, counties, WKT points of
+        monitors), and the smallest integer dtype for whole-number columns. Columns with fractions keep float64 and
+        amounts that are summed keep int64, so every value and total stays exactly the same.
+        Columns of integrated frames are recognized by their name without the source suffix.
+
+        Args:
+            df (DataFrame): The frame to convert.
+            name (str): The name the frame's footprint is reported under (see report_footprint). None skips the report.
+
+        Returns:
+            DataFrame: A new frame with the compact dtypes.
+    """
+    before = footprint(df) if name else None
+    compacted = pd.DataFrame({column: compact_column(column, df[column]) for column in df.columns}, index=df.index)
+    if name:
+        after = footprint(compacted)
+        _footprints.append((name, before, after))
+        emit({"kind": "memory", "frame": name, "rows": len(df), "bytes_before": before, "bytes_after": after})
+    return compacted
+
+
+def report_footprint(title="Memory footprint"):
+    """
+        Print the footprint of every frame compacted since the last report before and after compaction, and reset the tally.
+    """
+    if not _footprints:
+        return
+    print(f"\n{title}:")
+    print(f"  {'frame':<32}{'before (MB)':>14}{'after (MB)':>14}{'saved':>8}")
+    for name, before, after in _footprints:
+        print(f"  {name:<32}{before / 1024 ** 2:>14.2f}{after / 1024 ** 2:>14.2f}{1 - after / max(before, 1):>8.0%}")
+    before = sum(before for _, before, _ in _footprints)
+    after = sum(after for _, _, after in _footprints)
+    print(f"  {'total':<32}{before / 1024 ** 2:>14.2f}{after / 1024 ** 2:>14.2f}{1 - after / max(before, 1):>8.0%}")
+    _footprints.clear()
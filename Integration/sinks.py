@@ -0,0 +1,325 @@
+import os
+import shutil
+from itertools import chain
+from uuid import uuid4
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from Integration.sqlite_store import KEY_COLUMNS, connect, create_table, insert_rows, create_indexes, read_table, to_records
+from Pipeline.instrumentation import instrumented
+
+# The file extension of every output format. The columnar, CSV and Excel outputs of a stage hold one file or sheet per table,
+# the SQLite output one database with every table.
+FORMATS = {"arrow": ".arrow", "csv": ".csv", "sqlite": ".sqlite", "excel": ".xlsx"}
+
+# The formats the stages write their outputs in. Excel is too slow and too small for intermediate artifacts,
+# so workbooks are only written by the optional excel_report stage.
+ARTIFACT_FORMATS = ("arrow", "csv", "sqlite")
+DEFAULT_FORMAT = "arrow"
+
+# The output format of the stages; the pipeline runner passes it to its stages through the environment (see run_pipeline --output-format)
+OUTPUT_FORMAT_ENV = "PIPELINE_OUTPUT_FORMAT"
+
+# The number of rows converted and written at a time, i.e. the size of an Arrow record batch
+DEFAULT_CHUNK_ROWS = 100_000
+
+# The rows of an Excel worksheet, including the header row
+EXCEL_MAX_ROWS = 1_048_576
+
+
+def output_format(format=None):
+    """
+        The format of the stage outputs: the given format, or else the value of OUTPUT_FORMAT_ENV, or else DEFAULT_FORMAT.
+    """
+    format = format or os.environ.get(OUTPUT_FORMAT_ENV) or DEFAULT_FORMAT
+    if format not in FORMATS:
+        raise ValueError(f"Unknown output format {format}, expected one of {sorted(FORMATS)}")
+    return format
+
+
+def output_path(stem, format=None):
+    """
+        The path of an output in the given format (see output_format), e.g. "branch_counts.arrow" for the stem "branch_counts".
+    """
+    return stem + FORMATS[output_format(format)]
+
+
+def format_of(path):
+    """
+        The format of an output, recognized by its extension.
+    """
+    for format, extension in FORMATS.items():
+        if path.endswith(extension):
+            return format
+    raise ValueError(f"Unknown output format of {path}")
+
+
+class Sink:
+    """
+        Writes the tables of an output one chunk of rows at a time.
+        A table is written by begin(), which receives the first chunk to define the columns, a write() per chunk and end().
+        Every chunk of a table has the columns and dtypes of the first; categoricals may add categories.
+    """
+    format = None
+
+    def __init__(self, path):
+        self.path = path
+
+    def begin(self, table, chunk):
+        pass
+
+    def write(self, chunk):
+        raise NotImplementedError
+
+    def end(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DirectorySink(Sink):
+    """
+        A sink that writes every table to its own file in the output directory, e.g. "branch_counts.arrow/County.arrow".
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        os.makedirs(path)
+
+    def table_file(self, table):
+        return os.path.join(self.path, table + FORMATS[self.format])
+
+
+class ArrowSink(DirectorySink):
+    """
+        Writes every table as an uncompressed Arrow IPC (Feather) file with one record batch per chunk, like the sheet cache.
+        The compact dtypes (categoricals, nullable integers and booleans) are kept, and the files can be memory-mapped.
+    """
+    format = "arrow"
+
+    def begin(self, table, chunk):
+        # The schema of the first chunk, so every chunk is converted to the same types. Categorical codes are widened
+        # to 32 bits, so the categories later chunks add still fit.
+        schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+        self.schema = pa.schema([
+            field.with_type(pa.dictionary(pa.int32(), field.type.value_type, field.type.ordered)) if pa.types.is_dictionary(field.type) else field
+            for field in schema
+        ], metadata=schema.metadata)
+        self.categories = {column: chunk[column].cat.categories for column in chunk.columns if isinstance(chunk[column].dtype, pd.CategoricalDtype)}
+        self.file = pa.OSFile(self.table_file(table), "wb")
+        # An Arrow file holds one dictionary per column, which later record batches may only append to
+        self.writer = pa.ipc.new_file(self.file, self.schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+    def write(self, chunk):
+        # The categories of every chunk are appended to the categories written so far, so the dictionaries only grow
+        for column, categories in self.categories.items():
+            if not chunk[column].cat.categories.equals(categories):
+                categories = categories.append(chunk[column].cat.categories.difference(categories))
+                chunk = chunk.assign(**{column: chunk[column].cat.set_categories(categories)})
+                self.categories[column] = categories
+        self.writer.write_table(pa.Table.from_pandas(chunk, schema=self.schema, preserve_index=False))
+
+    def end(self):
+        self.writer.close()
+        self.file.close()
+
+
+class CsvSink(DirectorySink):
+    """
+        Writes every table as a CSV file, appending one chunk at a time.
+    """
+    format = "csv"
+
+    def begin(self, table, chunk):
+        self.file = open(self.table_file(table), "w", newline="")
+        self.header = True
+
+    def write(self, chunk):
+        chunk.to_csv(self.file, index=False, header=self.header)
+        self.header = False
+
+    def end(self):
+        self.file.close()
+
+
+class SqliteSink(Sink):
+    """
+        Writes every table to a SQLite database in one transaction per chunk, indexing the KEY_COLUMNS afterwards.
+    """
+    format = "sqlite"
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.conn = connect(path)
+
+    def begin(self, table, chunk):
+        self.table = table
+        self.indexes = [column for column in KEY_COLUMNS if column in chunk.columns]
+        create_table(self.conn, table, chunk)
+
+    def write(self, chunk):
+        insert_rows(self.conn, self.table, chunk, batch_size=max(len(chunk), 1))
+
+    def end(self):
+        create_indexes(self.conn, self.table, self.indexes)
+
+    def close(self):
+        self.conn.close()
+
+
+class ExcelSink(Sink):
+    """
+        Writes every table to a sheet of an Excel workbook, streaming the rows instead of building the workbook cell by cell.
+    """
+    format = "excel"
+
+    def __init__(self, path):
+        from openpyxl import Workbook
+        super().__init__(path)
+        self.workbook = Workbook(write_only=True)
+
+    def begin(self, table, chunk):
+        self.table = table
+        self.rows = 1
+        self.sheet = self.workbook.create_sheet(table)
+        self.sheet.append([str(column) for column in chunk.columns])
+
+    def write(self, chunk):
+        self.rows += len(chunk)
+        if self.rows > EXCEL_MAX_ROWS:
+            raise ValueError(f"Table {self.table} has more rows than an Excel sheet holds")
+        for row in to_records(chunk):
+            self.sheet.append(row)
+
+    def close(self):
+        self.workbook.save(self.path)
+
+
+SINKS = {sink.format: sink for sink in (ArrowSink, CsvSink, SqliteSink, ExcelSink)}
+
+
+def remove_output(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def table_chunks(rows, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+        The chunks of at most chunk_rows rows of a table, given as a frame or as an iterable of frames (e.g. a generator
+        that produces the rows as they are computed). An empty frame is kept as one empty chunk, so its columns are written.
+    """
+    for chunk in [rows] if isinstance(rows, pd.DataFrame) else rows:
+        for start in range(0, max(len(chunk), 1), chunk_rows):
+            yield chunk.iloc[start:start + chunk_rows]
+
+
+def publish_output(tmp_path, path):
+    """
+        Put a written output in place of the previous one.
+        A file replaces the previous file in one step. A directory cannot replace a directory that way, so the previous
+        directory is moved aside first and removed afterwards; the output is missing only between the two renames.
+    """
+    if not os.path.isdir(tmp_path) or not os.path.isdir(path):
+        os.replace(tmp_path, path)
+        return
+    old_path = f"{path}.{os.getpid()}.{uuid4().hex}.old"
+    os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+@instrumented()
+def write_output(tables, stem, format=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+        Write the tables of a stage output, one chunk of rows at a time, as the chunks are produced.
+        The output is written under a temporary name of its own and only replaces the previous output once it is complete,
+        so a failed or concurrent run never leaves a partial output behind.
+
+        Args:
+            tables (dict): The rows of every table, keyed by table name: a frame, or an iterable of frames that are
+                written as they are produced (see table_chunks). The first chunk of a table defines its columns.
+            stem (str): The path of the output without the extension of the format.
+            format (str): The output format (see output_format).
+            chunk_rows (int): The largest number of rows written at a time.
+
+        Returns:
+            str: The path of the output.
+    """
+    format = output_format(format)
+    path = output_path(stem, format)
+    tmp_path = f"{path}.{os.getpid()}.{uuid4().hex}.tmp"
+
+    try:
+        with SINKS[format](tmp_path) as sink:
+            for table, rows in tables.items():
+                chunks = table_chunks(rows, chunk_rows)
+                first = next(chunks, None)
+                if first is None:
+                    raise ValueError(f"Table {table} has no chunks, at least one (possibly empty) chunk defines its columns")
+                sink.begin(table, first)
+                for chunk in chain([first], chunks):
+                    sink.write(chunk)
+                sink.end()
+    except BaseException:
+        remove_output(tmp_path)
+        raise
+
+    publish_output(tmp_path, path)
+    return path
+
+
+def output_tables(path):
+    """
+        The names of the tables of an output.
+    """
+    format = format_of(path)
+    if format == "sqlite":
+        conn = connect(path)
+        try:
+            return [name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY rowid")]
+        finally:
+            conn.close()
+    if format == "excel":
+        return pd.ExcelFile(path).sheet_names
+    extension = FORMATS[format]
+    return sorted(entry[:-len(extension)] for entry in os.listdir(path) if entry.endswith(extension))
+
+
+@instrumented()
+def read_output(path, table=None, columns=None):
+    """
+        Read a table of a stage output written by write_output, in the format of its extension.
+        The Arrow format restores the dtypes the table was written with; CSV and Excel infer them.
+
+        Args:
+            path (str): The path of the output, e.g. output_path("branch_counts").
+            table (str): The table to read. Defaults to the only table of the output.
+            columns (list): The columns to read. Defaults to all columns.
+
+        Returns:
+            DataFrame: The rows of the table.
+    """
+    format = format_of(path)
+    if table is None:
+        tables = output_tables(path)
+        if len(tables) != 1:
+            raise ValueError(f"{path} holds the tables {tables}, the table to read has to be given")
+        table = tables[0]
+
+    if format == "arrow":
+        return feather.read_table(os.path.join(path, table + FORMATS[format]), columns=columns, memory_map=True).to_pandas()
+    if format == "csv":
+        return pd.read_csv(os.path.join(path, table + FORMATS[format]), usecols=columns)
+    if format == "sqlite":
+        return read_table(path, table, columns)
+    return pd.read_excel(path, sheet_name=table, usecols=columns)
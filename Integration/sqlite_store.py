@@ -0,0 +1,267 @@
+import pandas as pd
+import sqlite3
+import numpy as np
+
+from Pipeline.instrumentation import instrumented
+
+# Columns that are used to look up rows; an index is created on every one of them a table has
+KEY_COLUMNS = [
+    "census_tract", "census_tract_AQ", "census_tract_SOD", "census_tract_NCUA",
+    "CERT", "CERT_SOD", "SiteId", "SiteId_NCUA",
+]
+
+# Page size only takes effect on a new database file
+PRAGMAS = {
+    "page_size": 8192,
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -64 * 1024,
+    "mmap_size": 256 * 1024 * 1024,
+}
+
+DEFAULT_BATCH_SIZE = 50_000
+
+OPERATORS = {">", ">=", "<", "<=", "=", "!="}
+
+
+def connect(db_name):
+    """
+        Open a SQLite database with the pragmas tuned for bulk loading and read-heavy use.
+    """
+    conn = sqlite3.connect(db_name)
+    for pragma, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    return conn
+
+
+def sql_type(dtype):
+    """
+        Map a pandas dtype to a SQLite column type.
+    """
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(dtype):
+        return "REAL"
+    return "TEXT"
+
+
+def drop_relation(conn, name):
+    """
+        Drop a table or view, whichever the name currently refers to.
+        The merged and normalized integration modes store the integrated data under the same name as a table and a view respectively.
+    """
+    for kind, in conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,)).fetchall():
+        conn.execute(f'DROP {kind.upper()} "{name}"')
+    conn.commit()
+
+
+def to_records(df):
+    """
+        Convert a DataFrame to tuples of plain Python values, with missing values as None and timestamps as ISO strings.
+    """
+    columns = []
+    for column in df.columns:
+        values = df[column]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            values = values.dt.strftime("%Y-%m-%d %H:%M:%S")
+        values = values.astype(object)
+        columns.append(values.where(values.notna(), None).tolist())
+
+    return list(zip(*columns))
+
+
+def integer_keys(df):
+    """
+        Merges turn the key columns into floats because of missing values; convert them back to integers.
+    """
+    for column in df.columns.intersection(KEY_COLUMNS):
+        values = df[column]
+        if pd.api.types.is_float_dtype(values) and (values.dropna() % 1 == 0).all():
+            df = df.assign(**{column: values.astype("Int64")})
+    return df
+
+
+def create_table(conn, table, df):
+    """
+        Replace a table with an empty table with the columns of a DataFrame.
+    """
+    columns = ", ".join(f'"{column}" {sql_type(dtype)}' for column, dtype in integer_keys(df).dtypes.items())
+    drop_relation(conn, table)
+    conn.execute(f'CREATE TABLE "{table}" ({columns})')
+
+
+def insert_rows(conn, table, df, batch_size=DEFAULT_BATCH_SIZE):
+    """
+        Append the rows of a DataFrame to a table, in one transaction per batch of rows.
+    """
+    columns = ", ".join(f'"{column}"' for column in df.columns)
+    placeholders = ", ".join("?" for _ in df.columns)
+    df = integer_keys(df)
+    for start in range(0, len(df), batch_size):
+        with conn:
+            conn.executemany(f'INSERT INTO "{table}" ({columns}) VALUES ({placeholders})', to_records(df.iloc[start:start + batch_size]))
+
+
+def delete_rows(conn, table, keys):
+    """
+        Delete the rows of a table whose key columns match a row of keys, in one transaction.
+        Missing key values match missing values.
+
+        Args:
+            conn (Connection): The SQLite connection (see connect).
+            table (str): The name of the table.
+            keys (DataFrame): The key values of the rows to delete, one column per key column.
+    """
+    # IS compares like =, except that NULL IS NULL is true
+    condition = " AND ".join(f'"{column}" IS ?' for column in keys.columns)
+    with conn:
+        conn.executemany(f'DELETE FROM "{table}" WHERE {condition}', to_records(integer_keys(keys)))
+
+
+def create_indexes(conn, table, indexes):
+    """
+        Index the given columns of a table and update its statistics for the query planner.
+        Building the indexes once after the load is much faster than maintaining them row by row.
+    """
+    with conn:
+        for column in indexes:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table}_{column}" ON "{table}" ("{column}")')
+        conn.execute(f'ANALYZE "{table}"')
+
+
+@instrumented()
+def bulk_load(conn, table, df, indexes=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+        Replace a table with the rows of a DataFrame, loading them in large transactions and creating the indexes afterwards.
+
+        Args:
+            conn (Connection): The SQLite connection (see connect).
+            table (str): The name of the table.
+            df (DataFrame): The rows to load.
+            indexes (list): The columns to index. Defaults to the KEY_COLUMNS present in the table.
+            batch_size (int): The number of rows inserted per transaction.
+    """
+    indexes = [column for column in KEY_COLUMNS if column in df.columns] if indexes is None else indexes
+    create_table(conn, table, df)
+    insert_rows(conn, table, df, batch_size)
+    create_indexes(conn, table, indexes)
+
+
+def load_chunks(conn, table, chunks, indexes=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+        Replace a table with the rows of a frame or of an iterable of frames, yielding every chunk once it is inserted,
+        so the rows can be written to an output in the same pass (see sinks.write_output).
+        The table is created from the first chunk and indexed after the last one, once the chunks are consumed.
+    """
+    created = False
+    for chunk in [chunks] if isinstance(chunks, pd.DataFrame) else chunks:
+        if not created:
+            indexes = [column for column in KEY_COLUMNS if column in chunk.columns] if indexes is None else indexes
+            create_table(conn, table, chunk)
+            created = True
+        insert_rows(conn, table, chunk, batch_size)
+        yield chunk
+    if created:
+        create_indexes(conn, table, indexes)
+
+
+@instrumented()
+def read_table(db_name, table, columns=None, conditions=None, order_by=None, limit=None):
+    """
+        Read rows of a table or view, filtered in SQL so that only the matching rows are loaded.
+
+        Args:
+            db_name (str): The SQLite database file.
+            table (str): The table or view to read.
+            columns (list): The columns to read. Defaults to all columns.
+            conditions (list): (column, operator, value) tuples that all have to hold, e.g. ("total_branch_count", ">", 20).
+                A list or tuple value with the "in" operator matches any of its values.
+            order_by (str): The column to sort by; prefix it with "-" to sort in descending order.
+            limit (int): The maximum number of rows to read.
+
+        Returns:
+            DataFrame: The matching rows.
+    """
+    selected = ", ".join(f'"{column}"' for column in columns) if columns else "*"
+    sql = f'SELECT {selected} FROM "{table}"'
+    params = []
+
+    clauses = []
+    for column, operator, value in conditions or []:
+        if operator == "in":
+            values = list(value)
+            clauses.append(f'"{column}" IN ({", ".join("?" for _ in values)})')
+            params.extend(values)
+        elif operator in OPERATORS:
+            clauses.append(f'"{column}" {operator} ?')
+            params.append(value.item() if isinstance(value, np.generic) else value)
+        else:
+            raise ValueError(f"Unsupported operator {operator}")
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+
+    if order_by:
+        descending = order_by.startswith("-")
+        sql += f' ORDER BY "{order_by.lstrip("-")}"' + (" DESC" if descending else "")
+    if limit is not None:
+        sql += f" LIMIT {int(limit)}"
+
+    conn = connect(db_name)
+    try:
+        return pd.read_sql_query(sql, conn, params=params)
+    finally:
+        conn.close()
+
+
+def iter_table(db_name, table, columns=None, chunksize=DEFAULT_BATCH_SIZE):
+    """
+        Read a table or view in chunks of rows, so that tables larger than memory can be processed in one pass.
+
+        Args:
+            db_name (str): The SQLite database file.
+            table (str): The table or view to read.
+            columns (list): The columns to read. Defaults to all columns.
+            chunksize (int): The number of rows per chunk.
+
+        Yields:
+            DataFrame: The next chunk of rows.
+    """
+    selected = ", ".join(f'"{column}"' for column in columns) if columns else "*"
+    conn = connect(db_name)
+    try:
+        yield from pd.read_sql_query(f'SELECT {selected} FROM "{table}"', conn, chunksize=chunksize)
+    finally:
+        conn.close()
+
+
+def rows_for_tracts(db_name, table, tracts, columns=None, tract_column="census_tract"):
+    """
+        Read the rows of the given census tracts using the tract index.
+    """
+    return read_table(db_name, table, columns, [(tract_column, "in", [int(tract) for tract in tracts])])
+
+
+def has_table(db_name, table):
+    """
+        Whether a database has a table or view of the given name.
+    """
+    conn = connect(db_name)
+    try:
+        return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (table,)).fetchone() is not None
+    finally:
+        conn.close()
+
+
+def rows_for_bank(db_name, table, cert, columns=None, cert_column="CERT_SOD"):
+    """
+        Read the rows of a bank, identified by its FDIC certificate number, using the institution index.
+    """
+    return read_table(db_name, table, columns, [(cert_column, "=", int(cert))])
+
+
+def rows_for_credit_union(db_name, table, site_id, columns=None, site_column="SiteId_NCUA"):
+    """
+        Read the rows of a credit union site, identified by its NCUA site id, using the institution index.
+    """
+    return read_table(db_name, table, columns, [(site_column, "=", int(site_id))])
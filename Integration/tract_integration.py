@@ -0,0 +1,450 @@
+import numpy as np
+import pandas as pd
+import tracemalloc
+from functools import partial
+
+from Integration.delta_ingestion import (
+    TRACT_BRANCH_COUNTS_TABLE, finish_ingestion, in_tracts, plan_ingestion, refresh_branch_counts, refresh_tracts, reset_ingestion,
+    tract_list
+)
+from Integration.partitioning import combine, partition, run_partitions
+from Integration.schema import compact
+from Integration.sinks import DEFAULT_CHUNK_ROWS, write_output
+from Integration.sqlite_store import connect, drop_relation, load_chunks, read_table
+from Pipeline.instrumentation import instrumented, step
+
+# How the sources are integrated (see integrate_sources)
+INTEGRATION_MODES = ["merged", "normalized", "aggregate"]
+
+# Suffixes added to the columns of each source to avoid column name conflicts
+AQ_SUFFIX = "_AQ"
+SOD_SUFFIX = "_SOD"
+NCUA_SUFFIX = "_NCUA"
+
+# Names of the normalized tables; the merged layout is exposed as a view over them
+TRACT_KEYS_TABLE = "Tract_Keys"
+AQ_TABLE = "AirQuality"
+SOD_TABLE = "SOD_Branches"
+NCUA_TABLE = "NCUA_Sites"
+AGGREGATES_TABLE = "Tract_Aggregates"
+
+# The census tract column of every normalized and aggregate table, which an incremental ingestion refreshes their rows by
+TRACT_COLUMNS = {
+    TRACT_KEYS_TABLE: "census_tract",
+    AQ_TABLE: "census_tract" + AQ_SUFFIX,
+    SOD_TABLE: "census_tract" + SOD_SUFFIX,
+    NCUA_TABLE: "census_tract" + NCUA_SUFFIX,
+    AGGREGATES_TABLE: "census_tract",
+}
+
+# Carries the position of every AirQuality row through the merge of a partition, so the merged rows can be put back in order
+AQ_ROW_COLUMN = "_airquality_row"
+
+
+def suffix_sources(df_aq, df_sod, df_ncua):
+    """
+        Rename the NCUA census tract column to match the other sources and add the source suffixes to every column.
+    """
+    df_ncua = df_ncua.rename(columns={"census tract": "census_tract"})
+    return df_aq.add_suffix(AQ_SUFFIX), df_sod.add_suffix(SOD_SUFFIX), df_ncua.add_suffix(NCUA_SUFFIX)
+
+
+def tract_keys(df_aq, df_sod, df_ncua):
+    """
+        Build the tract key table: one row per census tract of the AirQuality data with the number of rows each source has in it.
+        The sources are expected to carry the source suffixes (see suffix_sources).
+        Rows without a census tract count as one more tract, since the merged integration joins them with each other.
+    """
+    aq_rows = df_aq.groupby("census_tract" + AQ_SUFFIX, dropna=False).size()
+    sod_rows = df_sod["census_tract" + SOD_SUFFIX].value_counts(dropna=False)
+    ncua_rows = df_ncua["census_tract" + NCUA_SUFFIX].value_counts(dropna=False)
+
+    keys = pd.DataFrame({
+        "census_tract": aq_rows.index.astype("Int64"),
+        "airquality_rows": aq_rows.to_numpy(),
+        "sod_rows": sod_rows.reindex(aq_rows.index, fill_value=0).to_numpy(dtype="int64"),
+        "ncua_rows": ncua_rows.reindex(aq_rows.index, fill_value=0).to_numpy(dtype="int64"),
+    })
+    return keys
+
+
+@instrumented()
+def integrate_normalized(df_aq, df_sod, df_ncua, filtered=False):
+    """
+        Integrate the three sources without multiplying their rows: each source is kept as its own table,
+        restricted to the census tracts of the AirQuality data, and linked through the tract key table.
+        The size of the result is therefore linear in the size of the inputs.
+
+        Args:
+            df_aq (DataFrame): The AirQuality data with the _AQ suffix.
+            df_sod (DataFrame): The SOD data with the _SOD suffix.
+            df_ncua (DataFrame): The NCUA data with the _NCUA suffix.
+            filtered (bool): Whether to keep only the tracts with at least one bank or credit union branch
+                and drop duplicate rows, as data_integrate_filtered does.
+
+        Returns:
+            dict: The tract key table and the three source tables, keyed by table name.
+    """
+    keys = tract_keys(df_aq, df_sod, df_ncua)
+    if filtered:
+        keys = keys[(keys["sod_rows"] > 0) | (keys["ncua_rows"] > 0)].reset_index(drop=True)
+
+    tracts = tract_list(keys["census_tract"])
+    tables = {
+        TRACT_KEYS_TABLE: keys,
+        AQ_TABLE: in_tracts(df_aq, "census_tract" + AQ_SUFFIX, tracts),
+        SOD_TABLE: in_tracts(df_sod, "census_tract" + SOD_SUFFIX, tracts),
+        NCUA_TABLE: in_tracts(df_ncua, "census_tract" + NCUA_SUFFIX, tracts),
+    }
+    if filtered:
+        tables = {name: table.drop_duplicates() for name, table in tables.items()}
+    return tables
+
+
+@instrumented()
+def tract_aggregates(df_aq, df_sod, df_ncua):
+    """
+        Summarize the three sources per census tract of the AirQuality data, producing one row per tract.
+        The sources are expected to carry the source suffixes (see suffix_sources).
+    """
+    keys = tract_keys(df_aq, df_sod, df_ncua).set_index("census_tract")
+
+    aq = df_aq.groupby("census_tract" + AQ_SUFFIX, dropna=False).agg(
+        mean_arithmetic_mean=("arithmetic_mean" + AQ_SUFFIX, "mean"),
+        max_arithmetic_mean=("arithmetic_mean" + AQ_SUFFIX, "max"),
+    )
+    sod = df_sod.groupby("census_tract" + SOD_SUFFIX, dropna=False).agg(
+        unique_bank_count=("CERT" + SOD_SUFFIX, "nunique"),
+        total_deposits=("DEPSUMBR" + SOD_SUFFIX, "sum"),
+    )
+    ncua = df_ncua.groupby("census_tract" + NCUA_SUFFIX, dropna=False).agg(
+        unique_creditunion_count=("SiteId" + NCUA_SUFFIX, "nunique"),
+    )
+
+    aggregates = keys.join(aq).join(sod).join(ncua)
+    counts = ["unique_bank_count", "unique_creditunion_count", "total_deposits"]
+    aggregates[counts] = aggregates[counts].fillna(0).astype("int64")
+    return aggregates.reset_index()
+
+
+def partition_sources(df_aq, df_sod, df_ncua):
+    """
+        Shard the suffixed sources by the state of their census tracts (see partitioning.partition).
+        The AirQuality rows are indexed by their position, so the merged rows can be put back in their order.
+    """
+    return partition(
+        [df_aq.reset_index(drop=True), df_sod, df_ncua],
+        ["census_tract" + AQ_SUFFIX, "census_tract" + SOD_SUFFIX, "census_tract" + NCUA_SUFFIX],
+    )
+
+
+def restrict_sources(df_aq, df_sod, df_ncua, tracts):
+    """
+        The rows of the suffixed sources in the given census tracts, e.g. the dirty tracts of an incremental ingestion.
+        Every tract is integrated from its own rows only, so integrating the restricted sources recalculates those tracts.
+    """
+    return (
+        in_tracts(df_aq, "census_tract" + AQ_SUFFIX, tracts),
+        in_tracts(df_sod, "census_tract" + SOD_SUFFIX, tracts),
+        in_tracts(df_ncua, "census_tract" + NCUA_SUFFIX, tracts),
+    )
+
+
+def merge_partition(integrate, df_aq, df_sod, df_ncua):
+    """
+        Run a merged integration over the sources of one partition.
+        The merged rows are indexed by the position of their AirQuality row.
+    """
+    merged = integrate(df_aq.assign(**{AQ_ROW_COLUMN: df_aq.index}), df_sod, df_ncua)
+    return merged.set_index(AQ_ROW_COLUMN).rename_axis(None)
+
+
+@instrumented()
+def merged_by_state(integrate, df_aq, df_sod, df_ncua, workers, deduplicate=False):
+    """
+        Run a merged integration (e.g. integrate_merged of data_integrate_all) separately for every state in a process pool
+        and combine the partitions into the rows of a single-process run, in the same order.
+        Every AirQuality row is only merged with the rows of its own census tract, so the partitions are independent.
+
+        Args:
+            integrate (callable): The picklable merge function, taking the suffixed AirQuality, SOD and NCUA frames.
+            df_aq (DataFrame): The AirQuality data with the _AQ suffix.
+            df_sod (DataFrame): The SOD data with the _SOD suffix.
+            df_ncua (DataFrame): The NCUA data with the _NCUA suffix.
+            workers (int): The number of worker processes.
+            deduplicate (bool): Whether integrate drops duplicate rows, which is then repeated over the combined rows
+                because the position that orders them makes every row of a partition unique.
+
+        Returns:
+            DataFrame: The merged rows.
+    """
+    partials = run_partitions(partial(merge_partition, integrate), partition_sources(df_aq, df_sod, df_ncua), workers)
+    merged = combine(list(partials.values()), ordered=True)
+    if deduplicate:
+        merged = merged.drop_duplicates()
+    return merged.reset_index(drop=True)
+
+
+def merge_dtypes(left_keys, df_right, right_on):
+    """
+        The right frame of a left merge, with the dtypes the merge of all the left keys gives its columns.
+        When a left key has no match (missing keys match missing keys), pandas turns NumPy integer columns into floats
+        and boolean columns into objects; doing so up front gives the merge of every slice of the left rows the same dtypes.
+    """
+    right_keys = df_right[right_on]
+    matched = left_keys.isin(right_keys) | (left_keys.isna() & right_keys.isna().any())
+    if matched.all():
+        return df_right
+    widened = {
+        column: "float64" if dtype.kind in "iu" else object
+        for column, dtype in df_right.dtypes.items() if isinstance(dtype, np.dtype) and dtype.kind in "iub"
+    }
+    return df_right.astype(widened)
+
+
+def merged_chunks(integrate, df_aq, df_sod, df_ncua, chunk_rows=DEFAULT_CHUNK_ROWS, deduplicate=False):
+    """
+        Run a merged integration over slices of the AirQuality rows and yield the merged rows of every slice, so the merged
+        rows are produced as they are written instead of all at once. Together the chunks hold the rows of a single merge,
+        in the same order and with the same dtypes: a left merge keeps the order of its left rows, and every AirQuality row
+        is only merged with the rows of its own census tract.
+
+        Args:
+            integrate (callable): The merge function, taking the suffixed AirQuality, SOD and NCUA frames.
+            df_aq (DataFrame): The AirQuality data with the _AQ suffix.
+            df_sod (DataFrame): The SOD data with the _SOD suffix.
+            df_ncua (DataFrame): The NCUA data with the _NCUA suffix.
+            chunk_rows (int): The number of AirQuality rows merged at a time.
+            deduplicate (bool): Whether integrate drops duplicate rows, which is then repeated across the chunks
+                by the hashes of the rows already yielded.
+    """
+    aq_tract = df_aq["census_tract" + AQ_SUFFIX]
+    df_sod = merge_dtypes(aq_tract, df_sod, "census_tract" + SOD_SUFFIX)
+    df_ncua = merge_dtypes(aq_tract, df_ncua, "census_tract" + NCUA_SUFFIX)
+
+    seen = set()
+    # An empty AirQuality sheet still yields one empty chunk, which defines the columns
+    for start in range(0, max(len(df_aq), 1), chunk_rows):
+        merged = integrate(df_aq.iloc[start:start + chunk_rows], df_sod, df_ncua)
+        if deduplicate:
+            hashes = pd.util.hash_pandas_object(merged, index=False)
+            keep = ~hashes.duplicated() & ~hashes.map(seen.__contains__).astype(bool)
+            seen.update(hashes[keep])
+            merged = merged[keep.to_numpy()]
+        yield merged.reset_index(drop=True)
+
+
+@instrumented()
+def normalized_by_state(df_aq, df_sod, df_ncua, workers, filtered=False):
+    """
+        Run integrate_normalized separately for every state in a process pool and combine the partitions
+        into the tables of a single-process run, with the same rows in the same order.
+    """
+    partials = run_partitions(partial(integrate_normalized, filtered=filtered), partition_sources(df_aq, df_sod, df_ncua), workers)
+    return {
+        name: combine([tables[name] for tables in partials.values()], ordered=name != TRACT_KEYS_TABLE)
+        for name in (TRACT_KEYS_TABLE, AQ_TABLE, SOD_TABLE, NCUA_TABLE)
+    }
+
+
+@instrumented()
+def aggregates_by_state(df_aq, df_sod, df_ncua, workers):
+    """
+        Run tract_aggregates separately for every state in a process pool and combine the partitions
+        into the rows of a single-process run, sorted by census tract.
+    """
+    partials = run_partitions(tract_aggregates, partition_sources(df_aq, df_sod, df_ncua), workers)
+    return combine(list(partials.values()))
+
+
+def create_merged_view(conn, view_name, tables, filtered=False):
+    """
+        Create a view that presents the normalized tables in the layout of the merged integration,
+        so existing queries keep working while the rows are only multiplied when they are read.
+        The tracts are joined with IS, so rows without a census tract are joined with each other like the merge does.
+    """
+    aq, sod, ncua = tables[AQ_TABLE], tables[SOD_TABLE], tables[NCUA_TABLE]
+    aq_tract, sod_tract, ncua_tract = "census_tract" + AQ_SUFFIX, "census_tract" + SOD_SUFFIX, "census_tract" + NCUA_SUFFIX
+
+    def columns(alias, df, skip=()):
+        return [f'{alias}."{column}"' for column in df.columns if column not in skip]
+
+    if filtered:
+        # Same layout as data_integrate_filtered: the AirQuality tract first as census_tract, the other tract columns dropped
+        selected = [f'a."{aq_tract}" AS census_tract'] + columns("a", aq, [aq_tract]) + columns("s", sod, [sod_tract]) + columns("n", ncua, [ncua_tract])
+    else:
+        selected = columns("a", aq) + columns("s", sod) + columns("n", ncua)
+
+    drop_relation(conn, view_name)
+    conn.execute(
+        f'CREATE VIEW "{view_name}" AS SELECT {", ".join(selected)} '
+        f'FROM "{AQ_TABLE}" a '
+        f'LEFT JOIN "{SOD_TABLE}" s ON s."{sod_tract}" IS a."{aq_tract}" '
+        f'LEFT JOIN "{NCUA_TABLE}" n ON n."{ncua_tract}" IS a."{aq_tract}"'
+    )
+    conn.commit()
+
+
+def mode_relations(mode, view_name):
+    """
+        The tables and views an integration mode stores the integrated data in (see integrated_tables and create_merged_view).
+    """
+    if mode == "merged":
+        return [view_name]
+    if mode == "normalized":
+        return [TRACT_KEYS_TABLE, AQ_TABLE, SOD_TABLE, NCUA_TABLE, view_name]
+    if mode == "aggregate":
+        return [AGGREGATES_TABLE]
+    raise ValueError(f"Unknown integration mode {mode}, expected one of {INTEGRATION_MODES}")
+
+
+def measure(function, *args, **kwargs):
+    """
+        Call a function and return its result together with the peak memory (in bytes) allocated during the call.
+    """
+    tracemalloc.start()
+    try:
+        result = function(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def print_comparison(stats):
+    """
+        Print the row counts and peak memory of the integration modes side by side.
+
+        Args:
+            stats (dict): The (rows, peak bytes) of each integration mode, keyed by mode name.
+    """
+    print("\nIntegration mode comparison:")
+    print(f"  {'mode':<12}{'rows':>12}{'peak memory (MB)':>20}")
+    for mode, (rows, peak) in stats.items():
+        print(f"  {mode:<12}{rows:>12,}{peak / 1024 ** 2:>20.1f}")
+
+
+def integrated_tables(mode, integrate, view_name, df_aq, df_sod, df_ncua, workers=0, filtered=False, stream=False):
+    """
+        Integrate the suffixed sources in the given mode (see integrate_sources) into the tables the mode stores, keyed by table name.
+        With stream, the merged rows of a single process are a generator of chunks (see merged_chunks) instead of a frame.
+    """
+    if mode == "merged":
+        if workers:
+            return {view_name: merged_by_state(integrate, df_aq, df_sod, df_ncua, workers, deduplicate=filtered)}
+        if stream:
+            return {view_name: merged_chunks(integrate, df_aq, df_sod, df_ncua, deduplicate=filtered)}
+        return {view_name: integrate(df_aq, df_sod, df_ncua)}
+    if mode == "normalized":
+        # Keep each source once and let the merged view join them on demand
+        if workers:
+            return normalized_by_state(df_aq, df_sod, df_ncua, workers, filtered=filtered)
+        return integrate_normalized(df_aq, df_sod, df_ncua, filtered=filtered)
+    if mode == "aggregate":
+        if workers:
+            aggregates = aggregates_by_state(df_aq, df_sod, df_ncua, workers)
+        else:
+            aggregates = tract_aggregates(df_aq, df_sod, df_ncua)
+        if filtered:
+            aggregates = aggregates[(aggregates["sod_rows"] > 0) | (aggregates["ncua_rows"] > 0)]
+        return {AGGREGATES_TABLE: aggregates}
+    raise ValueError(f"Unknown integration mode {mode}, expected one of {INTEGRATION_MODES}")
+
+
+def compare_modes(integrate, df_aq, df_sod, df_ncua, filtered=False):
+    """
+        Run every integration mode over the suffixed sources and print their row counts and peak memory (see print_comparison).
+    """
+    merged, merged_peak = measure(integrate, df_aq, df_sod, df_ncua)
+    normalized, normalized_peak = measure(integrate_normalized, df_aq, df_sod, df_ncua, filtered=filtered)
+    aggregates, aggregates_peak = measure(tract_aggregates, df_aq, df_sod, df_ncua)
+    print_comparison({
+        "merged": (len(merged), merged_peak),
+        "normalized": (sum(len(table) for table in normalized.values()), normalized_peak),
+        "aggregate": (len(aggregates), aggregates_peak),
+    })
+
+
+def integrate_sources(db_name, view_name, integrate, output_stem, script, df_aq, df_sod, df_ncua,
+                      mode="merged", compare=False, workers=0, format=None, incremental=False, filtered=False):
+    """
+        Integrate the AirQuality, SOD and NCUA sheets into a database and write the integrated tables to a stage output.
+        This is the shared body of data_integrate_all and data_integrate_filtered.
+
+        Args:
+            db_name (str): The SQLite database the integrated tables are stored in.
+            view_name (str): The table (or view, in the normalized mode) holding the merged rows.
+            integrate (callable): The picklable merge function of the stage, taking the suffixed AirQuality, SOD and NCUA frames.
+            output_stem (str): The path of the output without the extension of the format.
+            script (str): The stage script, whose code is part of the state of an incremental ingestion.
+            df_aq (DataFrame): The AirQuality sheet.
+            df_sod (DataFrame): The SOD sheet.
+            df_ncua (DataFrame): The NCUA sheet.
+            mode (str): "merged" stores the merged rows of the three sources, "normalized" stores each source once
+                with a tract key table and exposes the merged rows as a view, and "aggregate" stores one row per tract.
+            compare (bool): Whether to report the row count and peak memory of every mode.
+            workers (int): The number of worker processes to partition the integration by state over. 0 integrates in this process.
+            format (str): The format of the output (see sinks.output_format).
+            incremental (bool): Whether to only integrate the census tracts whose SOD or NCUA rows changed since the previous
+                incremental run and replace them in the database (see delta_ingestion.plan_ingestion).
+            filtered (bool): Whether to keep only the tracts with a bank or credit union branch, with the AirQuality tract
+                as census_tract, as data_integrate_filtered does.
+
+        Returns:
+            str: The path of the output.
+    """
+    if mode not in INTEGRATION_MODES:
+        raise ValueError(f"Unknown integration mode {mode}, expected one of {INTEGRATION_MODES}")
+    tract_column = "census_tract" if filtered else "census_tract" + AQ_SUFFIX
+    conn = connect(db_name)
+
+    # Diff the SOD and NCUA sheets against the snapshots of the previous incremental run
+    ingestion = plan_ingestion(conn, mode, df_aq, {"SOD": df_sod, "NCUA": df_ncua}, script) if incremental else None
+    if ingestion is None or ingestion.rebuild:
+        reset_ingestion(conn)
+        # Drop what another mode stored before, so the database never holds rows of a previous integration
+        stored = mode_relations(mode, view_name)
+        for other in INTEGRATION_MODES:
+            for name in mode_relations(other, view_name):
+                if name not in stored:
+                    drop_relation(conn, name)
+
+    # Rename columns to avoid SQL syntax errors and add suffixes to the columns to avoid column name conflicts
+    df_aq, df_sod, df_ncua = suffix_sources(df_aq, df_sod, df_ncua)
+
+    if compare:
+        compare_modes(integrate, df_aq, df_sod, df_ncua, filtered)
+
+    if ingestion is None or ingestion.rebuild:
+        tracts = None
+        tables = integrated_tables(mode, integrate, view_name, df_aq, df_sod, df_ncua, workers, filtered, stream=True)
+        # Every table is loaded into the database while it is written to the output, so the streamed rows are only produced once
+        with step("write_output"):
+            output_file = write_output({name: load_chunks(conn, name, table) for name, table in tables.items()}, output_stem, format)
+        if mode == "normalized":
+            create_merged_view(conn, view_name, tables, filtered=filtered)
+    else:
+        # Only the census tracts with changed SOD or NCUA rows are integrated again and replaced in the database
+        tracts = ingestion.dirty_tracts
+        tables = integrated_tables(mode, integrate, view_name, *restrict_sources(df_aq, df_sod, df_ncua, tracts), filtered=filtered)
+        refresh_tracts(conn, tables, dict(TRACT_COLUMNS, **{view_name: tract_column}), tracts)
+
+    # The unique banks and credit unions of every tract, which the branch density scripts read instead of counting them
+    if mode == "aggregate":
+        drop_relation(conn, TRACT_BRANCH_COUNTS_TABLE)
+    else:
+        refresh_branch_counts(conn, view_name, tract_column, "CERT" + SOD_SUFFIX, "SiteId" + NCUA_SUFFIX, tracts)
+    if ingestion is not None:
+        finish_ingestion(conn, ingestion)
+    conn.close()
+
+    if tracts is not None:
+        # The output holds every tract, so it is written from the updated tables in the database
+        with step("read_tables") as record:
+            tables = {name: compact(read_table(db_name, name), name=name) for name in tables}
+            record.rows_out = sum(len(table) for table in tables.values())
+        with step("write_output", rows_in=record.rows_out):
+            output_file = write_output(tables, output_stem, format)
+    if mode != "normalized":
+        print(read_table(db_name, next(iter(tables)), limit=5))
+    return output_file
@@ -0,0 +1,136 @@
+import pandas as pd
+import os
+import json
+import shutil
+import hashlib
+from uuid import uuid4
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from Integration.schema import compact
+from Pipeline.instrumentation import instrumented
+
+CASE_STUDY_FILE = "20241125 Case Study for Position SE_Data (1).xlsx"
+CASE_STUDY_SHEETS = ["AirQuality_EPA_IL", "SOD_IL_2024", "NCUA_IL_Q2_2024"]
+
+# The cache lives next to the working directory the pipeline scripts are run from
+DEFAULT_CACHE_DIR = ".workbook_cache"
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """
+        Calculate the SHA-256 hash of a file's content, reading it in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def workbook_key(workbook, cache_dir):
+    """
+        Return the content hash of the workbook.
+        The hash is remembered together with the file's size and modification time, so an unchanged
+        workbook is not re-read on every load; any change to the file triggers a new hash.
+    """
+    stat = os.stat(workbook)
+    stamp = {"path": os.path.abspath(workbook), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    stamp_file = os.path.join(cache_dir, "source.json")
+
+    if os.path.exists(stamp_file):
+        with open(stamp_file) as file:
+            stamps = json.load(file)
+        for saved in stamps:
+            if {k: saved[k] for k in stamp} == stamp:
+                return saved["hash"]
+    else:
+        stamps = []
+
+    stamp["hash"] = file_hash(workbook)
+    stamps = [saved for saved in stamps if saved["path"] != stamp["path"]] + [stamp]
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Replace the stamps in one step so a concurrent reader never sees a half-written file
+    tmp_file = f"{stamp_file}.{os.getpid()}.{uuid4().hex}.tmp"
+    with open(tmp_file, "w") as file:
+        json.dump(stamps, file)
+    os.replace(tmp_file, stamp_file)
+    return stamp["hash"]
+
+
+def to_arrow(df):
+    """
+        Convert a sheet to an Arrow table.
+        Excel columns that mix types (e.g. dates and text) cannot be stored in a typed column,
+        so they are stored as strings with missing values kept as nulls.
+    """
+    for column in df.columns:
+        if df[column].dtype == object and pd.api.types.infer_dtype(df[column], skipna=True).startswith("mixed"):
+            df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def build_cache(workbook, sheet_dir):
+    """
+        Parse every sheet of the workbook once and write each one as an uncompressed Feather (Arrow IPC) file.
+        Uncompressed files can be memory-mapped, so later loads only touch the columns that are requested.
+    """
+    sheets = pd.read_excel(workbook, sheet_name=None)
+
+    # Every process builds into its own directory, so concurrent builds of a cold cache never touch each other's files
+    tmp_dir = f"{sheet_dir}.{os.getpid()}.{uuid4().hex}.tmp"
+    os.makedirs(tmp_dir)
+    for sheet_name, df in sheets.items():
+        feather.write_feather(to_arrow(df), os.path.join(tmp_dir, f"{sheet_name}.arrow"), compression="uncompressed")
+
+    # Publish the whole directory at once so a concurrent reader never sees a partial cache
+    try:
+        os.rename(tmp_dir, sheet_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+@instrumented()
+def read_sheet(sheet_name, columns=None, workbook=CASE_STUDY_FILE, cache_dir=DEFAULT_CACHE_DIR, compact_dtypes=True):
+    """
+        Load a sheet of the case study workbook from the columnar cache, building the cache if needed.
+
+        Args:
+            sheet_name (str): The name of the sheet, e.g. "SOD_IL_2024".
+            columns (list): The columns to load. Defaults to all columns of the sheet.
+            workbook (str): The Excel workbook the sheet is read from.
+            cache_dir (str): The directory holding the cached sheets.
+            compact_dtypes (bool): Whether to convert the columns to the compact dtypes of the schema (see schema.compact).
+
+        Returns:
+            DataFrame: The requested columns of the sheet.
+    """
+    key = workbook_key(workbook, cache_dir)
+    sheet_dir = os.path.join(cache_dir, key[:16])
+
+    if not os.path.isdir(sheet_dir):
+        build_cache(workbook, sheet_dir)
+        prune_cache(cache_dir, keep=key[:16])
+
+    sheet_file = os.path.join(sheet_dir, f"{sheet_name}.arrow")
+    if not os.path.exists(sheet_file):
+        raise ValueError(f"Worksheet named '{sheet_name}' not found in {workbook}")
+
+    table = feather.read_table(sheet_file, columns=list(columns) if columns is not None else None, memory_map=True)
+    df = table.to_pandas()
+    return compact(df, name=sheet_name) if compact_dtypes else df
+
+
+def prune_cache(cache_dir, keep):
+    """
+        Remove the cached sheets of older versions of the workbooks, keeping the given version.
+        Directories that are still being built for a live version are kept as well.
+    """
+    with open(os.path.join(cache_dir, "source.json")) as file:
+        live = {saved["hash"][:16] for saved in json.load(file)} | {keep}
+
+    for entry in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, entry)
+        if os.path.isdir(path) and entry.split(".")[0] not in live:
+            shutil.rmtree(path, ignore_errors=True)
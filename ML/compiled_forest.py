@@ -0,0 +1,251 @@
+import os
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b"RFOREST1"
+
+# Arrays are aligned so that every memory-mapped view starts on a cache line
+ALIGNMENT = 64
+
+# Rows evaluated at a time; bounds the (rows x trees) node matrix of the evaluator
+BATCH_ROWS = 1024
+
+NODE_ARRAYS = {
+    "feature": "<i4",
+    "threshold": "<f8",
+    "left": "<i4",
+    "value": "<f8",
+    "roots": "<i4",
+}
+
+
+def breadth_first(tree):
+    """
+        Order the nodes of a tree so that the two children of every node are adjacent.
+
+        Returns:
+            array: The original node of every position in the new order.
+    """
+    order = [0]
+    for node in order:
+        if tree.children_left[node] != -1:
+            order.extend([tree.children_left[node], tree.children_right[node]])
+    return np.array(order)
+
+
+def flatten_trees(estimators):
+    """
+        Concatenate the nodes of fitted sklearn regression trees into contiguous arrays.
+
+        The nodes are laid out so that the right child of every node directly follows its left child, and child indexes
+        are absolute, so a step down the tree is a single "left child + (feature > threshold)". Every leaf points to itself
+        with a +inf threshold on feature 0, so a traversal can take the same number of steps for every row and tree
+        without checking for leaves.
+
+        Returns:
+            dict: The feature, threshold, left, value and roots arrays, and the maximum tree depth.
+    """
+    arrays = {name: [] for name in NODE_ARRAYS}
+    offset = 0
+    max_depth = 0
+    for estimator in estimators:
+        tree = estimator.tree_
+        order = breadth_first(tree)
+        position = np.empty(tree.node_count, dtype="int64")
+        position[order] = np.arange(tree.node_count)
+        leaf = tree.children_left[order] == -1
+
+        arrays["feature"].append(np.where(leaf, 0, tree.feature[order]))
+        arrays["threshold"].append(np.where(leaf, np.inf, tree.threshold[order]))
+        arrays["left"].append(np.where(leaf, np.arange(tree.node_count), position[np.maximum(tree.children_left[order], 0)]) + offset)
+        arrays["value"].append(tree.value[order, 0, 0])
+        arrays["roots"].append([offset])
+
+        offset += tree.node_count
+        max_depth = max(max_depth, tree.max_depth)
+
+    flat = {name: np.ascontiguousarray(np.concatenate(values), dtype=NODE_ARRAYS[name]) for name, values in arrays.items()}
+    return flat, max_depth
+
+
+# The models that can be compiled: forests average their trees, and a single tree is a forest of one
+FOREST_MODELS = ("RandomForestRegressor", "ExtraTreesRegressor")
+TREE_MODELS = ("DecisionTreeRegressor", "ExtraTreeRegressor")
+
+# How far the compiled predictions may differ from sklearn's, which sum the trees in a different order
+RTOL = 1e-9
+ATOL = 1e-9
+
+
+def is_forest(model):
+    """
+        Whether a model can be compiled, i.e. is a random forest or decision tree regressor.
+        Boosted models are not supported: their trees predict gradients that are combined with a learning rate and an initial estimate.
+    """
+    return type(model).__name__ in FOREST_MODELS + TREE_MODELS
+
+
+def forest_estimators(model):
+    """
+        Return the trees of a fitted random forest or decision tree regressor (see is_forest).
+    """
+    if not is_forest(model):
+        raise TypeError(f"Cannot compile a {type(model).__name__}, only random forests and decision trees")
+    return list(model.estimators_) if type(model).__name__ in FOREST_MODELS else [model]
+
+
+def compile_forest(model, path, features=None, target=None, scaler=None, source=None):
+    """
+        Save a fitted forest as flat node arrays in one memory-mappable file.
+
+        Args:
+            model: A fitted RandomForestRegressor, ExtraTreesRegressor or DecisionTreeRegressor.
+            path (str): The file to write.
+            features (list): The feature order the model was trained with.
+            target (str): The column the model predicts.
+            scaler: The fitted StandardScaler the features were standardized with, if any. Its mean and scale are stored
+                so that the compiled file can be used without unpickling anything.
+            source (str): An identifier of the model the file was compiled from, e.g. the hash of its pickle.
+    """
+    arrays, max_depth = flatten_trees(forest_estimators(model))
+
+    header = {
+        "n_trees": len(arrays["roots"]),
+        "n_features": int(model.n_features_in_),
+        "max_depth": int(max_depth),
+        "features": list(features) if features is not None else None,
+        "target": target,
+        "scaler_mean": scaler.mean_.tolist() if scaler is not None and scaler.with_mean else None,
+        "scaler_scale": scaler.scale_.tolist() if scaler is not None and scaler.with_std else None,
+        "source": source,
+        "arrays": {},
+    }
+
+    # The array offsets depend on the header length, so lay out the arrays after a header of the final size
+    layout_size = 0
+    while True:
+        offset = align(len(MAGIC) + 8 + layout_size)
+        for name, values in arrays.items():
+            header["arrays"][name] = [values.dtype.str, len(values), offset]
+            offset = align(offset + values.nbytes)
+        encoded = json.dumps(header).encode("utf-8")
+        if len(encoded) <= layout_size:
+            break
+        layout_size = len(encoded) + 64
+
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(MAGIC + struct.pack("<Q", layout_size) + encoded.ljust(layout_size))
+        for name, values in arrays.items():
+            file.seek(header["arrays"][name][2])
+            file.write(values.tobytes())
+    os.replace(temporary, path)
+
+
+def verify_forest(model, path, X):
+    """
+        Check that a compiled forest predicts what the model it was compiled from predicts, on the rows of X
+        (e.g. the training data, in the scaled features the model takes).
+
+        Raises:
+            ValueError: If a prediction differs by more than the tolerance (see RTOL and ATOL).
+    """
+    expected = model.predict(X)
+    compiled = CompiledForest(path).predict(X)
+    mismatched = ~np.isclose(compiled, expected, rtol=RTOL, atol=ATOL)
+    if mismatched.any():
+        worst = np.abs(compiled - expected).max()
+        raise ValueError(f"The compiled forest {path} differs from the model on {mismatched.sum()} of {len(X)} rows (by up to {worst})")
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def read_header(path):
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a compiled forest")
+        size, = struct.unpack("<Q", file.read(8))
+        return json.loads(file.read(size))
+
+
+class StandardScaling:
+    """
+        The transform of a fitted StandardScaler from its stored mean and scale.
+    """
+
+    def __init__(self, mean=None, scale=None):
+        self.mean = None if mean is None else np.asarray(mean)
+        self.scale = None if scale is None else np.asarray(scale)
+
+    def transform(self, X):
+        X = np.array(X, dtype="float64")
+        if self.mean is not None:
+            X -= self.mean
+        if self.scale is not None:
+            X /= self.scale
+        return X
+
+
+class CompiledForest:
+    """
+        A random forest evaluated directly from the flat node arrays of a compiled file.
+
+        The arrays are memory-mapped read-only, so loading takes no time regardless of the forest size,
+        and every process that loads the same file shares its pages through the page cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = read_header(path)
+        self.n_features_in_ = self.header["n_features"]
+        self.max_depth = self.header["max_depth"]
+        for name, (dtype, length, offset) in self.header["arrays"].items():
+            setattr(self, name, np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(length,)))
+
+    @property
+    def features(self):
+        return self.header["features"]
+
+    @property
+    def target(self):
+        return self.header["target"]
+
+    @property
+    def source(self):
+        return self.header["source"]
+
+    def scaler(self):
+        if self.header["scaler_mean"] is None and self.header["scaler_scale"] is None:
+            return None
+        return StandardScaling(self.header["scaler_mean"], self.header["scaler_scale"])
+
+    def predict(self, X):
+        """
+            Predict a batch of rows by walking every tree for every distinct row at once, one level per step.
+        """
+        # sklearn compares the features as float32 with float64 thresholds; do the same so that the splits agree
+        X = np.asarray(X, dtype="float32").astype("float64")
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(f"Expected a matrix with {self.n_features_in_} features")
+        if np.isnan(X).any():
+            raise ValueError("Cannot predict rows with missing features")
+
+        # Identical rows take identical paths, so each distinct row is only evaluated once
+        X, inverse = np.unique(X, axis=0, return_inverse=True)
+
+        predictions = np.empty(len(X))
+        for start in range(0, len(X), BATCH_ROWS):
+            rows = X[start:start + BATCH_ROWS]
+            # Index the features of all rows through one flat array: row offset + feature of the current node
+            values = rows.ravel()
+            row_offsets = (np.arange(len(rows)) * rows.shape[1])[:, None]
+            nodes = np.repeat(self.roots[None, :], len(rows), axis=0)
+            for _ in range(self.max_depth):
+                go_right = values[row_offsets + self.feature[nodes]] > self.threshold[nodes]
+                nodes = self.left[nodes] + go_right
+            predictions[start:start + len(rows)] = self.value[nodes].mean(axis=1)
+        return predictions[inverse.reshape(-1)]
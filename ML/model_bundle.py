@@ -0,0 +1,211 @@
+import os
+import pickle
+import threading
+
+import numpy as np
+import pandas as pd
+
+from Integration.sinks import write_output
+from Integration.workbook_cache import file_hash
+from ML.compiled_forest import CompiledForest, compile_forest, is_forest, verify_forest
+from ML.prediction_table import PredictionTable
+from Pipeline.instrumentation import instrumented
+
+# The features the PM2.5 models are trained on, in training order, and their target
+FEATURES = ["unique_bank_count", "unique_creditunion_count", "total_branch_count"]
+TARGET = "mean_pm25_concentration"
+
+MODEL_FILE = "random_forest_model.pkl"
+
+# The table of the prediction outputs written by predict_file
+PREDICTIONS_TABLE = "Predictions"
+
+
+def compiled_path(model_file):
+    """
+        Return the path of the compiled forest saved next to a model bundle (see compiled_forest.py).
+    """
+    return os.path.splitext(model_file)[0] + ".forest"
+
+
+def table_path(model_file):
+    """
+        Return the path of the prediction table saved next to a model bundle (see prediction_table.py).
+    """
+    return os.path.splitext(model_file)[0] + ".table.npz"
+
+
+@instrumented()
+def save_bundle(model_file, model, scaler, features=FEATURES, target=TARGET, table_range=None, check_rows=None):
+    """
+        Save a trained model together with the scaler its features were standardized with and the feature order,
+        so that predictions apply exactly the transformation the model was trained on.
+        Forests are also compiled to flat arrays next to the bundle, which prediction processes load instead of the pickle.
+
+        Args:
+            check_rows (array): Rows of scaled features (e.g. the training data) the compiled forest has to predict like the model;
+                a compiled forest that does not is removed and an error raised (see compiled_forest.verify_forest).
+            table_range (tuple): The largest (bank, credit union) counts to precompute a prediction table for,
+                e.g. the largest counts in the training data. No table is saved if not given.
+    """
+    with open(model_file, "wb") as file:
+        pickle.dump({"model": model, "scaler": scaler, "features": list(features), "target": target}, file)
+    source = file_hash(model_file)
+
+    if is_forest(model):
+        compile_forest(model, compiled_path(model_file), features, target, scaler, source=source)
+        if check_rows is not None:
+            try:
+                verify_forest(model, compiled_path(model_file), check_rows)
+            except ValueError:
+                # Prediction processes would otherwise load the compiled forest instead of the model
+                os.remove(compiled_path(model_file))
+                raise
+
+    if table_range is not None and PredictionTable.supports(features):
+        bundle = ModelBundle(model, scaler, features, target)
+        PredictionTable.build(bundle.predict_model, bundle.features, *table_range, source=source).save(table_path(model_file))
+
+
+def load_compiled(model_file, source):
+    """
+        Load the compiled forest of a model bundle, if it exists and was compiled from the current bundle.
+    """
+    path = compiled_path(model_file)
+    if not os.path.exists(path):
+        return None
+    forest = CompiledForest(path)
+    if forest.source != source:
+        return None
+    return ModelBundle(forest, forest.scaler(), forest.features, forest.target)
+
+
+def load_table(model_file, source):
+    """
+        Load the prediction table of a model bundle, if it exists and was built from the current bundle.
+    """
+    path = table_path(model_file)
+    if not os.path.exists(path):
+        return None
+    table = PredictionTable.load(path)
+    return table if table.source == source else None
+
+
+def feature_matrix(frame, features=FEATURES):
+    """
+        Select the features of a frame in training order as a float matrix.
+        The total branch count is derived from the bank and credit union counts when it is missing.
+    """
+    if "total_branch_count" in features and "total_branch_count" not in frame:
+        frame = frame.assign(total_branch_count=frame["unique_bank_count"] + frame["unique_creditunion_count"])
+    return frame[features].to_numpy(dtype="float64")
+
+
+class ModelBundle:
+    """
+        A trained model with its scaler and feature order, loaded once and shared by every prediction.
+    """
+
+    def __init__(self, model, scaler=None, features=FEATURES, target=TARGET, table=None):
+        self.model = model
+        self.scaler = scaler
+        self.features = list(features)
+        self.target = target
+        self.table = table
+
+    def predict_model(self, X):
+        """
+            Predict from a feature matrix in the bundle's feature order by evaluating the model.
+        """
+        if self.scaler is not None:
+            X = self.scaler.transform(X)
+        return self.model.predict(X)
+
+    def predict_matrix(self, X):
+        """
+            Predict from a feature matrix in the bundle's feature order.
+            Rows inside the prediction table are looked up; only the other rows are evaluated by the model.
+        """
+        if self.table is None:
+            return self.predict_model(X)
+        predictions, missing = self.table.lookup(X, self.features)
+        if missing.any():
+            predictions[missing] = self.predict_model(np.asarray(X, dtype="float64")[missing])
+        return predictions
+
+    def predict(self, frame):
+        """
+            Predict from a frame with the bundle's features (see feature_matrix).
+        """
+        return self.predict_matrix(feature_matrix(frame, self.features))
+
+
+_bundles = {}
+_bundles_lock = threading.Lock()
+
+
+def load_bundle(model_file=MODEL_FILE):
+    """
+        Load a model bundle, reusing the loaded bundle until the file changes.
+        The compiled forest and prediction table saved with the bundle are used when they are up to date,
+        so the pickle does not have to be unpickled.
+        A file with a bare model (saved before bundles) is loaded without a scaler, predicting on the raw features as before.
+    """
+    stat = os.stat(model_file)
+    key = (os.path.abspath(model_file), stat.st_size, stat.st_mtime_ns)
+    with _bundles_lock:
+        if key not in _bundles:
+            source = file_hash(model_file)
+            bundle = load_compiled(model_file, source) or load_pickled(model_file)
+            bundle.table = load_table(model_file, source)
+            _bundles.clear()
+            _bundles[key] = bundle
+        return _bundles[key]
+
+
+def load_pickled(model_file):
+    with open(model_file, "rb") as file:
+        saved = pickle.load(file)
+    if isinstance(saved, dict):
+        return ModelBundle(saved["model"], saved.get("scaler"), saved.get("features", FEATURES), saved.get("target", TARGET))
+    return ModelBundle(saved)
+
+
+def predicted_chunks(bundle, input_file, chunksize=100_000):
+    """
+        Predict a CSV file chunk by chunk, yielding the predictions of every chunk as a frame with the target column,
+        so memory use does not grow with the size of the file. A file without rows yields one empty frame.
+    """
+    columns = set(bundle.features) | {"unique_bank_count", "unique_creditunion_count"}
+    empty = True
+    for chunk in pd.read_csv(input_file, chunksize=chunksize, usecols=lambda column: column in columns):
+        if chunk.empty:
+            continue
+        empty = False
+        yield pd.DataFrame({bundle.target: np.asarray(bundle.predict(chunk), dtype="float64")})
+    if empty:
+        yield pd.DataFrame({bundle.target: pd.Series(dtype="float64")})
+
+
+def predict_file(bundle, input_file, output_stem, chunksize=100_000, format=None):
+    """
+        Stream predictions for a CSV file to the Predictions table of an output, writing every chunk as it is predicted
+        (see sinks.write_output).
+
+        Args:
+            output_stem (str): The path of the output without the extension of the format.
+            format (str): The output format (see sinks.output_format).
+
+        Returns:
+            int: The number of predictions written.
+    """
+    rows = 0
+
+    def counted(chunks):
+        nonlocal rows
+        for chunk in chunks:
+            rows += len(chunk)
+            yield chunk
+
+    write_output({PREDICTIONS_TABLE: counted(predicted_chunks(bundle, input_file, chunksize))}, output_stem, format)
+    return rows
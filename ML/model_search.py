@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import hashlib
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.base import clone
+from sklearn.model_selection import KFold
+from sklearn.preprocessing import StandardScaler
+from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
+from sklearn.linear_model import LinearRegression
+from sklearn.metrics import mean_squared_error, r2_score
+
+from Pipeline.instrumentation import instrumented
+
+# The candidate model families and the hyperparameters searched for each
+CANDIDATES = {
+    "Random Forest": (RandomForestRegressor(random_state=42), {
+        "n_estimators": [100, 300],
+        "max_depth": [None, 8, 16],
+        "min_samples_leaf": [1, 5],
+    }),
+    "Gradient Boosting": (GradientBoostingRegressor(random_state=42), {
+        "n_estimators": [100, 300],
+        "learning_rate": [0.05, 0.1],
+        "max_depth": [2, 3],
+    }),
+    "Linear Regression": (LinearRegression(), {}),
+}
+
+DEFAULT_FOLDS = 5
+
+# Every halving round keeps the best 1/HALVING_FACTOR of the configurations and trains on HALVING_FACTOR times more rows
+HALVING_FACTOR = 3
+
+# Rounds never train on fewer rows than this
+MIN_RESOURCES = 100
+
+CACHE_FILE = ".model_search_cache.json"
+
+RANDOM_STATE = 42
+
+
+def data_hash(X, y):
+    """
+        Hash the training data, so that cached fold results are only reused for the same data.
+    """
+    digest = hashlib.sha256()
+    for values in (X, y):
+        values = np.ascontiguousarray(values, dtype="float64")
+        digest.update(str(values.shape).encode())
+        digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+def expand_grid(grid):
+    """
+        Return every combination of the hyperparameter grid as a dict.
+    """
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def task_key(data_key, family, params, folds, fold, resources):
+    return hashlib.sha256(json.dumps([data_key, family, params, folds, fold, resources, RANDOM_STATE], sort_keys=True).encode()).hexdigest()
+
+
+def load_cache(cache_file):
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file) as file:
+            return json.load(file)
+    return {}
+
+
+def save_cache(cache, cache_file):
+    if not cache_file:
+        return
+    temporary = cache_file + ".tmp"
+    with open(temporary, "w") as file:
+        json.dump(cache, file)
+    os.replace(temporary, cache_file)
+
+
+# The training data of a worker process, set once by the pool initializer instead of being sent with every task
+_data = {}
+
+
+def set_data(X, y, splits):
+    _data.update(X=X, y=y, splits=splits)
+
+
+def fit_fold(family, params, fold, resources):
+    """
+        Fit one configuration on (the first resources rows of) one training fold and score it on the validation fold.
+        The features are standardized with a scaler fitted on the training fold only.
+    """
+    X, y = _data["X"], _data["y"]
+    train, test = _data["splits"][fold]
+    train = train[:resources]
+
+    start = time.perf_counter()
+    scaler = StandardScaler()
+    model = clone(CANDIDATES[family][0]).set_params(**params)
+    model.fit(scaler.fit_transform(X[train]), y[train])
+    y_pred = model.predict(scaler.transform(X[test]))
+    return {
+        "rmse": float(np.sqrt(mean_squared_error(y[test], y_pred))),
+        "r2": float(r2_score(y[test], y_pred)),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def halving_schedule(n_configs, max_resources, factor=HALVING_FACTOR, min_resources=MIN_RESOURCES):
+    """
+        Return the training rows per fold of every successive halving round, ending with all rows.
+        There are as many rounds as it takes to narrow the configurations down to about one, as far as the minimum allows.
+    """
+    rounds = 1
+    while factor ** rounds < n_configs and max_resources / factor ** rounds >= min_resources:
+        rounds += 1
+    return [int(max_resources / factor ** (rounds - 1 - i)) for i in range(rounds)]
+
+
+@instrumented()
+def search_models(X, y, candidates=None, folds=DEFAULT_FOLDS, workers=None, factor=HALVING_FACTOR, cache_file=CACHE_FILE):
+    """
+        Cross-validate every configuration of every candidate family with successive halving, in a process pool.
+
+        All configurations are first scored on a small share of every training fold; each round keeps the best
+        1/factor of them by mean RMSE and scores those on factor times more rows, until the survivors are scored on
+        the full folds. Fold results are cached by data hash, configuration, fold and rows, so a rerun only fits
+        configurations it has not seen.
+
+        Args:
+            X (array): The features.
+            y (array): The target.
+            candidates (list): The families to search (keys of CANDIDATES). Defaults to all.
+            folds (int): The number of cross-validation folds.
+            workers (int): The number of worker processes. Defaults to the number of CPUs.
+            factor (int): The halving factor.
+            cache_file (str): The fold result cache. None disables the cache.
+
+        Returns:
+            list: One dict per configuration scored on the full folds, with the family, params, rmse, rmse_std, r2
+                and fit seconds averaged over the folds, sorted by rmse. The first one is the best.
+    """
+    X = np.asarray(X, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+    data_key = data_hash(X, y)
+    # The training rows of every fold are shuffled, so that the first rows used by the early rounds are a random sample
+    rng = np.random.default_rng(RANDOM_STATE)
+    splits = [(rng.permutation(train), test) for train, test in KFold(n_splits=folds, shuffle=True, random_state=RANDOM_STATE).split(X)]
+    max_resources = min(len(train) for train, _ in splits)
+
+    configs = [(family, params) for family in candidates or CANDIDATES for params in expand_grid(CANDIDATES[family][1])]
+    schedule = halving_schedule(len(configs), max_resources, factor)
+
+    cache = load_cache(cache_file)
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_data, initargs=(X, y, splits)) as executor:
+        for round_number, resources in enumerate(schedule):
+            tasks = {task_key(data_key, family, params, folds, fold, resources): (family, params, fold, resources)
+                     for family, params in configs for fold in range(folds)}
+            missing = [key for key in tasks if key not in cache]
+            futures = {key: executor.submit(fit_fold, *tasks[key]) for key in missing}
+            for key, future in futures.items():
+                cache[key] = future.result()
+            save_cache(cache, cache_file)
+
+            scores = []
+            for family, params in configs:
+                results = [cache[task_key(data_key, family, params, folds, fold, resources)] for fold in range(folds)]
+                scores.append({
+                    "family": family,
+                    "params": params,
+                    "resources": resources,
+                    "rmse": float(np.mean([result["rmse"] for result in results])),
+                    "rmse_std": float(np.std([result["rmse"] for result in results])),
+                    "r2": float(np.mean([result["r2"] for result in results])),
+                    "seconds": float(np.mean([result["seconds"] for result in results])),
+                })
+            scores.sort(key=lambda score: score["rmse"])
+            print(f"Round {round_number + 1}/{len(schedule)}: {len(configs)} configurations on {resources} rows per fold, "
+                  f"{len(missing)} fits ({len(tasks) - len(missing)} cached)")
+
+            if round_number + 1 < len(schedule):
+                keep = max(1, int(np.ceil(len(configs) / factor)))
+                configs = [(score["family"], score["params"]) for score in scores[:keep]]
+
+    return scores
+
+
+def build_model(family, params):
+    """
+        Create an unfitted model of a searched configuration.
+    """
+    return clone(CANDIDATES[family][0]).set_params(**params)
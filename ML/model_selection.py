@@ -1,21 +1,53 @@
 import pandas as pd
 import os
 import sys
-import pickle
-import matplotlib.pyplot as plt
+import argparse
+from math import sqrt
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
-from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
-from sklearn.linear_model import LinearRegression
 from sklearn.metrics import mean_squared_error, r2_score
 
+# Add the repository root to the path so that the shared modules can be imported when run as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-def main():
+from ML.model_bundle import FEATURES, TARGET, MODEL_FILE, save_bundle
+from ML.model_search import DEFAULT_FOLDS, HALVING_FACTOR, build_model, search_models
+from Integration.sinks import output_path, read_output
+from Pipeline.instrumentation import stage, step
+
+
+def save_prediction_plot(branch_counts, predictions, output_file):
+    """
+        Render the predicted PM2.5 levels by total branch count straight to a file with the non-interactive Agg backend,
+        so the stage runs headless and in worker processes.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = Figure(figsize=(8, 6))
+    FigureCanvasAgg(figure)
+    axes = figure.subplots()
+    axes.plot(branch_counts, predictions, marker='o', linestyle='-', color='b')
+    axes.set_title("Predicted PM2.5 Levels vs Total Branch Count")
+    axes.set_xlabel("Total Branch Count")
+    axes.set_ylabel("Predicted PM2.5 Levels")
+    axes.grid(True)
+    figure.savefig(output_file)
+
+
+@stage("model_selection")
+def main(folds=DEFAULT_FOLDS, workers=None, factor=HALVING_FACTOR):
     """
         Main function for model selection and evaluation.
-        This function loads the branch density and PM2.5 data, trains and evaluates multiple regression models,
-        selects the best model based on evaluation metrics, and saves the model to a file.
+        This function loads the branch density and PM2.5 data, cross-validates a hyperparameter grid of multiple regression
+        models, selects the best configuration by its cross-validated RMSE, evaluates it on a held-out test set,
+        and saves the model to a file.
         It also demonstrates how to use the model to make predictions on new data.
+
+        Args:
+            folds (int): The number of cross-validation folds.
+            workers (int): The number of worker processes of the search. Defaults to the number of CPUs.
+            factor (int): The successive halving factor of the search.
     """
     
     
@@ -26,58 +58,53 @@ def main():
     sys.path.append(data_dir)
     
     # Load the branch density and PM2.5 data
-    branch_density_pm_file = "branch_counts_with_pm25.xlsx"
-    df = pd.read_excel(branch_density_pm_file)
+    branch_density_pm_file = output_path("branch_counts_with_pm25")
+    with step("read_output") as record:
+        df = read_output(branch_density_pm_file, "Branch_Counts_With_PM25")
+        record.rows_out = len(df)
     
 
-    features = ["unique_bank_count", "unique_creditunion_count", "total_branch_count"]
-    target = "mean_pm25_concentration"
+    features = FEATURES
+    target = TARGET
     
-    X = df[features]
+    # The features are passed as arrays in FEATURES order, the order the saved model bundle predicts in
+    X = df[features].to_numpy(dtype="float64")
     y = df[target]
     
     # Split the data into training and test sets
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-    
+
+    # Cross-validate the hyperparameter grids of the Random Forest, Gradient Boosting and Linear Regression models
+    # on the training set; poor configurations are dropped early by successive halving
+    results = search_models(X_train, y_train, folds=folds, workers=workers, factor=factor)
+
+    # Display results
+    print(f"\nModel Evaluation Results ({folds}-fold cross-validation):")
+    for result in results:
+        print(f"\n{result['family']} {result['params']}:")
+        print(f"  Root Mean Squared Error (RMSE): {result['rmse']} (std {result['rmse_std']})")
+        print(f"  R-squared (R2): {result['r2']}")
+
     # Standardize the features because the Random Forest and Gradient Boosting models are not scale-invariant
     scaler = StandardScaler()
     X_train_scaled = scaler.fit_transform(X_train)
     X_test_scaled = scaler.transform(X_test)
 
-    # Train and evaluate the models
-    models = {
-        "Random Forest": RandomForestRegressor(random_state=42),
-        "Gradient Boosting": GradientBoostingRegressor(random_state=42),
-        "Linear Regression": LinearRegression()
-    }
-
-    # Train and evaluate the models using the scaled data and display the results    
-    results = {}
-    for name, model in models.items():
-        model.fit(X_train_scaled, y_train)
-        y_pred = model.predict(X_test_scaled)
-        mse = mean_squared_error(y_test, y_pred)
-        rmse = sqrt(mse)
-        r2 = r2_score(y_test, y_pred)
-        results[name] = {
-            "RMSE": rmse,
-            "R2": r2
-        }
+    # Refit the configuration with the best cross-validated RMSE on the whole training set and evaluate it on the test set
+    best = results[0]
+    best_model = build_model(best["family"], best["params"])
+    with step("fit_best", rows_in=len(X_train_scaled)):
+        best_model.fit(X_train_scaled, y_train)
+    y_pred = best_model.predict(X_test_scaled)
+    print(f"\nSelected {best['family']} {best['params']}:")
+    print(f"  Test Root Mean Squared Error (RMSE): {sqrt(mean_squared_error(y_test, y_pred))}")
+    print(f"  Test R-squared (R2): {r2_score(y_test, y_pred)}")
 
-    # Display results
-    print("Model Evaluation Results:")
-    for name, metrics in results.items():
-        print(f"\n{name}:")
-        print(f"  Root Mean Squared Error (RMSE): {metrics['RMSE']}")
-        print(f"  R-squared (R2): {metrics['R2']}")
-        
-    # After training the models, it turned out that the Random Forest model performed the best in terms of RMSE and R2.
-    # Feature importance for Random Forest
-    rf_model = models["Random Forest"]
-    feature_importances = rf_model.feature_importances_
-    importance_df = pd.DataFrame({"Feature": features, "Importance": feature_importances})
-    print("\nFeature Importances (Random Forest):")
-    print(importance_df.sort_values(by="Importance", ascending=False))
+    # Feature importance of the selected model
+    if hasattr(best_model, "feature_importances_"):
+        importance_df = pd.DataFrame({"Feature": features, "Importance": best_model.feature_importances_})
+        print(f"\nFeature Importances ({best['family']}):")
+        print(importance_df.sort_values(by="Importance", ascending=False))
     
     
     # Predict PM2.5 levels for new data
@@ -87,27 +114,28 @@ def main():
     })
     new_data["total_branch_count"] = new_data["unique_bank_count"] + new_data["unique_creditunion_count"] 
 
-    new_data_scaled = scaler.transform(new_data)
-    new_predictions = rf_model.predict(new_data_scaled)
+    new_data_scaled = scaler.transform(new_data[features].to_numpy(dtype="float64"))
+    new_predictions = best_model.predict(new_data_scaled)
 
-    plt.figure(figsize=(8, 6))
-    plt.plot(new_data["total_branch_count"], new_predictions, marker='o', linestyle='-', color='b')
-    plt.title("Predicted PM2.5 Levels vs Total Branch Count")
-    plt.xlabel("Total Branch Count")
-    plt.ylabel("Predicted PM2.5 Levels")
-    plt.grid(True)
-    plt.show()
-    
     # Save the plot to a file named "predicted_pm25_vs_branch_count.png"
     plot_file = "predicted_pm25_vs_branch_count.png"
-    plt.savefig(plot_file)
+    save_prediction_plot(new_data["total_branch_count"], new_predictions, plot_file)
     print(f"\nPlot saved to {plot_file}")
     
-    # Save the Random Forest model to a file
-    model_file = "random_forest_model.pkl"
-    pickle.dump(model, open(model_file, 'wb'))
-    print(f"Random Forest model saved to {model_file}")
+    # Save the selected model with its scaler and feature order, so predictions scale the features like training did.
+    # The file keeps its name for the prediction scripts, whichever model family is selected
+    model_file = MODEL_FILE
+    # Predictions for every bank and credit union count up to the largest observed ones are precomputed as a lookup table
+    table_range = (int(df["unique_bank_count"].max()), int(df["unique_creditunion_count"].max()))
+    # A compiled forest has to predict the training data like the model does
+    save_bundle(model_file, best_model, scaler, features, target, table_range, check_rows=X_train_scaled)
+    print(f"{best['family']} model saved to {model_file}")
         
     
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Select the PM2.5 model by cross-validated hyperparameter search.")
+    parser.add_argument("--folds", type=int, default=DEFAULT_FOLDS, help="Number of cross-validation folds")
+    parser.add_argument("--workers", type=int, help="Number of worker processes")
+    parser.add_argument("--factor", type=int, default=HALVING_FACTOR, help="Successive halving factor")
+    args = parser.parse_args()
+    main(args.folds, args.workers, args.factor)
\ No newline at end of file
@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import Future
+from urllib.parse import parse_qs
+
+import numpy as np
+
+# Add the repository root to the path so that the shared modules can be imported when run as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ML.model_bundle import MODEL_FILE, load_bundle
+from Pipeline.http_service import DEFAULT_HOST, DEFAULT_WORKERS, JSONRequestHandler, PooledHTTPServer
+from Pipeline.instrumentation import step
+
+DEFAULT_PORT = 8081
+
+# Single-row requests are collected for up to MAX_WAIT seconds, or until MAX_BATCH rows, and predicted together
+MAX_BATCH = 256
+MAX_WAIT = 0.002
+
+
+def feature_row(row, features):
+    """
+        Convert a request's feature values to a row in the bundle's feature order.
+        The total branch count is derived from the bank and credit union counts when it is missing.
+    """
+    values = dict(row)
+    if "total_branch_count" in features and "total_branch_count" not in values:
+        values["total_branch_count"] = float(values["unique_bank_count"]) + float(values["unique_creditunion_count"])
+    return [float(values[feature]) for feature in features]
+
+
+class MicroBatcher:
+    """
+        Coalesces concurrent single-row prediction requests into batches, so the model predicts many rows
+        in one vectorized call instead of paying its per-call overhead for every request.
+    """
+
+    def __init__(self, model_file=MODEL_FILE, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        self.model_file = model_file
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, row):
+        """
+            Queue one row (in the bundle's feature order) for prediction.
+
+            Returns:
+                Future: Resolves to the prediction.
+        """
+        future = Future()
+        self.requests.put((row, future))
+        return future
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                # The bundle is reloaded here when the model file changes
+                predictions = load_bundle(self.model_file).predict_matrix(np.array([row for row, _ in batch]))
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            for (_, future), prediction in zip(batch, predictions):
+                future.set_result(float(prediction))
+
+
+class PredictionHandler(JSONRequestHandler):
+    """
+        GET /predict?unique_bank_count=<n>&unique_creditunion_count=<n> or POST /predict with one row of features,
+        looked up in the prediction table or else micro-batched, and POST /predict with a {"rows": [...]} body,
+        predicted as one batch.
+    """
+
+    def get(self, url):
+        if url.path == "/health":
+            bundle = load_bundle(self.server.model_file)
+            return self.respond(json.dumps({"model": type(bundle.model).__name__, "features": bundle.features}), 200)
+        if url.path != "/predict":
+            return self.respond(json.dumps({"error": "Not found"}), 404)
+        return self.predict({name: values[0] for name, values in parse_qs(url.query).items()})
+
+    def post(self, url):
+        if url.path != "/predict":
+            return self.respond(json.dumps({"error": "Not found"}), 404)
+        body = self.read_json()
+        if body is None:
+            return
+        if "rows" in body:
+            self.predict_rows(body["rows"])
+        else:
+            return self.predict(body)
+
+    def predict(self, row):
+        """
+            Answer one row from the prediction table, or else queue it for a micro-batch and return the callable that
+            waits for its prediction, which is called without holding a worker (see JSONRequestHandler.dispatch), so more
+            rows than workers can wait for the same batch.
+        """
+        bundle = load_bundle(self.server.model_file)
+        try:
+            values = feature_row(row, bundle.features)
+        except (KeyError, TypeError, ValueError):
+            return self.respond(json.dumps({"error": f"Expected numeric values for {bundle.features}"}), 400)
+
+        # Rows in the prediction table are answered right away; only the others wait for a micro-batch
+        if bundle.table is not None:
+            predictions, missing = bundle.table.lookup(np.array([values]), bundle.features)
+            if not missing[0]:
+                return self.respond(json.dumps({"prediction": float(predictions[0])}), 200)
+        future = self.server.batcher.submit(values)
+        return lambda: self.respond(json.dumps({"prediction": future.result()}), 200)
+
+    def predict_rows(self, rows):
+        bundle = load_bundle(self.server.model_file)
+        try:
+            X = np.array([feature_row(row, bundle.features) for row in rows], dtype="float64").reshape(len(rows), len(bundle.features))
+        except (KeyError, TypeError, ValueError):
+            return self.respond(json.dumps({"error": f"Expected numeric values for {bundle.features}"}), 400)
+        predictions = bundle.predict_matrix(X).tolist() if len(rows) else []
+        self.respond(json.dumps({"predictions": predictions}), 200)
+
+
+class ModelServer(PooledHTTPServer):
+    """
+        Prediction server whose workers share one model bundle and micro-batcher.
+    """
+
+    def __init__(self, address, model_file=MODEL_FILE, workers=DEFAULT_WORKERS, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        super().__init__(address, PredictionHandler, workers)
+        self.model_file = model_file
+        self.batcher = MicroBatcher(model_file, max_batch, max_wait)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve PM2.5 predictions from the trained model bundle.")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Number of requests answered concurrently")
+    parser.add_argument("--model", default=MODEL_FILE, help="Model bundle saved by model_selection.py")
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH, help="Maximum rows per micro-batch")
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT * 1000, help="Maximum time a row waits for its batch")
+    args = parser.parse_args()
+
+    # Load the model once before serving, so that a missing or broken file fails at startup
+    with step("load_bundle"):
+        bundle = load_bundle(args.model)
+    server = ModelServer((args.host, args.port), args.model, args.workers, args.max_batch, args.max_wait_ms / 1000)
+    print(f"Serving {type(bundle.model).__name__} predictions on http://{args.host}:{server.server_port}/predict")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Goodbye!")
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,51 +1,57 @@
-import pandas as pd
 import os
 import sys
-import pickle
+import argparse
 
-def predict_with_model(model_file, new_data_file, output_file):
+# Add the repository root to the path so that the shared modules can be imported when run as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Integration.sinks import ARTIFACT_FORMATS, output_path
+from ML.model_bundle import MODEL_FILE, load_bundle, predict_file
+from Pipeline.instrumentation import stage, step
+
+
+def predict_with_model(model_file, new_data_file, output_stem, chunksize=100_000, format=None):
     """
-        Load a trained regression model from a file, make predictions on new data, and save the predictions to a file.
-        
+        Load a trained regression model from a file, make predictions on new data, and save the predictions to an output.
+        The model bundle is loaded once per process and reused, and the new data is streamed in chunks.
+
         Args:
             model_file (str): The file containing the trained regression model.
             new_data_file (str): The file containing the new data on which to make predictions.
-            output_file (str): The file to which the predictions should be saved.
+            output_stem (str): The output the predictions should be saved to, without the extension of the format.
+            chunksize (int): The number of rows predicted at a time.
+            format (str): The format of the output (see sinks.output_format).
+
+        Returns:
+            int: The number of predictions.
     """
-    
-    # Load the trained model from the file
-    with open(model_file, "rb") as file:
-        model = pickle.load(file)
-    
-    # Load the new data on which to make predictions
-    new_data = pd.read_csv(new_data_file)
-    
-    # Make predictions on the new data
-    predictions = model.predict(new_data)
-    
-    # Save the predictions to a file
-    pd.Series(predictions).to_csv(output_file, index=False)
-
-
-def main(prediction_file):
+
+    # Load the trained model, its scaler and feature order from the file
+    bundle = load_bundle(model_file)
+
+    # Make predictions on the new data and save them to a file, chunk by chunk
+    with step("predict_file") as record:
+        record.rows_out = predict_file(bundle, new_data_file, output_stem, chunksize, format)
+    return record.rows_out
+
+
+@stage("predict")
+def main(prediction_file, model_file=MODEL_FILE, output_stem="predictions", chunksize=100_000, format=None):
     """
         Main function for making predictions on new data using a trained regression model.
+        The files are relative to the data directory the script is run from.
     """
-    
-    # Add the data directory to the path so that we can import the data files directly
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    parent_dir = os.path.dirname(current_dir)
-    data_dir = os.path.join(parent_dir, "data/")
-    sys.path.append(data_dir)
-    
-    # Assuming we recieve prediction_file as a parameter we first create the file paths
-    model_file = os.path.join(data_dir, "random_forest_model.pkl")
-    new_data_file = os.path.join(data_dir, prediction_file)
-    output_file = os.path.join(data_dir, "predictions.csv")
-    
+
     # Call the predict_with_model function to make predictions on the new data
-    predict_with_model(model_file, new_data_file, output_file)
-    print(f"Predictions saved to {output_file}")
-    
+    rows = predict_with_model(model_file, prediction_file, output_stem, chunksize, format)
+    print(f"{rows} predictions saved to {output_path(output_stem, format)}")
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Predict PM2.5 levels from branch counts.")
+    parser.add_argument("prediction_file", help="CSV file with the unique_bank_count and unique_creditunion_count columns")
+    parser.add_argument("--model", default=MODEL_FILE, help="Model bundle saved by model_selection.py")
+    parser.add_argument("--output", default="predictions", help="Output to save the predictions to, without extension")
+    parser.add_argument("--chunksize", type=int, default=100_000, help="Number of rows predicted at a time")
+    parser.add_argument("--output-format", choices=ARTIFACT_FORMATS, help="Format of the output (defaults to the PIPELINE_OUTPUT_FORMAT variable or arrow)")
+    args = parser.parse_args()
+    main(args.prediction_file, args.model, args.output, args.chunksize, args.output_format)
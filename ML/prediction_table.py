@@ -0,0 +1,72 @@
+import numpy as np
+
+BANK_FEATURE = "unique_bank_count"
+CREDITUNION_FEATURE = "unique_creditunion_count"
+TOTAL_FEATURE = "total_branch_count"
+
+
+class PredictionTable:
+    """
+        Precomputed predictions for every combination of bank and credit union counts up to the largest observed counts.
+
+        The model's features are whole branch counts, and the total is the sum of the other two, so every input inside
+        the observed range is one cell of a small 2-D grid. Looking a prediction up is an array index instead of a model
+        evaluation; inputs outside the grid (or that are not whole counts) are left to the model.
+    """
+
+    def __init__(self, table, source=None):
+        self.table = np.asarray(table, dtype="float64")
+        self.source = source
+
+    @classmethod
+    def build(cls, predict_matrix, features, bank_max, creditunion_max, source=None):
+        """
+            Predict every cell of the grid in one batch.
+
+            Args:
+                predict_matrix (callable): Predicts a feature matrix in the features order.
+                features (list): The feature order of the model.
+                bank_max (int): The largest bank count in the table.
+                creditunion_max (int): The largest credit union count in the table.
+                source (str): An identifier of the model the table was built from.
+        """
+        banks, creditunions = np.meshgrid(np.arange(bank_max + 1), np.arange(creditunion_max + 1), indexing="ij")
+        columns = {BANK_FEATURE: banks.ravel(), CREDITUNION_FEATURE: creditunions.ravel(), TOTAL_FEATURE: (banks + creditunions).ravel()}
+        predictions = predict_matrix(np.column_stack([columns[feature] for feature in features]).astype("float64"))
+        return cls(np.asarray(predictions).reshape(banks.shape), source)
+
+    @staticmethod
+    def supports(features):
+        """
+            Whether a model with these features can be tabulated, i.e. all its features are derived from the two counts.
+        """
+        return {BANK_FEATURE, CREDITUNION_FEATURE} <= set(features) <= {BANK_FEATURE, CREDITUNION_FEATURE, TOTAL_FEATURE}
+
+    def save(self, path):
+        with open(path, "wb") as file:
+            np.savez(file, table=self.table, source=np.array(self.source or ""))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            return cls(saved["table"], str(saved["source"]) or None)
+
+    def lookup(self, X, features):
+        """
+            Look up the predictions of the rows of a feature matrix.
+
+            Returns:
+                tuple: The predictions, with NaN for the rows outside the table, and a mask of those rows.
+        """
+        X = np.asarray(X, dtype="float64")
+        banks = X[:, features.index(BANK_FEATURE)]
+        creditunions = X[:, features.index(CREDITUNION_FEATURE)]
+
+        inside = (banks >= 0) & (banks < self.table.shape[0]) & (banks % 1 == 0) \
+            & (creditunions >= 0) & (creditunions < self.table.shape[1]) & (creditunions % 1 == 0)
+        if TOTAL_FEATURE in features:
+            inside &= X[:, features.index(TOTAL_FEATURE)] == banks + creditunions
+
+        predictions = np.full(len(X), np.nan)
+        predictions[inside] = self.table[banks[inside].astype("int64"), creditunions[inside].astype("int64")]
+        return predictions, ~inside
@@ -0,0 +1,196 @@
+import numpy as np
+
+# Operators answered by binary search on a sorted column
+RANGE_OPERATORS = {">", ">=", "<", "<=", "=", "between"}
+
+# Operators that keep the k rows with the largest or smallest values of a column
+RANK_OPERATORS = {"top", "bottom"}
+
+
+class ColumnIndex:
+    """
+        Sorted indexes over the queryable columns of a DataFrame, built once and shared by every query.
+
+        Each column keeps its non-missing values in sorted order together with their row positions,
+        so a range predicate is answered by binary search and returns the matching row positions.
+        AND conditions start from the most selective range and check the others on its rows only,
+        OR conditions are combined as sorted row-id set unions, and the DataFrame is only copied once,
+        when the result rows are materialized.
+    """
+
+    def __init__(self, df, columns):
+        self.df = df
+        self.values = {}
+        self.order = {}
+        self.sorted_values = {}
+        for column in columns:
+            values = df[column].to_numpy(dtype="float64", na_value=np.nan)
+            order = np.argsort(values, kind="stable")
+            # NaN sorts last; missing values never satisfy a predicate, like in a pandas comparison
+            order = order[:np.count_nonzero(~np.isnan(values))]
+            self.values[column] = values
+            self.order[column] = order
+            self.sorted_values[column] = values[order]
+
+    def __len__(self):
+        return len(self.df)
+
+    def all_rows(self):
+        return np.arange(len(self.df))
+
+    def bounds(self, column, operator, value):
+        """
+            Return the [start, end) range of the sorted column that satisfies a range predicate.
+
+            Args:
+                column (str): An indexed column.
+                operator (str): One of ">", ">=", "<", "<=", "=" or "between".
+                value (float): The value to compare with, or the inclusive (low, high) bounds for "between".
+        """
+        if column not in self.order:
+            raise KeyError(f"Column {column} is not indexed")
+        values = self.sorted_values[column]
+
+        if operator == ">":
+            return np.searchsorted(values, value, side="right"), len(values)
+        if operator == ">=":
+            return np.searchsorted(values, value, side="left"), len(values)
+        if operator == "<":
+            return 0, np.searchsorted(values, value, side="left")
+        if operator == "<=":
+            return 0, np.searchsorted(values, value, side="right")
+        if operator == "=":
+            return np.searchsorted(values, value, side="left"), np.searchsorted(values, value, side="right")
+        if operator == "between":
+            low, high = value
+            return np.searchsorted(values, low, side="left"), np.searchsorted(values, high, side="right")
+        raise ValueError(f"Unsupported operator {operator}")
+
+    def rows(self, column, operator, value):
+        """
+            Return the sorted row positions where the column satisfies a range predicate (see bounds).
+        """
+        start, end = self.bounds(column, operator, value)
+        return np.sort(self.order[column][start:end])
+
+    def matches(self, rows, column, operator, value):
+        """
+            Check a range predicate on the given rows only, returning the rows that satisfy it.
+        """
+        values = self.values[column][rows]
+        if operator == ">":
+            keep = values > value
+        elif operator == ">=":
+            keep = values >= value
+        elif operator == "<":
+            keep = values < value
+        elif operator == "<=":
+            keep = values <= value
+        elif operator == "=":
+            keep = values == value
+        elif operator == "between":
+            keep = (values >= value[0]) & (values <= value[1])
+        else:
+            raise ValueError(f"Unsupported operator {operator}")
+        return rows[keep]
+
+    def rank(self, column, k, rows=None, largest=True):
+        """
+            Return the positions of the k rows with the largest (or smallest) values of a column, in rank order.
+
+            Args:
+                column (str): An indexed column.
+                k (int): The number of rows.
+                rows (array): The sorted candidate row positions. Defaults to all rows.
+                largest (bool): Whether to keep the largest values; otherwise the smallest.
+        """
+        k = int(k)
+        if rows is None:
+            # The index is already sorted, so the answer is its head or tail
+            order = self.order[column]
+            return order[::-1][:k] if largest else order[:k]
+
+        values = self.values[column][rows]
+        rows = rows[~np.isnan(values)]
+        values = values[~np.isnan(values)]
+        if k < len(rows):
+            keep = np.argpartition(-values if largest else values, k - 1)[:k]
+            rows, values = rows[keep], values[keep]
+        ranking = np.argsort(-values if largest else values, kind="stable")
+        return rows[ranking]
+
+    def evaluate(self, conditions):
+        """
+            Evaluate conditions to row positions.
+
+            Args:
+                conditions: A (column, operator, value) condition, an ("and", [conditions]) or ("or", [conditions]) group,
+                    or a list of conditions that all have to hold. Rank conditions such as (column, "top", k) are applied
+                    last, to the rows matching the other conditions, and return the rows in rank order.
+
+            Returns:
+                array: The row positions of the matching rows.
+        """
+        if isinstance(conditions, tuple):
+            conditions = [conditions]
+
+        filters = [condition for condition in conditions if not is_rank(condition)]
+        ranks = [condition for condition in conditions if is_rank(condition)]
+
+        rows = self.evaluate_group("and", filters) if filters else None
+        for column, operator, k in ranks:
+            rows = self.rank(column, k, rows, largest=operator == "top")
+        return self.all_rows() if rows is None else rows
+
+    def evaluate_group(self, connective, conditions):
+        if connective == "or":
+            rows = self.evaluate_condition(conditions[0])
+            for condition in conditions[1:]:
+                rows = np.union1d(rows, self.evaluate_condition(condition))
+            return rows
+        if connective != "and":
+            raise ValueError(f"Unsupported connective {connective}")
+
+        # Start from the most selective predicate, whose size is known from the binary search alone,
+        # and check the other predicates on its rows instead of materializing and intersecting every range
+        predicates = [condition for condition in conditions if len(condition) == 3]
+        groups = [condition for condition in conditions if len(condition) == 2]
+        if predicates:
+            sizes = [np.subtract(*self.bounds(*predicate)[::-1]) for predicate in predicates]
+            first = predicates.pop(int(np.argmin(sizes)))
+            rows = self.rows(*first)
+        else:
+            rows = self.evaluate_condition(groups.pop(0))
+        for predicate in predicates:
+            rows = self.matches(rows, *predicate)
+        for group in groups:
+            rows = np.intersect1d(rows, self.evaluate_condition(group), assume_unique=True)
+        return rows
+
+    def evaluate_condition(self, condition):
+        if len(condition) == 2:
+            return self.evaluate_group(*condition)
+        return self.rows(*condition)
+
+    def materialize(self, rows):
+        """
+            Build the result DataFrame for the given row positions. This is the only copy of the data a query makes.
+        """
+        return self.df.iloc[rows]
+
+
+def is_rank(condition):
+    return len(condition) == 3 and condition[1] in RANK_OPERATORS
+
+
+def condition_columns(conditions):
+    """
+        Return the columns the conditions refer to.
+    """
+    columns = set()
+    for condition in conditions if isinstance(conditions, list) else [conditions]:
+        if len(condition) == 2:
+            columns |= condition_columns(list(condition[1]))
+        else:
+            columns.add(condition[0])
+    return columns
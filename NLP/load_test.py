@@ -0,0 +1,94 @@
+import sys
+import json
+import time
+import argparse
+import itertools
+import urllib.request
+import urllib.error
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+DEFAULT_URL = "http://127.0.0.1:8080"
+
+# A mix of the query shapes the service answers, from single predicates to ranked alternatives
+DEFAULT_QUERIES = [
+    "Show me tracts with pollution above 9.0",
+    "List tracts with total branches greater than 20",
+    "Show me tracts with pollution between 8 and 10 and at least 5 bank branches",
+    "Top 10 tracts by pollution with more than 3 credit union branches",
+    "pollution above 9 or more than 5 banks",
+    "bottom 20 tracts by total branches",
+]
+
+
+def send(url, query, limit, timeout):
+    """
+        Send one query and return its latency in seconds and whether it succeeded.
+    """
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(f"{url}/query?q={quote(query)}&limit={limit}", timeout=timeout) as response:
+            response.read()
+            ok = response.status == 200
+    except (urllib.error.URLError, OSError):
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def load_test(url=DEFAULT_URL, queries=DEFAULT_QUERIES, requests=2000, concurrency=16, limit=100, timeout=10.0):
+    """
+        Send requests to a running query service from concurrent clients, cycling through the queries.
+
+        Returns:
+            dict: The number of requests and errors, the throughput in requests per second,
+                and the p50, p90, p99 and maximum latency in milliseconds.
+    """
+    workload = list(itertools.islice(itertools.cycle(queries), requests))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda query: send(url, query, limit, timeout), workload))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": sum(not ok for _, ok in results),
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(requests / elapsed, 1),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p90_ms": round(float(np.percentile(latencies, 90)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+        "max_ms": round(float(latencies.max()), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a running NLP query service (see query_service.py).")
+    parser.add_argument("--url", default=DEFAULT_URL, help="Base URL of the service")
+    parser.add_argument("--requests", type=int, default=2000, help="Total number of requests")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[16], help="Concurrent clients; several values run one test each")
+    parser.add_argument("--limit", type=int, default=100, help="Maximum rows returned per query")
+    parser.add_argument("--query", action="append", help="Query to send (repeatable). Defaults to a built-in mix")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON lines")
+    args = parser.parse_args()
+
+    failed = False
+    for concurrency in args.concurrency:
+        result = load_test(args.url, args.query or DEFAULT_QUERIES, args.requests, concurrency, args.limit)
+        failed = failed or result["errors"] > 0
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"{result['requests']} requests, {concurrency} clients: {result['throughput_rps']} req/s, "
+                  f"p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms, {result['errors']} errors")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
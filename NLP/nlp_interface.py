@@ -1,69 +1,616 @@
-import pandas as pd
 import os
 import sys
-import spacy
+import re
+import json
+import time
+import argparse
+from collections import Counter
+from functools import lru_cache
 
-# Load spaCy's pre-trained NLP model
-nlp = spacy.load("en_core_web_sm")
+# Add the repository root to the path so that the shared modules can be imported when run as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-# Function to interpret query
-def parse_query(query, column_mappings):
-    doc = nlp(query.lower())
-    
-    # Extract conditions and fields
+# The data modules (pandas, the density cube and the column index) are imported by the functions that answer queries,
+# so that importing the parser stays fast
+from Pipeline.instrumentation import instrumented, step
+
+# Words that introduce a numeric filter
+GREATER_WORDS = {"above", "greater", "more", "over", "exceeding", "exceeds", "higher", "larger"}
+LESS_WORDS = {"below", "less", "fewer", "under", "lower", "smaller"}
+OPERATOR_SYMBOLS = {">", ">=", "<", "<="}
+
+# Phrases that introduce an inclusive numeric filter, rewritten to the operator before matching
+INCLUSIVE_PHRASES = [
+    (("greater", "than", "or", "equal", "to"), ">="),
+    (("more", "than", "or", "equal", "to"), ">="),
+    (("less", "than", "or", "equal", "to"), "<="),
+    (("fewer", "than", "or", "equal", "to"), "<="),
+    (("no", "less", "than"), ">="),
+    (("no", "fewer", "than"), ">="),
+    (("no", "more", "than"), "<="),
+    (("at", "least"), ">="),
+    (("at", "most"), "<="),
+    (("up", "to"), "<="),
+]
+
+# Words after a number that make the filter inclusive, e.g. "5 or more banks"
+INCLUSIVE_SUFFIXES = {"more": ">=", "above": ">=", "greater": ">=", "higher": ">=",
+                      "less": "<=", "fewer": "<=", "below": "<=", "lower": "<="}
+
+# Words that ask for the k rows with the largest or smallest values, e.g. "top 10 tracts by pollution"
+TOP_WORDS = {"top", "highest", "largest"}
+BOTTOM_WORDS = {"bottom", "lowest", "smallest"}
+
+# Phrases after "by", "per" or "for each" that ask for the matching tracts summarized per group, e.g. "branch density
+# by air quality level", mapped to the columns of the density cube they group by
+GROUP_WORDS = {"by", "per", "each", "every", "across"}
+GROUP_PHRASES = [
+    (("air", "quality"), ["pm25_bucket", "pm25_category"]),
+    (("aqi",), ["pm25_bucket", "pm25_category"]),
+    (("pm2.5", "bucket"), ["pm25_bucket", "pm25_category"]),
+    (("pm2.5", "category"), ["pm25_bucket", "pm25_category"]),
+    (("pollution", "bucket"), ["pm25_bucket", "pm25_category"]),
+    (("pollution", "category"), ["pm25_bucket", "pm25_category"]),
+    (("county",), ["county"]),
+    (("cbsa",), ["cbsa"]),
+    (("metro", "area"), ["cbsa"]),
+]
+
+# Words that may appear between a column, its comparison and the number without changing the meaning
+FILLER_WORDS = {"is", "are", "was", "were", "of", "with", "the", "a", "an", "that", "than", "level", "levels",
+                "count", "counts", "concentration", "concentrations", "number", "value", "values",
+                "tract", "tracts", "by", "in"}
+
+# Numbers, words, words with a number attached (e.g. "pm2.5") and comparison symbols.
+# Numbers may have a sign (unless the "-" joins two words or numbers, e.g. "9-12") and thousands separators (e.g. "1,000").
+NUMBER = r"-?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?"
+TOKEN_PATTERN = re.compile(r"[a-z]+\d+(?:\.\d+)?|(?<![a-z\d.])" + NUMBER + r"|\d+(?:\.\d+)?|[a-z]+|[<>]=?")
+NUMBER_PATTERN = re.compile(r"^" + NUMBER + r"$")
+
+# The batch mode parses the queries in tasks of this many distinct queries, which is also the nlp.pipe batch size
+DEFAULT_BATCH_SIZE = 500
+
+# Upper bound on the rows written per query in batch mode
+DEFAULT_BATCH_LIMIT = 1000
+
+
+@lru_cache(maxsize=1)
+def get_nlp():
+    """
+        Load spaCy's pre-trained NLP model on first use, so that importing this module stays fast.
+        Returns None if spaCy or the model is not installed; the rule-based parser does not need it.
+    """
+    try:
+        import spacy
+        return spacy.load("en_core_web_sm")
+    except (ImportError, OSError):
+        return None
+
+
+def normalize_query(query):
+    """
+        Normalize a query for parsing and caching: lower case and single spaces.
+    """
+    return " ".join(query.lower().split())
+
+
+def number(token):
+    """
+        The value of a number token (see NUMBER_PATTERN).
+    """
+    return float(token.replace(",", ""))
+
+
+def comparison(token):
+    """
+        Return the operator a word introduces, or None.
+    """
+    if token in OPERATOR_SYMBOLS:
+        return token
+    if token in GREATER_WORDS:
+        return ">"
+    if token in LESS_WORDS:
+        return "<"
+    return None
+
+
+def rewrite_phrases(tokens):
+    """
+        Rewrite the inclusive comparisons to their operator, e.g. "at least 5" to ">= 5" and "5 or more" to ">= 5".
+    """
+    rewritten = []
+    i = 0
+    while i < len(tokens):
+        for words, operator in INCLUSIVE_PHRASES:
+            if tuple(tokens[i:i + len(words)]) == words:
+                rewritten.append(operator)
+                i += len(words)
+                break
+        else:
+            # "<number> or more", but not "<number> or more than <number>" or "below <number> or above <number>"
+            if NUMBER_PATTERN.match(tokens[i]) and tokens[i + 1:i + 2] == ["or"] and i + 2 < len(tokens) \
+                    and tokens[i + 2] in INCLUSIVE_SUFFIXES and tokens[i + 3:i + 4] != ["than"] \
+                    and not (i + 3 < len(tokens) and NUMBER_PATTERN.match(tokens[i + 3])):
+                rewritten.extend([INCLUSIVE_SUFFIXES[tokens[i + 2]], tokens[i]])
+                i += 3
+            else:
+                rewritten.append(tokens[i])
+                i += 1
+    return rewritten
+
+
+def same_word(token, word):
+    """
+        Compare a query word with a column key word, ignoring a plural "s" (e.g. "banks" matches "bank").
+    """
+    return token == word or token == word + "s" or token + "s" == word
+
+
+def find_columns(tokens, keys):
+    """
+        Find the column keys in the tokens, preferring the longest key at every position (e.g. "total branches" over "branches").
+
+        Returns:
+            list: The (start, end, column) of every key found, in query order.
+    """
+    spans = []
+    i = 0
+    while i < len(tokens):
+        for words, column in keys:
+            if all(i + j < len(tokens) and same_word(tokens[i + j], word) for j, word in enumerate(words)):
+                spans.append((i, i + len(words), column))
+                i += len(words)
+                break
+        else:
+            i += 1
+    return spans
+
+
+def match_between(tokens):
+    """
+        Match "between <number> and <number>", returning the inclusive bounds in ascending order.
+    """
+    if len(tokens) == 4 and tokens[0] == "between" and tokens[2] == "and" \
+            and NUMBER_PATTERN.match(tokens[1]) and NUMBER_PATTERN.match(tokens[3]):
+        return "between", tuple(sorted((number(tokens[1]), number(tokens[3]))))
+    return None
+
+
+def match_after(tokens):
+    """
+        Match "<comparison> [than] <number>" or "between <number> and <number>" after a column,
+        e.g. "pollution above 9.0", "branches greater than 20" or "pollution between 8 and 10".
+    """
+    tokens = [token for token in tokens if token not in FILLER_WORDS or comparison(token)]
+    if len(tokens) >= 2 and comparison(tokens[0]) and NUMBER_PATTERN.match(tokens[1]):
+        return comparison(tokens[0]), number(tokens[1])
+    return match_between(tokens[:4])
+
+
+def match_before(tokens):
+    """
+        Match "<comparison> [than] <number>" or "between <number> and <number>" right before a column, e.g. "more than 5 banks".
+    """
+    tokens = [token for token in tokens if token not in FILLER_WORDS or comparison(token)]
+    if len(tokens) >= 2 and NUMBER_PATTERN.match(tokens[-1]) and comparison(tokens[-2]):
+        return comparison(tokens[-2]), number(tokens[-1])
+    return match_between(tokens[-4:])
+
+
+def match_range(tokens):
+    """
+        Match two comparisons of opposite directions joined by "and" or "or" after a column,
+        e.g. "pollution above 9 and below 12" or "pollution below 5 or above 12".
+
+        Returns:
+            tuple: The connective, the two (operator, number) comparisons and the number of tokens they span, or None.
+    """
+    words = [(i, token) for i, token in enumerate(tokens) if token not in FILLER_WORDS or comparison(token)][:5]
+    if len(words) < 5:
+        return None
+    (_, first), (_, low), (_, connective), (_, second), (last, high) = words
+    if connective in ("and", "or") and comparison(first) and comparison(second) \
+            and NUMBER_PATTERN.match(low) and NUMBER_PATTERN.match(high) and comparison(first)[0] != comparison(second)[0]:
+        return connective, ((comparison(first), number(low)), (comparison(second), number(high))), last + 1
+    return None
+
+
+def match_rank(tokens):
+    """
+        Match "<top|bottom> <number>" right before a column, e.g. "top 10 tracts by pollution".
+    """
+    tokens = [token for token in tokens if token not in FILLER_WORDS]
+    if len(tokens) >= 2 and NUMBER_PATTERN.match(tokens[-1]) and number(tokens[-1]).is_integer() and number(tokens[-1]) >= 0:
+        if tokens[-2] in TOP_WORDS:
+            return "top", int(number(tokens[-1]))
+        if tokens[-2] in BOTTOM_WORDS:
+            return "bottom", int(number(tokens[-1]))
+    return None
+
+
+def match_legacy(before, after):
+    """
+        Match the original grammar: a comparison right before the column and the number somewhere after it, e.g. "above pollution 9".
+    """
+    numbers = [token for token in after if NUMBER_PATTERN.match(token)]
+    if before and comparison(before[-1]) and numbers:
+        return comparison(before[-1]), number(numbers[0])
+    return None
+
+
+def condition_values(conditions):
+    """
+        The numbers the conditions were parsed from, including both bounds of a "between" and the row count of a "top" or "bottom".
+    """
+    values = []
+    for condition in conditions:
+        if condition[0] in ("or", "and"):
+            values.extend(condition_values(condition[1]))
+        elif condition[1] == "between":
+            values.extend(condition[2])
+        else:
+            values.append(condition[2])
+    return values
+
+
+@lru_cache(maxsize=4096)
+def parse_normalized(query, keys):
+    """
+        Rule-based parser for the supported query grammar, cached by normalized query.
+        Every column key takes a "top/bottom <k>" right before it, and the comparison and number that follow it,
+        or else the ones right before it, or else a comparison right before it and the first number after it.
+        Conditions joined by "or" are grouped; all other conditions have to hold together.
+        A query with a number that no condition uses (e.g. the 5 of "pollution above 9 and 5 banks") is outside the grammar,
+        so no conditions are returned rather than the ones that were understood.
+
+        Args:
+            query (str): The normalized query (see normalize_query).
+            keys (tuple): The (key words, column) pairs, longest keys first.
+
+        Returns:
+            tuple: The (column, operator, value) conditions, with alternatives as one ("or", conditions) group.
+    """
+    tokens = rewrite_phrases(TOKEN_PATTERN.findall(query))
+    spans = find_columns(tokens, keys)
+
+    chains = [[]]
+    ranks = []
+    condition_end = 0
+    for i, (start, end, column) in enumerate(spans):
+        previous_end = spans[i - 1][1] if i > 0 else 0
+        next_start = spans[i + 1][0] if i + 1 < len(spans) else len(tokens)
+        after_end = spans[i + 2][0] if i + 2 < len(spans) else len(tokens)
+        rank = match_rank(tokens[previous_end:start])
+        # A comparison right before the next column belongs to it, unless that column has one after it
+        # (e.g. the 3 in "pollution with more than 3 banks", but not in "pollution above 9 banks below 2")
+        shared = i + 1 < len(spans) and match_before(tokens[end:next_start]) == match_after(tokens[end:next_start]) \
+            and match_after(tokens[spans[i + 1][1]:after_end]) is None
+        condition = (not shared and match_after(tokens[end:next_start])) \
+            or (not rank and match_before(tokens[previous_end:start])) \
+            or match_legacy(tokens[previous_end:start], tokens[end:next_start])
+        # Both bounds of a range, unless the second comparison is the one right before the next column
+        # (e.g. "pollution above 9 and below 12", but not "pollution above 9 and fewer than 3 banks")
+        bounds = not shared and match_range(tokens[end:next_start])
+        if bounds and i + 1 < len(spans) and match_before(tokens[end:next_start]) == bounds[1][1]:
+            bounds = None
+        if rank:
+            ranks.append((column,) + rank)
+        if condition:
+            if chains[-1] and "or" in tokens[condition_end:start]:
+                chains.append([])
+            condition_end = end
+            if bounds:
+                connective, comparisons, length = bounds
+                range_conditions = [(column,) + bound for bound in comparisons]
+                if connective == "or":
+                    range_conditions = [("or", tuple(range_conditions))]
+                chains[-1].extend(range_conditions)
+                condition_end = end + length
+            else:
+                chains[-1].append((column,) + condition)
+
+    if len(chains) == 1:
+        conditions = tuple(chains[0]) + tuple(ranks)
+    else:
+        alternatives = tuple(chain[0] if len(chain) == 1 else ("and", tuple(chain)) for chain in chains)
+        conditions = (("or", alternatives),) + tuple(ranks)
+
+    if Counter(number(token) for token in tokens if NUMBER_PATTERN.match(token)) - Counter(condition_values(conditions)):
+        return ()
+    return conditions
+
+
+def parse_query_spacy(query, column_mappings):
+    """
+        Fallback parser using spaCy, for queries outside the rule-based grammar (e.g. numbers written as words).
+    """
+    nlp = get_nlp()
+    if nlp is None:
+        return []
+    return conditions_from_doc(nlp(query.lower()), column_mappings)
+
+
+def conditions_from_doc(doc, column_mappings):
+    """
+        Extract the conditions of a query from its spaCy doc (see parse_query_spacy).
+    """
     conditions = []
     for token in doc:
-        if token.text in column_mappings.keys():
+        if token.text in column_mappings.keys() and token.i > 0:
             column = column_mappings[token.text]
-            
+            numbers = [t for t in doc if t.like_num]
+            if not numbers:
+                continue
+
             # Handle numeric filters
+            try:
+                value = float(numbers[0].text)
+            except ValueError:
+                continue
             if token.nbor(-1).text in ["above", "greater"]:
-                value = float([t.text for t in doc if t.like_num][0])
                 conditions.append((column, ">", value))
             elif token.nbor(-1).text in ["below", "less"]:
-                value = float([t.text for t in doc if t.like_num][0])
                 conditions.append((column, "<", value))
-    
+
     return conditions
 
 
+def mapping_keys(column_mappings):
+    """
+        The (key words, column) pairs of the column mappings, longest keys first (see parse_normalized).
+    """
+    return tuple(sorted(((tuple(key.split()), column) for key, column in column_mappings.items()), key=lambda item: -len(item[0])))
+
+
+# Function to interpret query
+def parse_query(query, column_mappings):
+    """
+        Parse a query into (column, operator, value) conditions.
+        Operators are ">", ">=", "<", "<=", "between" (with inclusive (low, high) bounds) and "top" or "bottom" (with a row count).
+        The rule-based parser handles the supported grammar in microseconds; spaCy is only loaded and run
+        for queries it does not understand. Parsed queries are cached, so repeated queries are free.
+
+        Args:
+            query (str): The natural language query, e.g. "Show me tracts with pollution above 9.0".
+            column_mappings (dict): The words of the query (single or multiple words) mapped to dataset columns.
+
+        Returns:
+            list: The (column, operator, value) conditions, with alternatives as one ("or", conditions) group.
+                Empty if neither parser understands the query.
+    """
+    conditions = parse_normalized(normalize_query(query), mapping_keys(column_mappings))
+    if conditions:
+        return list(conditions)
+    return parse_query_spacy(query, column_mappings)
+
+
+def parse_grouping(query):
+    """
+        Find the grouping a query asks for, e.g. "branch density by air quality level" or "tracts above 12 pm2.5 per county".
+
+        Returns:
+            list: The density cube columns to group the matching tracts by (see density_cube.group_density), or None.
+    """
+    tokens = TOKEN_PATTERN.findall(normalize_query(query))
+    for i, token in enumerate(tokens):
+        if token not in GROUP_WORDS:
+            continue
+        words = [word for word in tokens[i + 1:i + 4] if word not in ("each", "every", "the")]
+        for phrase, columns in GROUP_PHRASES:
+            if len(words) >= len(phrase) and all(same_word(word, key) for word, key in zip(words, phrase)):
+                return columns
+    return None
+
+
+# Query words mapped to the columns of the branch density and PM2.5 data
+COLUMN_MAPPINGS = {
+    "pollution": "mean_pm25_concentration",
+    "pm2.5": "mean_pm25_concentration",
+    "bank": "unique_bank_count",
+    "bank branches": "unique_bank_count",
+    "credit union": "unique_creditunion_count",
+    "credit union branches": "unique_creditunion_count",
+    "total branches": "total_branch_count",
+    "branches": "total_branch_count",
+}
+
+
 # Function to dynamically filter dataset
-def apply_conditions(conditions, df):
-    filtered_df = df
-    for column, operator, value in conditions:
-        if operator == ">":
-            filtered_df = filtered_df[filtered_df[column] > value]
-        elif operator == "<":
-            filtered_df = filtered_df[filtered_df[column] < value]
-    return filtered_df
+def apply_conditions(conditions, df, index=None):
+    """
+        Filter the dataset by the parsed conditions.
+        Every condition is answered by binary search on a sorted column index and the matching row positions
+        are intersected (or united for "or" groups), so the dataset is only copied once, for the result rows.
 
+        Args:
+            conditions (list): The conditions (see parse_query).
+            df (DataFrame): The dataset.
+            index (ColumnIndex): A prebuilt index over df. Pass one when answering many queries,
+                otherwise the columns the conditions refer to are indexed for this call.
+
+        Returns:
+            DataFrame: The matching rows, in dataset order, or ranked for "top" and "bottom" conditions.
+    """
+    from NLP.column_index import ColumnIndex, condition_columns
+
+    if index is None:
+        index = ColumnIndex(df, sorted(condition_columns(list(conditions))))
+    return index.materialize(index.evaluate(list(conditions)))
+
+
+def parse_queries(queries, column_mappings=COLUMN_MAPPINGS, batch_size=DEFAULT_BATCH_SIZE):
+    """
+        Parse many queries into their conditions and grouping, like parse_query and parse_grouping.
+        The queries outside the rule-based grammar are run through spaCy together with nlp.pipe, in batches,
+        rather than one nlp() call per query.
+
+        Returns:
+            list: The (conditions, grouping) of every query, in query order.
+    """
+    keys = mapping_keys(column_mappings)
+    parsed = [list(parse_normalized(normalize_query(query), keys)) for query in queries]
+
+    fallback = [i for i, conditions in enumerate(parsed) if not conditions]
+    nlp = get_nlp() if fallback else None
+    if nlp is not None:
+        docs = nlp.pipe((queries[i].lower() for i in fallback), batch_size=batch_size)
+        for i, doc in zip(fallback, docs):
+            parsed[i] = conditions_from_doc(doc, column_mappings)
+    return [(conditions, parse_grouping(query)) for conditions, query in zip(parsed, queries)]
+
+
+@instrumented()
+def parse_query_batches(queries, workers=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+        Parse the distinct queries in batches spread across a pool of worker processes (see parse_queries).
+        Each worker loads spaCy itself, and only if one of its queries needs it.
+
+        Args:
+            queries (list): The queries.
+            workers (int): The number of worker processes. Defaults to the number of CPUs; 1 parses in this process.
+            batch_size (int): The number of distinct queries per batch.
+
+        Returns:
+            dict: The (conditions, grouping) of every distinct query.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    distinct = list(dict.fromkeys(queries))
+    batches = [distinct[i:i + batch_size] for i in range(0, len(distinct), batch_size)]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(batches) <= 1:
+        results = [parse_queries(batch) for batch in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(batches))) as executor:
+            results = list(executor.map(parse_queries, batches))
+    return {query: parsed for batch, result in zip(batches, results) for query, parsed in zip(batch, result)}
+
+
+def condition_key(conditions, grouping):
+    """
+        Identify what a query evaluates: its conditions and grouping, whatever its wording.
+    """
+    return tuple(conditions), tuple(grouping or ())
+
+
+@instrumented()
+def answer_batch(queries, df, index=None, workers=None, batch_size=DEFAULT_BATCH_SIZE, limit=DEFAULT_BATCH_LIMIT):
+    """
+        Answer many queries at once. The queries are parsed in worker processes (see parse_query_batches), and
+        queries with the same conditions and grouping are evaluated once, so replaying a log of repeated questions
+        costs one evaluation per distinct question.
+
+        Args:
+            queries (list): The natural language queries.
+            df (DataFrame): The dataset, e.g. the tract level of the branch density cube.
+            index (ColumnIndex): A prebuilt index over df (see apply_conditions).
+            workers (int): The number of worker processes parsing the queries.
+            batch_size (int): The number of distinct queries per parsing batch.
+            limit (int): Upper bound on the rows returned per query.
+
+        Returns:
+            tuple: The JSON result of every query in query order, with the parsed conditions and grouping, the number
+                of matching rows (or groups) and the (limited) rows, or an error; and the number of distinct condition sets.
+    """
+    from Analysis.density_cube import group_density
+    from NLP.column_index import ColumnIndex
+
+    if index is None:
+        index = ColumnIndex(df, sorted(set(COLUMN_MAPPINGS.values())))
+    parsed = parse_query_batches(queries, workers, batch_size)
+
+    evaluated = {}
+    results = []
+    for query in queries:
+        conditions, grouping = parsed[query]
+        if not conditions and not grouping:
+            results.append(json.dumps({"query": query, "error": "Sorry, I couldn't understand your query."}))
+            continue
+
+        key = condition_key(conditions, grouping)
+        if key not in evaluated:
+            matches = apply_conditions(conditions, df, index)
+            if grouping:
+                matches = group_density(matches, grouping)
+            # The rows are serialized once per condition set; pandas writes missing values as null
+            evaluated[key] = (len(matches), matches.head(limit).to_json(orient="records"))
+        count, rows = evaluated[key]
+        header = json.dumps({"query": query, "conditions": conditions, "group_by": grouping, "count": count})
+        results.append(header[:-1] + ', "rows": ' + rows + "}")
+    return results, len(evaluated)
+
+
+def read_queries(queries_file):
+    """
+        Read a file of queries, one per line, skipping blank lines.
+    """
+    with open(queries_file, encoding="utf-8") as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def run_batch(queries_file, output_file, df, index=None, workers=None, batch_size=DEFAULT_BATCH_SIZE, limit=DEFAULT_BATCH_LIMIT):
+    """
+        Answer the queries of a file (see answer_batch) and write one JSON result per line, in the order of the queries.
+
+        Returns:
+            dict: The number of queries, the number of distinct condition sets, the elapsed seconds and the queries per second.
+    """
+    started = time.perf_counter()
+    queries = read_queries(queries_file)
+    results, distinct = answer_batch(queries, df, index, workers, batch_size, limit)
+    with open(output_file, "w", encoding="utf-8") as file:
+        for result in results:
+            file.write(result + "\n")
+    elapsed = time.perf_counter() - started
+
+    qps = len(queries) / elapsed if elapsed > 0 else float("inf")
+    print(f"Answered {len(queries)} queries ({distinct} distinct condition sets) in {elapsed:.2f}s: "
+          f"{qps:.0f} queries per second, written to {output_file}")
+    return {"queries": len(queries), "distinct": distinct, "seconds": elapsed, "queries_per_second": qps}
+
+
+def main(queries_file=None, output_file=None, workers=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+        Answer queries over the branch density and PM2.5 data, interactively or, given a file of queries, in batch mode.
+
+        Args:
+            queries_file (str): A file of queries, one per line, to answer in batch mode. Defaults to interactive queries.
+            output_file (str): The JSON lines file of the batch results. Defaults to the queries file name with "_results.jsonl".
+            workers (int): The number of worker processes parsing the batch. Defaults to the number of CPUs.
+            batch_size (int): The number of distinct queries per parsing batch.
+    """
+    from Analysis.density_cube import group_density, read_cube
+    from NLP.column_index import ColumnIndex
 
-def main():
-    
-    
     # Add the data directory to the path so that we can import the data files directly
     current_dir = os.path.dirname(os.path.abspath(__file__))
     parent_dir = os.path.dirname(current_dir)
     data_dir = os.path.join(parent_dir, "data/")
     sys.path.append(data_dir)
     
-    # Load the branch density and PM2.5 data
-    branch_density_pm_file = "branch_counts_with_pm25.xlsx"
-    df = pd.read_excel(branch_density_pm_file)
+    # Load the tract level of the branch density cube, which holds the queryable columns of every tract
+    df = read_cube("branch_density.db")
+
+    # Index the queryable columns once, so that every query is answered by binary search
+    with step("index_dataset", rows_in=len(df)):
+        index = ColumnIndex(df, sorted(set(COLUMN_MAPPINGS.values())))
     
+    if queries_file:
+        output_file = output_file or os.path.splitext(queries_file)[0] + "_results.jsonl"
+        run_batch(queries_file, output_file, df, index, workers, batch_size)
+        return
+
     # Prepare column mappings for easier matching
-    column_mappings = {
-        "pollution": "mean_pm25_concentration",
-        "bank": "unique_bank_count",
-        "credit union": "unique_creditunion_count",
-        "total branches": "total_branch_count",
-    }
+    column_mappings = COLUMN_MAPPINGS
     
     
     print("Welcome to the NLP Data Query Interface!")
     print("You can ask questions like:")
     print(" - Show me tracts with pollution above 9.0")
     print(" - List tracts with total branches greater than 20")
+    print(" - Show me tracts with pollution between 8 and 10 and at least 5 bank branches")
+    print(" - Top 10 tracts by pollution with more than 3 credit union branches")
+    print(" - Branch density by air quality level for tracts with at least 5 branches")
     
     while True:
         query = input("\nEnter your query (or type 'exit' to quit): ")
@@ -73,10 +620,15 @@ def main():
         
         # Parse the query
         conditions = parse_query(query, column_mappings)
+        grouping = parse_grouping(query)
         
-        if conditions:
-            # Apply conditions to the dataset
-            results = apply_conditions(conditions, df)
+        if conditions or grouping:
+            # Apply conditions to the dataset, and summarize the matching tracts per group if asked to
+            with step("answer_query", rows_in=len(df)) as record:
+                results = apply_conditions(conditions, df, index)
+                if grouping:
+                    results = group_density(results, grouping)
+                record.rows_out = len(results)
             
             if not results.empty:
                 print("\nQuery Results:")
@@ -88,4 +640,10 @@ def main():
     
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Query the branch density and PM2.5 data in natural language.")
+    parser.add_argument("--batch", metavar="QUERIES_FILE", help="Answer the queries of a file, one per line, instead of asking interactively")
+    parser.add_argument("--output", help="JSON lines file of the batch results (defaults to <QUERIES_FILE>_results.jsonl)")
+    parser.add_argument("--workers", type=int, help="Number of worker processes parsing the batch (defaults to the number of CPUs)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Number of distinct queries per parsing batch")
+    args = parser.parse_args()
+    main(args.batch, args.output, args.workers, args.batch_size)
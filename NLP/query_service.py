@@ -0,0 +1,194 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from dataclasses import dataclass
+from urllib.parse import parse_qs
+
+# Add the repository root to the path so that the shared modules can be imported when run as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Analysis.density_cube import CUBE_TABLES, group_density
+from Integration.sqlite_store import read_table
+from NLP.column_index import ColumnIndex
+from NLP.nlp_interface import COLUMN_MAPPINGS, parse_grouping, parse_query, apply_conditions
+from Pipeline.http_service import DEFAULT_HOST, DEFAULT_WORKERS, JSONRequestHandler, PooledHTTPServer
+from Pipeline.instrumentation import step
+
+# The tract level of the branch density cube written by Analysis/branch_desnity_AQI.py
+DATASET_DB = "branch_density.db"
+DATASET_TABLE = CUBE_TABLES["tract"]
+
+DEFAULT_PORT = 8080
+
+# How often (in seconds) the dataset file is checked for changes, at most
+DEFAULT_RELOAD_INTERVAL = 2.0
+
+# Upper bound on the rows returned by one query, unless the request asks for fewer
+DEFAULT_LIMIT = 1000
+
+
+def artifact_stamp(db_name):
+    """
+        Identify the current version of a SQLite database by the size and modification time of the file and its write-ahead log.
+    """
+    stamp = []
+    for path in (db_name, db_name + "-wal"):
+        try:
+            stat = os.stat(path)
+            stamp.append((stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """
+        One loaded version of the dataset with its column index. Snapshots are never modified, so requests can
+        read them without locking; a reload builds a new snapshot and swaps it in.
+    """
+    df: object
+    index: ColumnIndex
+    stamp: tuple
+    loaded_at: float
+
+
+class DatasetHolder:
+    """
+        Keeps the dataset in memory and reloads it when the database file changes.
+        Requests that are running keep the snapshot they started with, so a reload never blocks or disturbs them.
+    """
+
+    def __init__(self, db_name=DATASET_DB, table=DATASET_TABLE, reload_interval=DEFAULT_RELOAD_INTERVAL):
+        self.db_name = db_name
+        self.table = table
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.checked_at = time.monotonic()
+        self.snapshot = self.load()
+
+    def load(self):
+        with step("load_dataset") as record:
+            stamp = artifact_stamp(self.db_name)
+            df = read_table(self.db_name, self.table)
+            index = ColumnIndex(df, sorted(column for column in set(COLUMN_MAPPINGS.values()) if column in df.columns))
+            record.rows_out = len(df)
+        return Snapshot(df, index, stamp, time.time())
+
+    def get(self):
+        """
+            Return the current snapshot, reloading the dataset first if the file changed since it was loaded.
+        """
+        if time.monotonic() - self.checked_at >= self.reload_interval and self.lock.acquire(blocking=False):
+            # Only one request checks and reloads; the others keep serving the current snapshot meanwhile
+            try:
+                self.checked_at = time.monotonic()
+                if artifact_stamp(self.db_name) != self.snapshot.stamp:
+                    try:
+                        self.snapshot = self.load()
+                        print(f"Reloaded {self.db_name} ({len(self.snapshot.df)} rows)")
+                    except Exception as error:
+                        # A half-written file; keep serving the previous snapshot and try again on the next check
+                        print(f"Could not reload {self.db_name}: {error}")
+            finally:
+                self.lock.release()
+        return self.snapshot
+
+
+def answer(snapshot, query, limit=DEFAULT_LIMIT):
+    """
+        Answer a natural language query from a snapshot.
+
+        Returns:
+            str: The JSON response with the parsed conditions and grouping, the number of matching rows (or groups)
+                and the (limited) rows.
+    """
+    conditions = parse_query(query, COLUMN_MAPPINGS)
+    grouping = parse_grouping(query)
+    if not conditions and not grouping:
+        return json.dumps({"query": query, "error": "Sorry, I couldn't understand your query."}), 422
+
+    results = apply_conditions(conditions, snapshot.df, snapshot.index)
+    if grouping:
+        results = group_density(results, grouping)
+    # The rows are serialized by pandas, which writes missing values as null
+    rows = results.head(limit).to_json(orient="records")
+    header = json.dumps({"query": query, "conditions": conditions, "group_by": grouping, "count": len(results)})
+    return header[:-1] + ', "rows": ' + rows + "}", 200
+
+
+class QueryHandler(JSONRequestHandler):
+    """
+        GET /query?q=<query>[&limit=<rows>] or POST /query with a {"query": ..., "limit": ...} body,
+        and GET /health for the loaded dataset version.
+    """
+
+    def get(self, url):
+        if url.path == "/health":
+            snapshot = self.server.holder.get()
+            return self.respond(json.dumps({"rows": len(snapshot.df), "loaded_at": snapshot.loaded_at}), 200)
+        if url.path != "/query":
+            return self.respond(json.dumps({"error": "Not found"}), 404)
+
+        params = parse_qs(url.query)
+        self.query(params.get("q", [""])[0], params.get("limit", [DEFAULT_LIMIT])[0])
+
+    def post(self, url):
+        if url.path != "/query":
+            return self.respond(json.dumps({"error": "Not found"}), 404)
+        body = self.read_json()
+        if body is None:
+            return
+        self.query(body.get("query", ""), body.get("limit", DEFAULT_LIMIT))
+
+    def query(self, query, limit):
+        if not isinstance(query, str):
+            return self.respond(json.dumps({"error": "The query is not a string"}), 400)
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            return self.respond(json.dumps({"error": "The limit is not a number"}), 400)
+        if limit < 0:
+            return self.respond(json.dumps({"error": "The limit must not be negative"}), 400)
+        if not query.strip():
+            return self.respond(json.dumps({"error": "No query given"}), 400)
+        self.respond(*answer(self.server.holder.get(), query, limit))
+
+
+class QueryServer(PooledHTTPServer):
+    """
+        Query server whose workers share one dataset holder.
+    """
+
+    def __init__(self, address, holder, workers=DEFAULT_WORKERS):
+        super().__init__(address, QueryHandler, workers)
+        self.holder = holder
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve natural language queries over the branch density and PM2.5 data.")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Number of requests answered concurrently")
+    parser.add_argument("--db", default=DATASET_DB, help="SQLite database with the dataset")
+    parser.add_argument("--table", default=DATASET_TABLE, help="Table with the dataset")
+    parser.add_argument("--reload-interval", type=float, default=DEFAULT_RELOAD_INTERVAL,
+                        help="Seconds between checks of the database for changes")
+    args = parser.parse_args()
+
+    holder = DatasetHolder(args.db, args.table, args.reload_interval)
+    server = QueryServer((args.host, args.port), holder, args.workers)
+    print(f"Serving {len(holder.snapshot.df)} rows of {args.table} on http://{args.host}:{server.server_port}/query")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Goodbye!")
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import subprocess
+import multiprocessing
+from datetime import datetime, timezone
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+
+# Add the repository root to the path so that the shared modules can be imported when run as a script
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO_ROOT)
+
+from Pipeline.run_pipeline import STAGES, run_stage
+from Pipeline.synthetic_data import DEFAULT_SEED, DEFAULT_YEARS, generate, read_manifest
+from Integration.workbook_cache import CASE_STUDY_SHEETS, DEFAULT_CACHE_DIR
+from Integration.partitioning import PARTITION_WORKERS_ENV
+from Integration.sinks import ARTIFACT_FORMATS, DEFAULT_FORMAT, OUTPUT_FORMAT_ENV
+from Integration.pm25_aggregates import AGGREGATES_DIR
+from Integration.pm25_daily_store import DAILY_DIR
+from Pipeline.instrumentation import METRICS_ENV, cpu_seconds, process_peak_rss, read_peak_rss, reset_peak_rss
+
+BENCHMARK_DIR = os.path.join(REPO_ROOT, "benchmarks")
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+DATA_DIR = os.path.join(BENCHMARK_DIR, "data")
+
+# Rows of the prediction benchmark's input file
+PREDICT_ROWS = 1_000_000
+PREDICT_INPUT = "benchmark_predict_input.csv"
+PREDICT_OUTPUT = "benchmark_predictions"
+
+# The step records of the benchmarked code are collected here and added to the results
+STEPS_FILE = "benchmark_steps.jsonl"
+
+# Queries of the NLP benchmark, each answered NLP_ROUNDS times
+NLP_QUERIES = [
+    "Show me tracts with pollution above 9.0",
+    "List tracts with total branches greater than 20",
+    "Show me tracts with pollution between 8 and 10 and at least 5 bank branches",
+    "Top 10 tracts by pollution with more than 3 credit union branches",
+    "tracts with pollution below 7 or more than 10 bank branches",
+]
+NLP_ROUNDS = 200
+
+# A step is reported as a regression when it is this much slower or larger than in the baseline
+DEFAULT_THRESHOLD = 0.10
+
+
+@dataclass
+class Benchmark:
+    """
+        A benchmarked step: setup() prepares the data directory and is not timed, run() is timed and may return
+        extra metrics. Both are called in the data directory.
+    """
+    name: str
+    run: callable
+    setup: callable = None
+    outputs: tuple = ()
+
+
+def remove(*paths):
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def build_workbook_cache():
+    from Integration.workbook_cache import read_sheet
+    rows = sum(len(read_sheet(sheet_name)) for sheet_name in CASE_STUDY_SHEETS)
+    return {"rows": rows}
+
+
+def stage_benchmark(stage):
+    """
+        Benchmark a pipeline stage by running its main() like the pipeline does.
+        Stores the stage keeps between runs are cleared first, so every run does the full work.
+    """
+    def setup():
+        if stage.name == "aqi_clean":
+            remove(AGGREGATES_DIR)
+            remove(DAILY_DIR)
+        if stage.name == "model_selection":
+            from ML.model_search import CACHE_FILE
+            remove(CACHE_FILE)
+
+    def run():
+        run_stage(stage.module, os.getcwd())
+
+    return Benchmark(stage.name, run, setup, tuple(stage.output_files()))
+
+
+def write_predict_input():
+    import numpy as np
+    import pandas as pd
+    from Integration.sqlite_store import read_table
+    counts = read_table("branch_density.db", "Branch_Counts_With_PM25", columns=["unique_bank_count", "unique_creditunion_count"])
+    rows = np.resize(np.arange(len(counts)), PREDICT_ROWS)
+    pd.DataFrame(counts.to_numpy()[rows], columns=counts.columns).to_csv(PREDICT_INPUT, index=False)
+
+
+def predict_rows():
+    from ML.model_bundle import MODEL_FILE, load_bundle, predict_file
+    rows = predict_file(load_bundle(MODEL_FILE), PREDICT_INPUT, PREDICT_OUTPUT)
+    return {"rows": rows}
+
+
+def answer_queries():
+    from Analysis.density_cube import read_cube
+    from NLP.column_index import ColumnIndex
+    from NLP.nlp_interface import COLUMN_MAPPINGS, apply_conditions, parse_query
+
+    df = read_cube("branch_density.db")
+    index = ColumnIndex(df, sorted(set(COLUMN_MAPPINGS.values())))
+    start = time.perf_counter()
+    matches = 0
+    for _ in range(NLP_ROUNDS):
+        for query in NLP_QUERIES:
+            matches += len(apply_conditions(parse_query(query, COLUMN_MAPPINGS), df, index))
+    elapsed = time.perf_counter() - start
+    queries = NLP_ROUNDS * len(NLP_QUERIES)
+    return {"rows": len(df), "queries": queries, "matches": matches, "queries_per_second": queries / elapsed}
+
+
+BENCHMARKS = (
+    [Benchmark("workbook_cache", build_workbook_cache, lambda: remove(DEFAULT_CACHE_DIR))]
+    + [stage_benchmark(stage) for stage in STAGES]
+    + [Benchmark("model_predict", predict_rows, write_predict_input, (PREDICT_OUTPUT,)),
+       Benchmark("nlp_queries", answer_queries)]
+)
+
+
+def output_bytes(path):
+    """
+        The size of an output file, or of all files of a directory output.
+    """
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+    return os.path.getsize(path)
+
+
+def measure(name, data_dir):
+    """
+        Run one benchmark and measure it. This is executed in a fresh worker process, whose peak memory is reset
+        before the step runs: a spawned process inherits the peak of the process that started it (ru_maxrss survives
+        fork and exec), so without the reset every step would report the peak of the launcher.
+
+        Returns:
+            dict: The wall and CPU seconds, the peak resident memory of the step, the output file sizes, the extra
+                metrics of the step and the records of its instrumented steps.
+    """
+    benchmark = {benchmark.name: benchmark for benchmark in BENCHMARKS}[name]
+    os.chdir(data_dir)
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    if benchmark.setup:
+        benchmark.setup()
+    remove(STEPS_FILE)
+    os.environ[METRICS_ENV] = os.path.abspath(STEPS_FILE)
+
+    reset_peak_rss()
+    start_cpu = cpu_seconds()
+    start = time.perf_counter()
+    metrics = benchmark.run() or {}
+    wall = time.perf_counter() - start
+    # Without /proc the peak is the peak of the whole process, including what it inherited
+    peak_rss = read_peak_rss() or process_peak_rss()
+
+    steps = []
+    if os.path.exists(STEPS_FILE):
+        with open(STEPS_FILE) as file:
+            steps = [json.loads(line) for line in file]
+
+    return dict({
+        "name": name,
+        "wall_seconds": wall,
+        "cpu_seconds": cpu_seconds() - start_cpu,
+        "peak_rss_mb": peak_rss,
+        "output_bytes": {output: output_bytes(output) for output in benchmark.outputs if os.path.exists(output)},
+        "steps": steps,
+    }, **metrics)
+
+
+def git_revision():
+    def git(*args):
+        result = subprocess.run(["git", *args], cwd=REPO_ROOT, capture_output=True, text=True)
+        return result.stdout.strip() if result.returncode == 0 else None
+    status = git("status", "--porcelain", "--untracked-files=no")
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(status) if status is not None else None}
+
+
+def prepare_data(data_dir, scale, seed=DEFAULT_SEED, years=DEFAULT_YEARS, days=None):
+    """
+        Generate the synthetic data of a scale, unless the data directory already holds it.
+    """
+    manifest = read_manifest(data_dir)
+    wanted = {"scale": str(scale), "seed": seed, "years": list(years), "days": days}
+    if manifest is None or {key: manifest[key] for key in wanted} != wanted:
+        print(f"Generating {scale} synthetic data in {data_dir}")
+        manifest = generate(data_dir, scale, seed, years, days)
+    return manifest
+
+
+def run_benchmarks(names=None, scale="1x", data_dir=None, output_dir=RESULTS_DIR, repeat=1, seed=DEFAULT_SEED, days=None,
+                   partition_workers=0, output_format=DEFAULT_FORMAT):
+    """
+        Benchmark the pipeline stages, model prediction and NLP query evaluation on synthetic data, and save the
+        results as JSON so runs can be compared across commits (see compare_results).
+
+        Every step runs in a fresh process, in dependency order, so that each one is measured on its own and
+        reads the outputs of the steps before it. A failing step is recorded with its error and the run goes on.
+
+        Args:
+            names (list): The steps to run. Defaults to every step; the steps they depend on must have run before.
+            scale (str): The scale of the synthetic data (see synthetic_data.generate).
+            data_dir (str): The directory of the synthetic data. Defaults to benchmarks/data/<scale>.
+            output_dir (str): The directory the result file is written to.
+            repeat (int): The number of runs of every step.
+            seed (int): The random seed of the synthetic data.
+            days (int): The number of days per year of the daily PM2.5 file. Defaults to every day.
+            partition_workers (int): The number of worker processes the integration and branch density stages partition
+                their work by state over. Comparing a run with a run without them shows the speedup of the partitioning.
+            output_format (str): The format the stages write their outputs in (see sinks.output_format).
+
+        Returns:
+            str: The path of the result file.
+    """
+    benchmarks = [benchmark for benchmark in BENCHMARKS if not names or benchmark.name in names]
+    unknown = set(names or []) - {benchmark.name for benchmark in BENCHMARKS}
+    if unknown:
+        raise ValueError(f"Unknown benchmarks {sorted(unknown)}")
+
+    data_dir = os.path.abspath(data_dir or os.path.join(DATA_DIR, str(scale)))
+    manifest = prepare_data(data_dir, scale, seed, DEFAULT_YEARS, days)
+
+    # The spawned processes inherit the environment, so the stages read the setting from it
+    os.environ[PARTITION_WORKERS_ENV] = str(partition_workers)
+    os.environ[OUTPUT_FORMAT_ENV] = output_format
+
+    started = datetime.now(timezone.utc)
+    results = []
+    for benchmark in benchmarks:
+        for run in range(repeat):
+            # A spawned process starts from a clean interpreter, so it does not share the memory of this one
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                try:
+                    result = executor.submit(measure, benchmark.name, data_dir).result()
+                except Exception as error:
+                    result = {"name": benchmark.name, "error": str(error)}
+            result["run"] = run
+            results.append(result)
+            if "error" in result:
+                print(f"[{benchmark.name}] failed:\n{result['error']}")
+            else:
+                print(f"[{benchmark.name}] {result['wall_seconds']:.2f}s wall, {result['cpu_seconds']:.2f}s CPU, "
+                      f"{result['peak_rss_mb']:.0f} MB peak")
+
+    revision = git_revision()
+    report = {
+        "created": started.isoformat(),
+        "revision": revision,
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "data": manifest,
+        "partition_workers": partition_workers,
+        "output_format": output_format,
+        "results": results,
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    result_file = os.path.join(output_dir, f"{started:%Y%m%dT%H%M%S}_{(revision['commit'] or 'unknown')[:10]}_{scale}.json")
+    with open(result_file, "w") as file:
+        json.dump(report, file, indent=2)
+    return result_file
+
+
+def summarize(report):
+    """
+        Reduce the runs of every step of a report to their fastest wall time and CPU time and largest peak memory.
+    """
+    summary = {}
+    for result in report["results"]:
+        if "error" in result:
+            continue
+        best = summary.setdefault(result["name"], {"wall_seconds": float("inf"), "cpu_seconds": float("inf"), "peak_rss_mb": 0.0})
+        best["wall_seconds"] = min(best["wall_seconds"], result["wall_seconds"])
+        best["cpu_seconds"] = min(best["cpu_seconds"], result["cpu_seconds"])
+        best["peak_rss_mb"] = max(best["peak_rss_mb"], result["peak_rss_mb"])
+    return summary
+
+
+def compare_results(baseline_file, result_file, threshold=DEFAULT_THRESHOLD):
+    """
+        Compare the steps of two result files and print the change of their wall time and peak memory.
+
+        Returns:
+            list: The (step, metric) pairs that got worse by more than the threshold.
+    """
+    with open(baseline_file) as file:
+        baseline = json.load(file)
+    with open(result_file) as file:
+        current = json.load(file)
+    if baseline["data"]["replicas"] != current["data"]["replicas"]:
+        print(f"Warning: comparing {baseline['data']['scale']} data with {current['data']['scale']} data")
+
+    before, after = summarize(baseline), summarize(current)
+    regressions = []
+    print(f"{'step':<26}{'wall (s)':>22}{'change':>9}{'peak RSS (MB)':>22}{'change':>9}")
+    for name in after:
+        if name not in before:
+            continue
+        line = f"{name:<26}"
+        for metric in ("wall_seconds", "peak_rss_mb"):
+            old, new = before[name][metric], after[name][metric]
+            change = new / old - 1 if old else 0.0
+            if change > threshold:
+                regressions.append((name, metric))
+            line += f"{old:>11.2f} -> {new:>7.2f}{change:>+9.1%}"
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic data and compare benchmark results.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks and save the results")
+    run_parser.add_argument("names", nargs="*", help="Steps to run (defaults to all): " + ", ".join(benchmark.name for benchmark in BENCHMARKS))
+    run_parser.add_argument("--scale", default="1x", help="1x, 10x, 100x, all or a number of replicas of the sample data")
+    run_parser.add_argument("--data-dir", help="Directory of the synthetic data (defaults to benchmarks/data/<scale>)")
+    run_parser.add_argument("--output-dir", default=RESULTS_DIR, help="Directory the result file is written to")
+    run_parser.add_argument("--repeat", type=int, default=1, help="Runs of every step")
+    run_parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help="Random seed of the synthetic data")
+    run_parser.add_argument("--days", type=int, help="Days per year of the daily PM2.5 file (defaults to every day)")
+    run_parser.add_argument("--partition-workers", type=int, default=0, help="Partition the integration and branch density stages by state over this many worker processes")
+    run_parser.add_argument("--output-format", choices=ARTIFACT_FORMATS, default=DEFAULT_FORMAT, help="Format the stages write their outputs in")
+
+    compare_parser = commands.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("baseline", help="Result file of the baseline")
+    compare_parser.add_argument("result", help="Result file to compare with the baseline")
+    compare_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        result_file = run_benchmarks(args.names, args.scale, args.data_dir, args.output_dir, args.repeat, args.seed, args.days,
+                                     args.partition_workers, args.output_format)
+        print(f"Benchmark results saved to {result_file}")
+    else:
+        regressions = compare_results(args.baseline, args.result, args.threshold)
+        if regressions:
+            print("\nRegressions: " + ", ".join(f"{name} ({metric})" for name, metric in regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
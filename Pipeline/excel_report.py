@@ -0,0 +1,63 @@
+import os
+import sys
+import argparse
+
+# Add the repository root to the path so that the shared modules can be imported when run as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Integration.sinks import ARTIFACT_FORMATS, EXCEL_MAX_ROWS, output_format, output_path, output_tables, read_output, write_output
+from Pipeline.instrumentation import stage, step
+
+# The stage outputs that are exported as workbooks, under the names of the workbooks the stages used to write
+REPORT_OUTPUTS = [
+    "Integrated_with_PM25",
+    "integrated_all_data",
+    "integrated_filtered_data",
+    "branch_counts",
+    "branch_counts_aqi",
+    "branch_counts_with_pm25",
+]
+
+
+@stage("excel_report")
+def main(outputs=REPORT_OUTPUTS, format=None):
+    """
+        Export the stage outputs to Excel workbooks with one sheet per table, e.g. branch_counts.arrow to branch_counts.xlsx.
+        The stages no longer write Excel files themselves, so this is an optional final step for reading the results in Excel.
+        Tables with more rows than an Excel sheet holds are left out of their workbook, and missing outputs are skipped.
+
+        Args:
+            outputs (list): The outputs to export, without extension.
+            format (str): The format the outputs were written in (see sinks.output_format).
+    """
+    if output_format(format) not in ARTIFACT_FORMATS:
+        raise ValueError(f"The outputs are already written in the {output_format(format)} format")
+
+    for stem in outputs:
+        path = output_path(stem, format)
+        if not os.path.exists(path):
+            print(path, "does not exist, skipped")
+            continue
+
+        with step("read_output") as record:
+            tables = {table: read_output(path, table) for table in output_tables(path)}
+            record.rows_out = sum(len(df) for df in tables.values())
+
+        for table, df in list(tables.items()):
+            if len(df) >= EXCEL_MAX_ROWS:
+                print(f"{stem}: table {table} has {len(df):,} rows, more than an Excel sheet holds, left out")
+                del tables[table]
+        if not tables:
+            continue
+
+        with step("write_excel", rows_in=sum(len(df) for df in tables.values())):
+            report_file = write_output(tables, stem, "excel")
+        print(path, "exported to", report_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the stage outputs to Excel workbooks.")
+    parser.add_argument("outputs", nargs="*", default=REPORT_OUTPUTS, help="Outputs to export, without extension")
+    parser.add_argument("--output-format", choices=ARTIFACT_FORMATS, help="Format the outputs were written in (defaults to the PIPELINE_OUTPUT_FORMAT variable or arrow)")
+    args = parser.parse_args()
+    main(args.outputs, args.output_format)
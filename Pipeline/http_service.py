@@ -0,0 +1,86 @@
+import json
+import threading
+import traceback
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+# Defaults shared by the long-running services (NLP/query_service.py and ML/model_server.py)
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_WORKERS = 8
+
+# Keep-alive connections idle for longer than this (in seconds) are closed
+DEFAULT_IDLE_TIMEOUT = 5.0
+
+
+class JSONRequestHandler(BaseHTTPRequestHandler):
+    """
+        Request handler with keep-alive connections and JSON bodies.
+        Subclasses answer requests in get() and post(), each holding one of the server's workers (see PooledHTTPServer).
+        They may return a callable that finishes the request after the worker is released, for a request that only waits,
+        e.g. for its micro-batch, so waiting requests do not keep the other requests from being answered.
+        A request that fails with an unexpected error gets a 500 response, so the client is not left without an answer.
+    """
+    protocol_version = "HTTP/1.1"
+    timeout = DEFAULT_IDLE_TIMEOUT
+
+    def do_GET(self):
+        self.dispatch(self.get)
+
+    def do_POST(self):
+        self.dispatch(self.post)
+
+    def dispatch(self, method):
+        try:
+            with self.server.workers:
+                finish = method(urlparse(self.path))
+            if finish is not None:
+                finish()
+        except ConnectionError:
+            # The client is gone, so there is no one to respond to
+            raise
+        except Exception as error:
+            # e.g. a corrupt database, or a dataset without a column a query refers to
+            traceback.print_exc()
+            self.respond(json.dumps({"error": f"{type(error).__name__}: {error}"}), 500)
+
+    def read_json(self):
+        """
+            Read the JSON object in the body of the request, or respond with an error and return None if it is not one.
+        """
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            self.respond(json.dumps({"error": "The body is not valid JSON"}), 400)
+            return None
+        if not isinstance(body, dict):
+            self.respond(json.dumps({"error": "The body is not a JSON object"}), 400)
+            return None
+        return body
+
+    def respond(self, body, status):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Logging every request to stderr would dominate the cost of a query
+        pass
+
+
+class PooledHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+        HTTP server that reads every connection on its own thread, but answers at most `workers` requests at a time.
+        Between requests a keep-alive connection only holds its thread, not a worker, so idle connections never make
+        other clients' requests wait; connections idle for longer than the handler's timeout are closed.
+    """
+    daemon_threads = True
+    # Connections opened in a burst wait in the listen queue instead of being dropped and retried a second later
+    request_queue_size = 128
+
+    def __init__(self, address, handler, workers=DEFAULT_WORKERS):
+        super().__init__(address, handler)
+        self.workers = threading.BoundedSemaphore(workers)
@@ -0,0 +1,327 @@
+import os
+import sys
+import json
+import time
+import resource
+import functools
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Where the step records are written as JSON lines: a file (appended to), "-" for stderr, or "off".
+# Unset, only the records of pipeline stages (see stage) are appended to the default file, in the working directory of the stage,
+# so calling an instrumented function from a library or a shell leaves no file behind.
+METRICS_ENV = "PIPELINE_METRICS"
+DEFAULT_METRICS_FILE = "pipeline_metrics.jsonl"
+
+# The name of the running stage, set by stage() so the worker processes it starts attribute their records to it
+STAGE_ENV = "PIPELINE_STAGE"
+
+# The stages to profile: a comma-separated list of stage names or "all"; unset profiles nothing
+PROFILE_ENV = "PIPELINE_PROFILE"
+# "cprofile" for deterministic profiles or "sampling" for sampled stacks, which slow the stage down far less
+PROFILER_ENV = "PIPELINE_PROFILER"
+PROFILE_DIR_ENV = "PIPELINE_PROFILE_DIR"
+DEFAULT_PROFILE_DIR = "profiles"
+PROFILERS = ("cprofile", "sampling")
+
+# Seconds between two stack samples of the sampling profiler
+SAMPLE_INTERVAL = 0.005
+
+# Functions listed in the text summary of a cProfile dump
+PROFILE_SUMMARY_LINES = 40
+
+# The open steps of every thread, innermost last
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def open_steps():
+    if not hasattr(_local, "steps"):
+        _local.steps = []
+    return _local.steps
+
+
+def current_stage():
+    """
+        The name of the stage the current thread runs in, or None outside of any stage.
+    """
+    return next((step.name for step in reversed(open_steps()) if step.kind == "stage"), None) or os.environ.get(STAGE_ENV)
+
+
+def array_types():
+    """
+        The frame and array types of pandas and numpy, as far as they are imported.
+    """
+    types = []
+    if "pandas" in sys.modules:
+        types += [sys.modules["pandas"].DataFrame, sys.modules["pandas"].Series]
+    if "numpy" in sys.modules:
+        types.append(sys.modules["numpy"].ndarray)
+    return tuple(types)
+
+
+def count_rows(value):
+    """
+        The number of rows of a step's input or output: the length of a frame or array, the sum over a list, tuple or
+        dict of them, or None for anything else.
+    """
+    # A frame or array can only be passed once pandas or numpy is imported, so instrumenting a module does not import them
+    if isinstance(value, array_types()):
+        return len(value)
+    if isinstance(value, (list, tuple)) or isinstance(value, dict):
+        counts = [count_rows(item) for item in (value.values() if isinstance(value, dict) else value)]
+        counts = [count for count in counts if count is not None]
+        return sum(counts) if counts else None
+    return None
+
+
+def read_peak_rss():
+    """
+        Return the peak resident memory (in MB) since it was last reset, or None where /proc is not available.
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """
+        Reset the peak resident memory of the whole process to the current one (Linux only). Only a stage does this,
+        when it starts, since it resets the peak for every thread of the process.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def process_peak_rss():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == "darwin" else 1024)
+
+
+def cpu_seconds():
+    """
+        The CPU time of this process and its finished worker processes.
+    """
+    return sum(usage.ru_utime + usage.ru_stime for usage in (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+
+class Step:
+    """
+        The measurements of one named step. Set rows_in and rows_out inside the step to record the rows it reads and writes.
+        The peak memory of a stage is its own; the peak of a step within a stage is the peak of the stage up to the end of the step.
+    """
+
+    def __init__(self, name, kind="step", rows_in=None, rows_out=None):
+        self.name = name
+        self.kind = kind
+        self.rows_in = rows_in
+        self.rows_out = rows_out
+        self.status = "ok"
+        self.path = "/".join([step.name for step in open_steps()] + [name])
+        self.stage = name if kind == "stage" else current_stage()
+        self.peak_rss_mb = None
+
+    def start(self):
+        if self.kind == "stage":
+            reset_peak_rss()
+        open_steps().append(self)
+        self.started = datetime.now(timezone.utc)
+        self.start_cpu = cpu_seconds()
+        self.start_wall = time.perf_counter()
+
+    def finish(self):
+        wall = time.perf_counter() - self.start_wall
+        cpu = cpu_seconds() - self.start_cpu
+        open_steps().remove(self)
+
+        # Without /proc the peak is the peak of the whole process so far
+        self.peak_rss_mb = read_peak_rss() or process_peak_rss()
+
+        emit({
+            "time": self.started.isoformat(),
+            "pid": os.getpid(),
+            "kind": self.kind,
+            "stage": self.stage,
+            "step": self.name,
+            "path": self.path,
+            "status": self.status,
+            "wall_seconds": round(wall, 6),
+            "cpu_seconds": round(cpu, 6),
+            "peak_rss_mb": round(self.peak_rss_mb, 1),
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+        })
+
+
+def emit(record):
+    """
+        Write one record as a JSON line to the metrics destination (see METRICS_ENV).
+    """
+    destination = os.environ.get(METRICS_ENV) or (DEFAULT_METRICS_FILE if record.get("stage") or current_stage() else "off")
+    if destination.lower() == "off":
+        return
+    line = json.dumps(record, default=str) + "\n"
+    with _write_lock:
+        if destination == "-":
+            sys.stderr.write(line)
+        else:
+            with open(destination, "a") as file:
+                file.write(line)
+
+
+@contextmanager
+def step(name, rows_in=None, rows_out=None, kind="step"):
+    """
+        Measure the wall time, CPU time, peak resident memory and rows in and out of a named step, and emit them as
+        one JSON line when the step ends, also when it raises. Steps can be nested; the record's path names the
+        enclosing steps.
+
+        Example:
+            with step("merge_pm25", rows_in=len(sod_data)) as record:
+                merged = pd.merge(sod_data, aqi_means, on="census_tract")
+                record.rows_out = len(merged)
+    """
+    record = Step(name, kind, rows_in, rows_out)
+    record.start()
+    try:
+        yield record
+    except BaseException:
+        record.status = "error"
+        raise
+    finally:
+        record.finish()
+
+
+def profiled_stages():
+    value = os.environ.get(PROFILE_ENV, "")
+    return {name.strip() for name in value.split(",") if name.strip()}
+
+
+@contextmanager
+def stage(name):
+    """
+        A step around the whole of a pipeline stage, i.e. a script's main(). It resets the peak memory of the process,
+        and the records of the stage and of the worker processes it starts are written to the metrics file by default.
+        When the stage is selected for profiling (see PROFILE_ENV), it also runs under the chosen profiler and the
+        profile is saved to the profile directory.
+    """
+    profiled = profiled_stages()
+    profiler = None
+    if name in profiled or "all" in profiled:
+        kind = os.environ.get(PROFILER_ENV, PROFILERS[0])
+        if kind not in PROFILERS:
+            raise ValueError(f"Unknown profiler {kind}, expected one of {PROFILERS}")
+        profiler = CProfiler() if kind == "cprofile" else SamplingProfiler()
+
+    outer_stage = os.environ.get(STAGE_ENV)
+    os.environ[STAGE_ENV] = name
+    try:
+        with step(name, kind="stage") as record:
+            if profiler is None:
+                yield record
+                return
+            profiler.start()
+            try:
+                yield record
+            finally:
+                profiler.stop()
+                profile_dir = os.environ.get(PROFILE_DIR_ENV, DEFAULT_PROFILE_DIR)
+                os.makedirs(profile_dir, exist_ok=True)
+                path = profiler.save(os.path.join(profile_dir, f"{name}-{record.started:%Y%m%dT%H%M%S}"))
+                print(f"Profile of {name} saved to {path}")
+    finally:
+        if outer_stage is None:
+            os.environ.pop(STAGE_ENV, None)
+        else:
+            os.environ[STAGE_ENV] = outer_stage
+
+
+def instrumented(name=None):
+    """
+        Decorate a function to run it as a step. The rows in are counted from the frame and array arguments,
+        and the rows out from the result (see count_rows).
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            rows_in = count_rows(list(args) + list(kwargs.values()))
+            with step(name or function.__name__, rows_in) as record:
+                result = function(*args, **kwargs)
+                record.rows_out = count_rows(result)
+                return result
+        return wrapper
+    return decorate
+
+
+class CProfiler:
+    """
+        Deterministic profile of every function call, saved as a pstats file and a text summary.
+    """
+
+    def __init__(self):
+        # The profilers are only imported when a stage is profiled, so instrumenting a module stays cheap to import
+        import cProfile
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def save(self, path):
+        import pstats
+        self.profile.dump_stats(path + ".prof")
+        with open(path + ".txt", "w") as file:
+            pstats.Stats(self.profile, stream=file).sort_stats("cumulative").print_stats(PROFILE_SUMMARY_LINES)
+        return path + ".prof"
+
+
+class SamplingProfiler:
+    """
+        Samples the stack of the profiled thread every SAMPLE_INTERVAL seconds from a background thread, and saves
+        the sample counts of every stack in the folded format read by flame graph tools (e.g. flamegraph.pl, speedscope).
+        Unlike cProfile, the profiled code runs at close to full speed.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = Counter()
+        self.thread_id = threading.get_ident()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.sampler.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def save(self, path):
+        with open(path + ".folded", "w") as file:
+            for stack, count in self.samples.most_common():
+                file.write(f"{stack} {count}\n")
+        return path + ".folded"
@@ -0,0 +1,433 @@
+import os
+import sys
+import ast
+import glob
+import json
+import hashlib
+import argparse
+import importlib
+import traceback
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# Add the repository root to the path so that the shared modules can be imported when run as a script
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO_ROOT)
+
+from Integration.workbook_cache import CASE_STUDY_FILE, file_hash
+from Integration.data_AQI_clean import DAILY_FILES_PATTERN
+from Integration.pm25_aggregates import AGGREGATES_DIR, AGGREGATES_FILE, MEANS_STEM
+from Integration.pm25_daily_store import DAILY_DIR, INDEX_FILE
+from Integration.delta_ingestion import INCREMENTAL_ENV
+from Integration.partitioning import PARTITION_WORKERS_ENV
+from Integration.sinks import ARTIFACT_FORMATS, OUTPUT_FORMAT_ENV, output_path
+from Pipeline.excel_report import REPORT_OUTPUTS
+from Pipeline.instrumentation import METRICS_ENV, PROFILE_ENV, PROFILER_ENV, PROFILERS
+
+# The fingerprints of the last successful run of every stage are kept next to the data files
+STATE_FILE = ".pipeline_state.json"
+
+PM25_AGGREGATES = os.path.join(AGGREGATES_DIR, AGGREGATES_FILE)
+PM25_DAILY_INDEX = os.path.join(DAILY_DIR, INDEX_FILE)
+# Exported tract means in any output format, which stand in for the years the aggregate store lacks
+PM25_MEANS = MEANS_STEM.format("*") + ".*"
+
+
+def module_file(name):
+    """
+        The file of a module of the repository, or None for other modules (e.g. pandas).
+    """
+    path = os.path.join(REPO_ROOT, *name.split("."))
+    for candidate in (path + ".py", os.path.join(path, "__init__.py")):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def imported_files(module):
+    """
+        The files of a module and of every repository module it imports, directly or through other repository modules,
+        found from their import statements (including the ones inside functions) without importing them.
+    """
+    files = set()
+    todo = [module]
+    while todo:
+        name = todo.pop()
+        path = module_file(name)
+        if path is None or path in files:
+            continue
+        files.add(path)
+        with open(path, encoding="utf-8") as file:
+            tree = ast.parse(file.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                todo.extend(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+                # The imported names may be submodules of a package
+                todo.append(node.module)
+                todo.extend(f"{node.module}.{alias.name}" for alias in node.names)
+    return sorted(files)
+
+
+@dataclass
+class Stage:
+    """
+        A pipeline stage: the main() of one script, the files it reads and writes, and the stages it depends on.
+        Inputs may be glob patterns; a pattern that matches nothing is fingerprinted as an empty list of files.
+        Artifacts are the outputs written through the sinks (see sinks.write_output), named without extension because
+        their path depends on the output format. Optional outputs may be left out by a run (e.g. the workbooks of the Excel report,
+        which skips the tables an Excel sheet cannot hold); the others have to be written. Optional stages only run when they are targeted.
+        The code a stage is fingerprinted from is its module and the repository modules it imports (see imported_files),
+        plus any other code files it runs, listed relative to the repository root.
+    """
+    name: str
+    module: str
+    inputs: list
+    outputs: list
+    depends_on: list = field(default_factory=list)
+    code: list = field(default_factory=list)
+    input_artifacts: list = field(default_factory=list)
+    output_artifacts: list = field(default_factory=list)
+    optional_outputs: list = field(default_factory=list)
+    optional: bool = False
+
+    def code_files(self):
+        return sorted(set(imported_files(self.module)) | {os.path.join(REPO_ROOT, path) for path in self.code})
+
+    def input_files(self):
+        return self.inputs + [output_path(stem) for stem in self.input_artifacts]
+
+    def required_outputs(self):
+        return self.outputs + [output_path(stem) for stem in self.output_artifacts]
+
+    def output_files(self):
+        return self.required_outputs() + self.optional_outputs
+
+
+STAGES = [
+    Stage("aqi_clean", "Integration.data_AQI_clean",
+          inputs=[DAILY_FILES_PATTERN], outputs=[PM25_AGGREGATES, PM25_DAILY_INDEX]),
+    Stage("aqi_integrate", "Integration.data_AQI_integrate",
+          inputs=[CASE_STUDY_FILE, PM25_AGGREGATES, PM25_MEANS], outputs=["integrated_with_pm25.db"], output_artifacts=["Integrated_with_PM25"],
+          depends_on=["aqi_clean"]),
+    Stage("integrate_all", "Integration.data_integrate_all",
+          inputs=[CASE_STUDY_FILE], outputs=["integrated_all_data.db"], output_artifacts=["integrated_all_data"]),
+    Stage("integrate_filtered", "Integration.data_integrate_filtered",
+          inputs=[CASE_STUDY_FILE], outputs=["integrated_filtered_data.db"], output_artifacts=["integrated_filtered_data"]),
+    Stage("branch_density_original", "Analysis.branch_density_original",
+          inputs=[CASE_STUDY_FILE, "integrated_filtered_data.db"], outputs=[], output_artifacts=["branch_counts"],
+          depends_on=["integrate_filtered"]),
+    Stage("branch_density_aqi", "Analysis.branch_desnity_AQI",
+          inputs=[CASE_STUDY_FILE, "integrated_with_pm25.db", PM25_AGGREGATES, PM25_MEANS],
+          outputs=["branch_density.db"], output_artifacts=["branch_counts_aqi", "branch_counts_with_pm25"],
+          depends_on=["aqi_integrate"]),
+    Stage("correlation", "Analysis.correlation_analysis",
+          inputs=["branch_density.db"], outputs=["correlation_heatmap.png", "correlation_summary.csv"],
+          depends_on=["branch_density_aqi"]),
+    Stage("model_selection", "ML.model_selection",
+          inputs=[], input_artifacts=["branch_counts_with_pm25"], outputs=["random_forest_model.pkl", "random_forest_model.forest", "random_forest_model.table.npz",
+                   "predicted_pm25_vs_branch_count.png"],
+          depends_on=["branch_density_aqi"]),
+    Stage("excel_report", "Pipeline.excel_report",
+          inputs=[], input_artifacts=REPORT_OUTPUTS, outputs=[], optional_outputs=[output_path(stem, "excel") for stem in REPORT_OUTPUTS],
+          depends_on=["aqi_integrate", "integrate_all", "integrate_filtered", "branch_density_original", "branch_density_aqi"], optional=True),
+]
+
+
+def validate(stages):
+    """
+        Check that the stages form a DAG with known dependencies and that no two stages write the same file.
+    """
+    names = {stage.name for stage in stages}
+    writers = {}
+    for stage in stages:
+        for dependency in stage.depends_on:
+            if dependency not in names:
+                raise ValueError(f"Stage {stage.name} depends on unknown stage {dependency}")
+        for output in stage.output_files():
+            if output in writers:
+                raise ValueError(f"Stages {writers[output]} and {stage.name} both write {output}")
+            writers[output] = stage.name
+
+    # Every stage must be reachable in a topological order, otherwise there is a cycle
+    ordered = set()
+    while len(ordered) < len(stages):
+        ready = [stage.name for stage in stages if stage.name not in ordered and set(stage.depends_on) <= ordered]
+        if not ready:
+            raise ValueError("The pipeline stages contain a dependency cycle")
+        ordered.update(ready)
+
+
+def select(stages, targets):
+    """
+        Return the stages needed to build the target stages, i.e. the targets and everything upstream of them.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    needed = set()
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in by_name:
+            raise ValueError(f"Unknown stage {name}")
+        if name not in needed:
+            needed.add(name)
+            todo.extend(by_name[name].depends_on)
+    return [stage for stage in stages if stage.name in needed]
+
+
+def expand(paths):
+    """
+        Expand glob patterns into the sorted list of existing files.
+        Literal paths are kept so that a missing input is reported instead of silently ignored.
+    """
+    files = []
+    for path in paths:
+        if glob.has_magic(path):
+            files.extend(sorted(glob.glob(path)))
+        else:
+            files.append(path)
+    return files
+
+
+class FileHasher:
+    """
+        Hash files by content, remembering each hash with the file's size and modification time so unchanged files are not re-read.
+    """
+
+    def __init__(self, stamps):
+        self.stamps = stamps
+
+    def stat(self, path):
+        stat = os.stat(path)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def __call__(self, path):
+        if os.path.isdir(path):
+            return self.hash_directory(path)
+        stamp = self.stat(path)
+        saved = self.stamps.get(path)
+        if saved is None or {k: saved[k] for k in stamp} != stamp:
+            saved = dict(stamp, hash=file_hash(path))
+            self.stamps[path] = saved
+        return saved["hash"]
+
+    def hash_directory(self, path):
+        """
+            Hash a directory output (e.g. the Arrow files of a stage) by the names and content hashes of its files.
+        """
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file = os.path.join(root, name)
+                digest.update(f"{os.path.relpath(file, path)}:{self(file)}".encode())
+        return digest.hexdigest()
+
+
+def fingerprint(stage, hasher):
+    """
+        Fingerprint a stage from the content of its code files and input files.
+    """
+    digest = hashlib.sha256(stage.module.encode())
+    for path in stage.code_files():
+        digest.update(f"code:{os.path.relpath(path, REPO_ROOT)}:{file_hash(path)}".encode())
+    for path in expand(stage.input_files()):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Input {path} of stage {stage.name} does not exist")
+        digest.update(f"input:{path}:{hasher(path)}".encode())
+    return digest.hexdigest()
+
+
+def is_up_to_date(stage, stage_fingerprint, state, hasher):
+    """
+        A stage can be skipped when its fingerprint matches the last successful run and its outputs are unchanged since.
+        An optional output that the last run left out has to still be missing.
+    """
+    saved = state.get(stage.name)
+    if saved is None or saved["fingerprint"] != stage_fingerprint:
+        return False
+    current = output_hashes(stage, hasher)
+    return all(current[output] == saved["outputs"].get(output) for output in stage.output_files())
+
+
+def output_hashes(stage, hasher):
+    """
+        The content hashes of the outputs of a stage, with None for the outputs that do not exist.
+    """
+    return {output: hasher(output) if os.path.exists(output) else None for output in stage.output_files()}
+
+
+def run_stage(module_name, data_dir):
+    """
+        Run the main() of a stage module in the data directory. This is executed in a worker process.
+    """
+    os.chdir(data_dir)
+    # The stages save their plots to files, so a non-interactive backend keeps them from blocking on a window
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    module = importlib.import_module(module_name)
+    try:
+        module.main()
+    except Exception:
+        # Send the traceback back as text because not every exception raised by a stage can be pickled
+        raise RuntimeError(traceback.format_exc())
+
+
+def load_state(state_file):
+    if not os.path.exists(state_file):
+        return {"stages": {}, "files": {}}
+    with open(state_file) as file:
+        return json.load(file)
+
+
+def save_state(state, state_file):
+    with open(state_file + ".tmp", "w") as file:
+        json.dump(state, file, indent=2)
+    os.replace(state_file + ".tmp", state_file)
+
+
+def run_pipeline(targets=None, data_dir=".", workers=None, force=False, dry_run=False, stages=STAGES):
+    """
+        Run the pipeline stages in dependency order, skipping the stages whose code and inputs did not change.
+        Stages whose dependencies are satisfied run concurrently in a process pool.
+
+        Args:
+            targets (list): The stages to build, along with everything upstream of them. Defaults to all stages but the optional ones.
+            data_dir (str): The directory holding the data files, which every stage runs in.
+            workers (int): The number of worker processes. Defaults to the number of CPUs.
+            force (bool): Whether to run the stages even if they are up to date.
+            dry_run (bool): Whether to only report which stages would run.
+
+        Returns:
+            dict: The outcome of every stage: "ran", "skipped", "would run", "failed" or "blocked".
+    """
+    validate(stages)
+    stages = select(stages, targets) if targets else [stage for stage in stages if not stage.optional]
+    data_dir = os.path.abspath(data_dir)
+    workers = workers or os.cpu_count() or 1
+
+    cwd = os.getcwd()
+    os.chdir(data_dir)
+    try:
+        state = load_state(STATE_FILE)
+        hasher = FileHasher(state["files"])
+        outcome = {}
+        running = {}
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while len(outcome) < len(stages):
+                for stage in stages:
+                    if stage.name in outcome or stage.name in running:
+                        continue
+                    upstream = [outcome.get(dependency) for dependency in stage.depends_on]
+                    if any(result in ("failed", "blocked") for result in upstream):
+                        outcome[stage.name] = "blocked"
+                        print(f"[{stage.name}] blocked by a failed upstream stage")
+                        continue
+                    if not all(result in ("ran", "skipped", "would run") for result in upstream):
+                        continue
+
+                    try:
+                        stage_fingerprint = fingerprint(stage, hasher)
+                    except FileNotFoundError as error:
+                        outcome[stage.name] = "failed"
+                        print(f"[{stage.name}] {error}")
+                        continue
+
+                    upstream_reran = any(result == "would run" for result in upstream)
+                    if not force and not upstream_reran and is_up_to_date(stage, stage_fingerprint, state["stages"], hasher):
+                        outcome[stage.name] = "skipped"
+                        print(f"[{stage.name}] up to date, skipped")
+                    elif dry_run:
+                        outcome[stage.name] = "would run"
+                        print(f"[{stage.name}] would run")
+                    else:
+                        print(f"[{stage.name}] running")
+                        future = executor.submit(run_stage, stage.module, data_dir)
+                        running[stage.name] = (future, stage, stage_fingerprint)
+
+                if not running:
+                    continue
+
+                done, _ = wait([future for future, _, _ in running.values()], return_when=FIRST_COMPLETED)
+                for name, (future, stage, stage_fingerprint) in list(running.items()):
+                    if future not in done:
+                        continue
+                    del running[name]
+                    try:
+                        future.result()
+                    except Exception as error:
+                        outcome[name] = "failed"
+                        print(f"[{name}] failed:\n{error}")
+                        continue
+
+                    # A stage that returned without writing its outputs failed, even if it raised no error
+                    missing = [output for output in stage.required_outputs() if not os.path.exists(output)]
+                    if missing:
+                        outcome[name] = "failed"
+                        print(f"[{name}] failed: did not write {', '.join(missing)}")
+                        continue
+
+                    outcome[name] = "ran"
+                    state["stages"][name] = {
+                        "fingerprint": stage_fingerprint,
+                        "outputs": output_hashes(stage, hasher),
+                    }
+                    save_state(state, STATE_FILE)
+                    print(f"[{name}] done")
+
+        save_state(state, STATE_FILE)
+        return outcome
+    finally:
+        os.chdir(cwd)
+
+
+def main():
+    """
+        Command line entry point of the pipeline runner.
+        Run it from the data directory (or pass --data-dir), like the individual scripts.
+    """
+    parser = argparse.ArgumentParser(description="Run the data pipeline, skipping the stages that are up to date.")
+    parser.add_argument("targets", nargs="*", help="Stages to build (with everything upstream). Defaults to all stages.")
+    parser.add_argument("--data-dir", default=".", help="Directory holding the data files")
+    parser.add_argument("--workers", type=int, help="Number of worker processes")
+    parser.add_argument("--force", action="store_true", help="Run the stages even if they are up to date")
+    parser.add_argument("--dry-run", action="store_true", help="Only report which stages would run")
+    parser.add_argument("--list", action="store_true", help="List the stages and exit")
+    parser.add_argument("--metrics", help="File the step metrics are appended to as JSON lines ('-' for stderr, 'off' to disable)")
+    parser.add_argument("--profile", nargs="+", metavar="STAGE", help="Stages to profile ('all' for every stage)")
+    parser.add_argument("--profiler", choices=PROFILERS, default=PROFILERS[0], help="Profiler of the profiled stages")
+    parser.add_argument("--partition-workers", type=int, help="Partition the integration and branch density stages by state over this many worker processes each")
+    parser.add_argument("--output-format", choices=ARTIFACT_FORMATS, help="Format the stages write their outputs in (default: arrow)")
+    parser.add_argument("--incremental", action="store_true", help="Let the integration stages only integrate the census tracts whose SOD or NCUA rows changed")
+    args = parser.parse_args()
+
+    # The stages read these settings from the environment, which the worker processes inherit
+    if args.metrics:
+        os.environ[METRICS_ENV] = os.path.abspath(args.metrics) if args.metrics not in ("-", "off") else args.metrics
+    if args.profile:
+        os.environ[PROFILE_ENV] = ",".join(args.profile)
+        os.environ[PROFILER_ENV] = args.profiler
+    if args.partition_workers is not None:
+        os.environ[PARTITION_WORKERS_ENV] = str(args.partition_workers)
+    if args.output_format:
+        os.environ[OUTPUT_FORMAT_ENV] = args.output_format
+    if args.incremental:
+        os.environ[INCREMENTAL_ENV] = "1"
+
+    if args.list:
+        for stage in STAGES:
+            print(f"{stage.name}: {stage.module} <- {', '.join(stage.depends_on) or '-'}" + (" (optional)" if stage.optional else ""))
+        return
+
+    outcome = run_pipeline(args.targets, args.data_dir, args.workers, args.force, args.dry_run)
+
+    print("\nPipeline summary:")
+    for name, result in outcome.items():
+        print(f"  {name}: {result}")
+
+    if any(result in ("failed", "blocked") for result in outcome.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
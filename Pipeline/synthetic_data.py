@@ -0,0 +1,355 @@
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# Add the repository root to the path so that the shared modules can be imported when run as a script
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO_ROOT)
+
+from Integration.workbook_cache import CASE_STUDY_FILE, CASE_STUDY_SHEETS
+
+# The Illinois sample workbook every synthetic workbook is modelled on
+TEMPLATE_FILE = os.path.join(REPO_ROOT, "Data", CASE_STUDY_FILE)
+
+MANIFEST_FILE = "synthetic_manifest.json"
+
+DEFAULT_SEED = 42
+DEFAULT_YEARS = (2020,)
+
+# The FIPS code, postal code and name of every state (and DC), starting with the state of the sample
+STATES = [
+    (17, "IL", "Illinois"), (1, "AL", "Alabama"), (2, "AK", "Alaska"), (4, "AZ", "Arizona"), (5, "AR", "Arkansas"),
+    (6, "CA", "California"), (8, "CO", "Colorado"), (9, "CT", "Connecticut"), (10, "DE", "Delaware"),
+    (11, "DC", "District of Columbia"), (12, "FL", "Florida"), (13, "GA", "Georgia"), (15, "HI", "Hawaii"),
+    (16, "ID", "Idaho"), (18, "IN", "Indiana"), (19, "IA", "Iowa"), (20, "KS", "Kansas"), (21, "KY", "Kentucky"),
+    (22, "LA", "Louisiana"), (23, "ME", "Maine"), (24, "MD", "Maryland"), (25, "MA", "Massachusetts"),
+    (26, "MI", "Michigan"), (27, "MN", "Minnesota"), (28, "MS", "Mississippi"), (29, "MO", "Missouri"),
+    (30, "MT", "Montana"), (31, "NE", "Nebraska"), (32, "NV", "Nevada"), (33, "NH", "New Hampshire"),
+    (34, "NJ", "New Jersey"), (35, "NM", "New Mexico"), (36, "NY", "New York"), (37, "NC", "North Carolina"),
+    (38, "ND", "North Dakota"), (39, "OH", "Ohio"), (40, "OK", "Oklahoma"), (41, "OR", "Oregon"),
+    (42, "PA", "Pennsylvania"), (44, "RI", "Rhode Island"), (45, "SC", "South Carolina"), (46, "SD", "South Dakota"),
+    (47, "TN", "Tennessee"), (48, "TX", "Texas"), (49, "UT", "Utah"), (50, "VT", "Vermont"), (51, "VA", "Virginia"),
+    (53, "WA", "Washington"), (54, "WV", "West Virginia"), (55, "WI", "Wisconsin"), (56, "WY", "Wyoming"),
+]
+
+# Named scales; "all" has one replica of the sample per state
+SCALES = {"1x": 1, "10x": 10, "100x": 100, "all": len(STATES)}
+
+# Replicas beyond one per state reuse the states with their county codes shifted by this much, which keeps
+# the tracts unique for up to three rounds of states (county codes have three digits)
+COUNTY_OFFSET = 300
+MAX_REPLICAS = 3 * len(STATES)
+
+# The identifiers of every replica are shifted by this much, so banks and credit unions are unique per replica
+ID_OFFSET = 10 ** 8
+
+# Every replica is moved this many degrees of longitude east of the previous one, so the replicas do not overlap
+LONGITUDE_STEP = 7.0
+
+# Excel sheets hold at most this many rows below the header
+EXCEL_MAX_ROWS = 1_048_575
+
+# Identifier columns of every sheet that are offset per replica
+ID_COLUMNS = {
+    "AirQuality_EPA_IL": [],
+    "SOD_IL_2024": ["CERT", "UNINUMBR", "RSSDID", "RSSDHCR"],
+    "NCUA_IL_Q2_2024": ["CU_NUMBER", "JOIN_NUMBER", "SiteId"],
+}
+
+# Measured values of the AirQuality sheet that are perturbed per row
+AQ_VALUE_COLUMNS = [
+    "arithmetic_mean", "standard_deviation", "first_max_value", "second_max_value", "third_max_value", "fourth_max_value",
+    "first_max_nonoverlap_value", "second_max_nonoverlap_value", "ninety_ninth_percentile", "ninety_eighth_percentile",
+    "ninety_fifth_percentile", "ninetieth_percentile", "seventy_fifth_percentile", "fiftieth_percentile", "tenth_percentile",
+]
+
+# Columns of the daily census tract-level PM2.5 file
+DAILY_COLUMNS = ["year", "date", "statefips", "countyfips", "ctfips", "latitude", "longitude", "DS_PM_pred", "DS_PM_stdd"]
+
+# Number of tracts written to the daily file at a time
+DAILY_BLOCK_TRACTS = 2000
+
+
+def parse_scale(scale):
+    """
+        Convert a scale ("1x", "10x", "100x", "all" or a number of replicas) to the number of replicas of the sample.
+    """
+    replicas = SCALES.get(str(scale).lower())
+    if replicas is None:
+        replicas = int(str(scale).lower().rstrip("x"))
+    if not 1 <= replicas <= MAX_REPLICAS:
+        raise ValueError(f"The scale must be between 1 and {MAX_REPLICAS} replicas, got {scale}")
+    return replicas
+
+
+class StateRotation:
+    """
+        Maps the states of the sample to the states of a replica.
+        Replica r moves every state r places along STATES, so replica 0 is the sample itself, the Illinois rows of
+        the replicas cover every state in turn, and the out-of-state rows of the sample move along consistently.
+    """
+
+    def __init__(self, replica):
+        self.replica = replica
+        self.cycle = replica // len(STATES)
+        shifted = STATES[replica % len(STATES):] + STATES[:replica % len(STATES)]
+        self.fips = {old[0]: new[0] for old, new in zip(STATES, shifted)}
+        self.alpha = {old[1]: new[1] for old, new in zip(STATES, shifted)}
+        self.names = {old[2]: new[2] for old, new in zip(STATES, shifted)}
+
+    def state_fips(self, values):
+        return pd.Series(values).map(lambda value: self.fips.get(int(value), value) if pd.notna(value) else value)
+
+    def county_fips(self, values):
+        return pd.Series(values) + COUNTY_OFFSET * self.cycle
+
+    def state_county(self, values):
+        """
+            Map five-digit state and county codes, e.g. STCNTYBR.
+        """
+        values = pd.Series(values)
+        return self.state_fips(values // 1000) * 1000 + self.county_fips(values % 1000)
+
+    def tract(self, values):
+        """
+            Map eleven-digit census tracts, keeping missing tracts missing and the dtype of the column.
+        """
+        values = pd.Series(values)
+        present = values.dropna().astype("int64")
+        mapped = self.state_county(present // 10 ** 6) * 10 ** 6 + present % 10 ** 6
+        return pd.Series(mapped.to_numpy(), index=present.index).reindex(values.index).astype(values.dtype)
+
+    def text(self, values, mapping):
+        return pd.Series(values).map(lambda value: mapping.get(value, value))
+
+
+def shift_longitude(values, replica):
+    return (pd.Series(values) + LONGITUDE_STEP * replica + 180) % 360 - 180
+
+
+def point(longitude, latitude):
+    return ("POINT (" + longitude.astype(str) + " " + latitude.astype(str) + ")").where(longitude.notna() & latitude.notna())
+
+
+def replicate_aq(sheet, replica, rng):
+    rotation = StateRotation(replica)
+    df = sheet.copy()
+    df["state_code"] = rotation.state_fips(df["state_code"])
+    df["county_code"] = rotation.county_fips(df["county_code"])
+    df["state"] = rotation.text(df["state"], rotation.names)
+    df["longitude"] = shift_longitude(df["longitude"], replica)
+    df["geometry"] = point(df["longitude"], df["latitude"])
+    df["census_tract"] = rotation.tract(df["census_tract"])
+    # Every monitor keeps its statistics consistent: all its values are scaled by the same factor
+    df[AQ_VALUE_COLUMNS] = df[AQ_VALUE_COLUMNS].mul(rng.lognormal(0.0, 0.1, len(df)), axis=0)
+    return df
+
+
+def replicate_sod(sheet, replica, rng):
+    rotation = StateRotation(replica)
+    df = sheet.copy()
+    for column in ID_COLUMNS["SOD_IL_2024"]:
+        df[column] = df[column] + ID_OFFSET * replica
+    for column in ["STNUMBR"]:
+        df[column] = rotation.state_fips(df[column])
+    for column in ["STCNTYBR", "STCNTY"]:
+        df[column] = rotation.state_county(df[column])
+    df["CNTYNUMB"] = rotation.county_fips(df["CNTYNUMB"])
+    for column in ["STALPBR", "STALP"]:
+        df[column] = rotation.text(df[column], rotation.alpha)
+    for column in ["STNAMEBR", "STNAME"]:
+        df[column] = rotation.text(df[column], rotation.names)
+    df["SIMS_LONGITUDE"] = shift_longitude(df["SIMS_LONGITUDE"], replica)
+    df["geometry"] = point(df["SIMS_LONGITUDE"], df["SIMS_LATITUDE"])
+    df["census_tract"] = rotation.tract(df["census_tract"])
+    df["DEPSUMBR"] = (df["DEPSUMBR"] * rng.lognormal(0.0, 0.2, len(df))).round().astype(df["DEPSUMBR"].dtype)
+    return df
+
+
+def replicate_ncua(sheet, replica, rng):
+    rotation = StateRotation(replica)
+    df = sheet.copy()
+    for column in ID_COLUMNS["NCUA_IL_Q2_2024"]:
+        df[column] = df[column] + ID_OFFSET * replica
+    for column in ["PhysicalAddressStateCode", "MailingAddressStateCode"]:
+        df[column] = rotation.text(df[column], rotation.alpha)
+    df["MailingAddressStateName"] = rotation.text(df["MailingAddressStateName"], rotation.names)
+    df["census tract"] = rotation.tract(df["census tract"])
+    return df
+
+
+REPLICATORS = {
+    "AirQuality_EPA_IL": replicate_aq,
+    "SOD_IL_2024": replicate_sod,
+    "NCUA_IL_Q2_2024": replicate_ncua,
+}
+
+
+def synthetic_sheets(replicas, seed=DEFAULT_SEED, template=TEMPLATE_FILE):
+    """
+        Build the sheets of a synthetic case study workbook with the given number of replicas of the sample.
+
+        Every replica keeps every column and dtype of the sample sheets. Census tracts, state and county codes and
+        state names are moved to another state (see StateRotation), bank and credit union identifiers are offset so
+        they are unique, coordinates are shifted east, and the air quality and deposit values are perturbed.
+
+        Returns:
+            dict: The sheets by name, in the order of the sample workbook.
+    """
+    sample = pd.read_excel(template, sheet_name=CASE_STUDY_SHEETS)
+    for sheet_name, df in sample.items():
+        if len(df) * replicas > EXCEL_MAX_ROWS:
+            raise ValueError(f"{replicas} replicas of {sheet_name} exceed the {EXCEL_MAX_ROWS:,} rows of an Excel sheet")
+
+    sheets = {}
+    for sheet_number, sheet_name in enumerate(CASE_STUDY_SHEETS):
+        parts = [REPLICATORS[sheet_name](sample[sheet_name], replica, np.random.default_rng([seed, sheet_number, replica]))
+                 for replica in range(replicas)]
+        sheets[sheet_name] = pd.concat(parts, ignore_index=True)
+    return sheets
+
+
+def tract_locations(sheets):
+    """
+        Return the census tracts of the sheets with the mean coordinates of their monitors and branches.
+    """
+    aq, sod, ncua = (sheets[sheet_name] for sheet_name in CASE_STUDY_SHEETS)
+    located = pd.concat([
+        aq[["census_tract", "latitude", "longitude"]],
+        sod[["census_tract", "SIMS_LATITUDE", "SIMS_LONGITUDE"]].rename(columns={"SIMS_LATITUDE": "latitude", "SIMS_LONGITUDE": "longitude"}),
+    ]).dropna(subset=["census_tract"])
+    locations = located.groupby(located["census_tract"].astype("int64"))[["latitude", "longitude"]].mean()
+
+    tracts = pd.Index(ncua["census tract"].dropna().astype("int64")).union(locations.index)
+    locations = locations.reindex(tracts)
+    return locations.fillna(locations.mean())
+
+
+def write_daily_file(path, sheets, years=DEFAULT_YEARS, days=None, seed=DEFAULT_SEED):
+    """
+        Write a daily census tract-level PM2.5 file for every census tract of the sheets, streamed in blocks of tracts.
+
+        The mean concentration of a tract grows slightly with the number of branches in it, so the synthetic data
+        has a correlation for the analysis and the model to find. Daily values vary around the tract mean
+        with a seasonal cycle.
+
+        Args:
+            path (str): The CSV file to write.
+            sheets (dict): The synthetic sheets (see synthetic_sheets).
+            years (tuple): The years of daily values.
+            days (int): The number of days per year. Defaults to every day of the year.
+            seed (int): The random seed.
+
+        Returns:
+            int: The number of rows written.
+    """
+    locations = tract_locations(sheets)
+    branches = pd.concat([sheets["SOD_IL_2024"]["census_tract"], sheets["NCUA_IL_Q2_2024"]["census tract"]]).dropna().astype("int64").value_counts()
+    branches = branches.reindex(locations.index, fill_value=0).to_numpy()
+
+    rng = np.random.default_rng([seed, len(locations)])
+    tract_means = np.clip(rng.normal(8.0, 1.2, len(locations)) + 0.4 * np.log1p(branches), 2.0, None)
+
+    dates = pd.DatetimeIndex(np.concatenate([pd.date_range(f"{year}-01-01", f"{year}-12-31").to_numpy()[:days] for year in years]))
+    season = 1 + 0.25 * np.cos(2 * np.pi * (dates.dayofyear.to_numpy() - 15) / 365.25)
+
+    rows = 0
+    with open(path, "w", newline="") as file:
+        for start in range(0, len(locations), DAILY_BLOCK_TRACTS):
+            block = slice(start, start + DAILY_BLOCK_TRACTS)
+            tracts = locations.index.to_numpy()[block]
+            n = len(tracts) * len(dates)
+            values = np.repeat(tract_means[block], len(dates)) * np.tile(season, len(tracts)) * rng.lognormal(0.0, 0.3, n)
+            daily = pd.DataFrame({
+                "year": np.tile(dates.year.to_numpy(), len(tracts)),
+                "date": np.tile(dates.strftime("%Y-%m-%d").to_numpy(), len(tracts)),
+                "statefips": np.repeat(tracts // 10 ** 9, len(dates)),
+                "countyfips": np.repeat(tracts // 10 ** 6, len(dates)),
+                "ctfips": np.repeat(tracts, len(dates)),
+                "latitude": np.repeat(locations["latitude"].to_numpy()[block], len(dates)),
+                "longitude": np.repeat(locations["longitude"].to_numpy()[block], len(dates)),
+                "DS_PM_pred": values,
+                "DS_PM_stdd": values * rng.uniform(0.05, 0.2, n),
+            }, columns=DAILY_COLUMNS)
+            daily.to_csv(file, index=False, header=start == 0, float_format="%.6f")
+            rows += n
+    return rows
+
+
+def daily_file_name(years):
+    first, last = min(years), max(years)
+    return f"Daily_Census_Tract-Level_PM2.5_Concentrations__{first}_-_{last}.csv"
+
+
+def read_manifest(output_dir):
+    manifest_file = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file) as file:
+        return json.load(file)
+
+
+def generate(output_dir, scale="1x", seed=DEFAULT_SEED, years=DEFAULT_YEARS, days=None, template=TEMPLATE_FILE):
+    """
+        Generate a synthetic case study workbook and daily PM2.5 file in a data directory, in the layout the pipeline
+        stages read, and record what was generated in a manifest.
+
+        Args:
+            output_dir (str): The data directory to write to.
+            scale (str): "1x", "10x", "100x", "all" (one replica per state) or a number of replicas of the sample.
+            seed (int): The random seed; the same arguments always generate the same files.
+            years (tuple): The years of the daily PM2.5 file.
+            days (int): The number of days per year in the daily file. Defaults to every day.
+            template (str): The sample workbook the synthetic sheets are modelled on.
+
+        Returns:
+            dict: The manifest: the arguments and the files written with their row counts.
+    """
+    replicas = parse_scale(scale)
+    os.makedirs(output_dir, exist_ok=True)
+
+    sheets = synthetic_sheets(replicas, seed, template)
+    workbook = os.path.join(output_dir, CASE_STUDY_FILE)
+    with pd.ExcelWriter(workbook) as writer:
+        for sheet_name, df in sheets.items():
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+
+    daily_file = daily_file_name(years)
+    daily_rows = write_daily_file(os.path.join(output_dir, daily_file), sheets, years, days, seed)
+
+    manifest = {
+        "scale": str(scale),
+        "replicas": replicas,
+        "seed": seed,
+        "years": list(years),
+        "days": days,
+        "files": {
+            CASE_STUDY_FILE: {sheet_name: len(df) for sheet_name, df in sheets.items()},
+            daily_file: daily_rows,
+        },
+    }
+    with open(os.path.join(output_dir, MANIFEST_FILE), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic SOD, NCUA, AirQuality and daily PM2.5 data at a given scale.")
+    parser.add_argument("output_dir", help="Data directory to write the files to")
+    parser.add_argument("--scale", default="1x", help="1x, 10x, 100x, all (one replica per state) or a number of replicas")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help="Random seed")
+    parser.add_argument("--years", nargs="+", type=int, default=list(DEFAULT_YEARS), help="Years of the daily PM2.5 file")
+    parser.add_argument("--days", type=int, help="Days per year in the daily PM2.5 file (defaults to every day)")
+    args = parser.parse_args()
+
+    manifest = generate(args.output_dir, args.scale, args.seed, tuple(args.years), args.days)
+    for name, rows in manifest["files"].items():
+        print(f"{name}: {rows}")
+
+
+if __name__ == "__main__":
+    main()